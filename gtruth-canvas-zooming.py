@@ -5,6 +5,27 @@ import sys
 import gtruth_meicreate
 from   gtruth_zoom import ZoomerMover
 from gtruth_sorts import *
+from gtruth_profile import span
+from gtruth_undo import EditLog
+from gtruth_journal import EditJournal, journal_path, has_journal,\
+        replay_journal
+from gtruth_session import Session, save_session, load_session,\
+        session_path, preprocessed_path
+from gtruth_store import store_from_environment, export_date
+from gtruth_meiload import read_mei_document
+from gtruth_predictions import PredictionLoader, predictions_from_environment
+from gtruth_lod import BoxLOD, lod_size_from_environment
+from gtruth_staffprop import StaffProposer
+from gtruth_ink import InkIndexBuilder
+from gtruth_ccache import ComponentIndexBuilder
+from gtruth_cache import page_key
+from gtruth_preprocess import preprocess, pipeline_from_environment,\
+        ensure_packed, packed_cache_path, sat_cache_path
+from gtruth_packed import PackedPage
+from gtruth_tiles import TileCache, TILE_SIZE, level_for_scale
+from gtruth_barprop import propose_bar_boxes
+from gtruth_snap import snap_point
+from gtruth_tighten import tighten_rects
 
 # For image preprocessing
 import gamera.core
@@ -16,10 +37,11 @@ from gtruthrect import *
 from gtruthtextedit import *
 from gtruthhelp import GtruthHelpFrame, helpmess
 import os.path
-import tempfile
+import shutil
+import datetime
 
 # For loading meifiles
-from pymei import MeiDocument, MeiElement, XmlImport
+from pymei import MeiDocument, MeiElement
 
 '''Must append path to meicreate.py to PYTHONPATH environment variable unless
 this is run in the same directory as it. '''
@@ -35,6 +57,20 @@ ID_ZOOM_IN          = wx.ID_HIGHEST + 4
 ID_ZOOM_OUT         = wx.ID_HIGHEST + 5
 ID_MINBOX_INC       = wx.ID_HIGHEST + 6
 ID_MINBOX_DEC       = wx.ID_HIGHEST + 7
+ID_SAVE_SESSION     = wx.ID_HIGHEST + 8
+ID_OPEN_SESSION     = wx.ID_HIGHEST + 9
+ID_LOAD_STORE       = wx.ID_HIGHEST + 10
+ID_PROPOSE_STAVES   = wx.ID_HIGHEST + 11
+ID_ACCEPT_PROPOSALS = wx.ID_HIGHEST + 12
+ID_REJECT_PROPOSALS = wx.ID_HIGHEST + 13
+ID_PROPOSE_BARS     = wx.ID_HIGHEST + 14
+ID_SNAP_TO_INK      = wx.ID_HIGHEST + 15
+ID_TIGHTEN_MODE     = wx.ID_HIGHEST + 16
+ID_TIGHTEN_ALL      = wx.ID_HIGHEST + 17
+ID_LOAD_PREDICTIONS = wx.ID_HIGHEST + 18
+
+# how far (in pixels on the screen) box edges are pulled when snapping to ink
+SNAP_RADIUS = 12
 
 class MyApp(wx.App):
     '''
@@ -73,6 +109,7 @@ class MainWindow(wx.ScrolledWindow):
         self.Bind(wx.EVT_LEFT_UP, self.OnLeftUp)
         self.Bind(wx.EVT_MOTION, self.OnMouseMove)
         self.Bind(wx.EVT_RIGHT_DOWN, self.OnControlClick)
+        self.Bind(wx.EVT_MIDDLE_DOWN, self.OnMiddleClick)
 
         # List of panels bounding the bars
         self.barpanels = []
@@ -80,14 +117,43 @@ class MainWindow(wx.ScrolledWindow):
         # List of panels bounding the staves
         self.staffpanels = [] 
 
-        # Initially no background image
-        self.bmp = None
+        # Boxes proposed automatically that the user has not accepted or
+        # rejected yet, for each rectangle mode
+        self.proposals = {'BAR': [], 'STAFF': []}
+        # counts the changes to the proposals of each mode
+        self.proposalsversion = {'BAR': 0, 'STAFF': 0}
+
+        # density maps of the boxes for drawing them when zoomed far out,
+        # below the on-screen size set by GTRUTH_LOD_SIZE
+        self.boxlod = BoxLOD(lod_size_from_environment())
+        # counts the changes to the boxes made without the edit log (see
+        # BoxesChanged), which the density maps are kept by along with the
+        # edit log's version
+        self.boxesversion = 0
+
+        # size of the page, set when one is shown
+        self.maxWidth = 0
+        self.maxHeight = 0
+
+        # Initially no background image; the page is drawn from the tiles of
+        # its packed pixels (see gtruth_tiles)
+        self.tiles = None
 
         # for zooming, start at original size
         self.userscale = (1.0,1.0)
         
-        # the panel we are currently resizing
+        # the panel we are currently resizing, and the rectangle mode of the
+        # list it is in
         self.curpanel = None
+        self.curpanelkind = None
+
+        # whether curpanel was just created (rather than being resized) and
+        # its box before the resizing began, for recording the edit
+        self.curpanelisnew = False
+        self.curpanelorigbox = None
+
+        # history of box edits for undo and redo
+        self.editlog = EditLog(self.GetPanels)
 
         # for storing the state of the mouse button
         self.leftdown = False
@@ -104,9 +170,31 @@ class MainWindow(wx.ScrolledWindow):
         # bothersome, the user may increase or decrease the minimum box size
         self.minboxsize = 20 # the size of the x and y dimensions
 
+        # whether box edges are pulled to the nearest ink boundary or barline
+        # while drawing and resizing
+        self.snaptoink = False
+
         self.Show(True)
         self.Refresh()
 
+    def GetPanels(self, kind):
+        '''
+        Returns the list of panels for a rectangle mode ('BAR' or 'STAFF').
+        '''
+        if kind == 'BAR':
+            return self.barpanels
+        elif kind == 'STAFF':
+            return self.staffpanels
+        raise ValueError("Unrecognized rectangle mode " + kind)
+
+    def _SnapPoint(self, point, anchor):
+        # Snap the moving corner of the box if snapping is on and the page's
+        # ink has been indexed
+        if (not self.snaptoink) or (self.parent.inkindex == None):
+            return point
+        return snap_point(self.parent.inkindex, point, anchor,\
+                SNAP_RADIUS/self.userscale[0])
+
     def _EnforceMinPanelSize(self, size):
         # set size conditional on the minimum box size
         if self.curpanel == None:
@@ -149,20 +237,123 @@ class MainWindow(wx.ScrolledWindow):
         # the wx docs said not to call self.PrepareDC but when I didn't, it
         # didn't work
         dc.SetUserScale(*self.userscale)
-        if self.bmp != None:
-            dc.DrawBitmap(self.bmp, 0, 0, True)
-        for p in self.barpanels:
-            dc.SetBrush(wx.Brush('WHITE',\
-                    style=wx.TRANSPARENT))
-            dc.SetPen(wx.Pen('RED',\
-                    width=3.0/self.userscale[0], style=wx.SOLID))
-            dc.DrawRectangle(*p.GetBox())
-        for p in self.staffpanels:
-            dc.SetBrush(wx.Brush('WHITE',\
-                    style=wx.TRANSPARENT))
-            dc.SetPen(wx.Pen('GREEN',\
-                    width=3.0/self.userscale[0], style=wx.SOLID))
-            dc.DrawRectangle(*p.GetBox())
+        if self.tiles != None:
+            self._DrawTiles(dc)
+        # zoomed far out, the boxes of a kind are drawn as a density map
+        # rather than outlines (see gtruth_lod)
+        for kind, colour in (('BAR', 'RED'), ('STAFF', 'GREEN')):
+            panels = self.GetPanels(kind)
+            if self._DrawDensity(dc, kind, (self.editlog.version,\
+                    self.boxesversion), panels, colour):
+                # the box being drawn or resized still gets its outline
+                if self.curpanel != None and self.curpanelkind == kind:
+                    panels = [self.curpanel]
+                else:
+                    continue
+            dc.SetBrush(wx.Brush('WHITE', style=wx.TRANSPARENT))
+            dc.SetPen(wx.Pen(colour, width=3.0/self.userscale[0],\
+                    style=wx.SOLID))
+            for p in panels:
+                dc.DrawRectangle(*p.GetBox())
+        # proposals are drawn dashed in the colour of their kind
+        for kind, colour in (('BAR', 'RED'), ('STAFF', 'GREEN')):
+            if self._DrawDensity(dc, 'PROPOSED ' + kind,\
+                    self.proposalsversion[kind], self.proposals[kind],\
+                    colour):
+                continue
+            dc.SetBrush(wx.Brush('WHITE', style=wx.TRANSPARENT))
+            dc.SetPen(wx.Pen(colour, width=2.0/self.userscale[0],\
+                    style=wx.SHORT_DASH))
+            for p in self.proposals[kind]:
+                dc.DrawRectangle(*p.GetBox())
+
+    def _DrawDensity(self, dc, name, version, rects, colour):
+        '''
+        Draw rects as a density map if they are too small on the screen to
+        be drawn as outlines. Returns whether they were.
+        '''
+        scale = self.userscale[0]
+        densitymap = self.boxlod.DensityMap(name, version, rects, scale,\
+                self.maxWidth, self.maxHeight, wx.NamedColour(colour))
+        if densitymap == None:
+            return False
+        cell, bmp = densitymap
+        # A pixel of the map covers a cell of cell by cell page pixels
+        dc.SetUserScale(scale * cell, scale * cell)
+        dc.DrawBitmap(bmp, 0, 0, True)
+        dc.SetUserScale(*self.userscale)
+        return True
+
+    def _DrawTiles(self, dc):
+        '''
+        Draw the tiles of the page that are in view, at the level of detail
+        that suits the zoom.
+        '''
+        scale = self.userscale[0]
+        unitx, unity = self.GetScrollPixelsPerUnit()
+        viewx, viewy = self.GetViewStart()
+        width, height = self.GetClientSize()
+        ulx, uly = viewx * unitx / scale, viewy * unity / scale
+        level = level_for_scale(scale)
+        tiles = self.tiles.VisibleTiles(level, ulx, uly, ulx + width / scale,\
+                uly + height / scale)
+        # A tile pixel covers 2**level page pixels
+        factor = 2 ** level
+        dc.SetUserScale(scale * factor, scale * factor)
+        for tx, ty, bmp in tiles:
+            dc.DrawBitmap(bmp, tx * TILE_SIZE, ty * TILE_SIZE, False)
+        dc.SetUserScale(*self.userscale)
+
+    def BoxesChanged(self):
+        '''
+        Redraw after the boxes were changed without going through the edit
+        log. Every change like that must call this.
+        '''
+        self.boxesversion += 1
+        self.boxlod.Clear()
+        self.Refresh()
+
+    def SetProposals(self, kind, rects):
+        '''
+        Replace the proposed boxes of a kind.
+        '''
+        self.proposals[kind] = rects
+        self.proposalsversion[kind] += 1
+        self.Refresh()
+
+    def AcceptProposals(self, kind, rects=None):
+        '''
+        Turn the proposed boxes rects (all of them if None) into real boxes.
+        This is recorded as one edit so it can be undone.
+        '''
+        if rects is None:
+            rects = self.proposals[kind]
+        accepted = set([r.id for r in rects])
+        self.proposals[kind] = [r for r in self.proposals[kind]\
+                if r.id not in accepted]
+        self.proposalsversion[kind] += 1
+        self.GetPanels(kind).extend(rects)
+        self.editlog.record_add(kind, rects)
+        self.Refresh()
+        return len(rects)
+
+    def RejectProposals(self, kind, rects=None):
+        if rects is None:
+            rects = self.proposals[kind]
+        rejected = set([r.id for r in rects])
+        self.proposals[kind] = [r for r in self.proposals[kind]\
+                if r.id not in rejected]
+        self.proposalsversion[kind] += 1
+        self.Refresh()
+        return len(rects)
+
+    def _ProposalAt(self, evt):
+        unscrolledevtx, unscrolledevty = \
+            self.CalcUnscrolledPosition(evt.GetPosition())
+        return find_smallest_enclosing_rect(\
+                sort_by_area(self.proposals[self.parent.rectmode]),\
+                (unscrolledevtx/self.userscale[0],\
+                unscrolledevty/self.userscale[1]))
 
     def Zoom(self, factor):
         '''
@@ -180,6 +371,13 @@ class MainWindow(wx.ScrolledWindow):
         If shift is down, edit an old panel.
         '''
 
+        if evt.ControlDown():
+            # Control-click accepts the proposal under the mouse
+            proposal = self._ProposalAt(evt)
+            if proposal != None:
+                self.AcceptProposals(self.parent.rectmode, [proposal])
+            return
+
         if self.leftdown ==  False:
 
             if self.parent.rectmode == 'BAR':
@@ -224,6 +422,10 @@ class MainWindow(wx.ScrolledWindow):
                 self.leftdownorigx, self.leftdownorigy =\
                         self.curpanel.GetPosition()
 
+                self.curpanelkind = self.parent.rectmode
+                self.curpanelisnew = False
+                self.curpanelorigbox = self.curpanel.GetBox()
+
             else:
 
                 self.leftdownorigx, self.leftdownorigy =\
@@ -235,14 +437,25 @@ class MainWindow(wx.ScrolledWindow):
 
                 self.curpanel = panels[-1]
 
+                self.curpanelkind = self.parent.rectmode
+                self.curpanelisnew = True
+                self.curpanelorigbox = None
+
             self.Refresh()
             self.ReleaseMouse()
 
     def OnControlClick(self, evt):
         '''
         Destroy the smallest rectangle beneath the mouse.
+        With control held down, reject the proposal beneath the mouse instead.
         '''
 
+        if evt.ControlDown():
+            proposal = self._ProposalAt(evt)
+            if proposal != None:
+                self.RejectProposals(self.parent.rectmode, [proposal])
+            return
+
         if self.parent.rectmode == 'BAR':
             panels = self.barpanels
         elif self.parent.rectmode == 'STAFF':
@@ -268,13 +481,49 @@ class MainWindow(wx.ScrolledWindow):
             self.ReleaseMouse()
             return
 
-        panels.remove(rect)
+        index = panels.index(rect)
+
+        del panels[index]
+
+        self.editlog.record_delete(self.parent.rectmode, rect, index)
 
         del(rect)
 
         self.Refresh()
         self.ReleaseMouse()
 
+    def Tighten(self, kind, rects=None):
+        '''
+        Shrink the boxes rects of a kind (all of them if None) to the ink
+        inside them. Recorded as one edit. Returns the number of boxes that
+        changed, or None if the page's ink is not indexed yet.
+        '''
+        if self.parent.inkindex == None:
+            return None
+        if rects is None:
+            rects = self.GetPanels(kind)
+        changes = tighten_rects(self.parent.inkindex, rects)
+        self.editlog.record_reshape(kind, changes)
+        self.Refresh()
+        return len(changes)
+
+    def OnMiddleClick(self, evt):
+        '''
+        Tighten the smallest rectangle beneath the mouse.
+        '''
+        kind = self.parent.rectmode
+        unscrolledevtx, unscrolledevty = \
+            self.CalcUnscrolledPosition(evt.GetPosition())
+        rect = find_smallest_enclosing_rect(\
+                sort_by_area(self.GetPanels(kind)),\
+                (unscrolledevtx/self.userscale[0],\
+                unscrolledevty/self.userscale[1]))
+        if rect == None:
+            return
+        if self.Tighten(kind, [rect]) == None:
+            self.parent.GetStatusBar().SetStatusText('The page is still '\
+                    + 'being analysed, try again in a moment.')
+
     def OnMouseMove(self, evt):
         '''
         Resize the rectange as we're drawing it, if we're drawing it.
@@ -289,6 +538,9 @@ class MainWindow(wx.ScrolledWindow):
             x0, y0 = (unscrolledevtx/self.userscale[0],\
                         unscrolledevty/self.userscale[1])
 
+            x0, y0 = self._SnapPoint((x0, y0),\
+                    (self.leftdownorigx, self.leftdownorigy))
+
             pos, size = self._HandleBoxDrawingMotion(x0, y0)
 
             # set size conditional on the minimum box size
@@ -315,6 +567,15 @@ class MainWindow(wx.ScrolledWindow):
 
             curx, cury = self.curpanel.GetPosition()
 
+            x0, y0 = self._SnapPoint((x0, y0),\
+                    (self.leftdownorigx, self.leftdownorigy))
+
+            if self.curpanelisnew:
+                # The corner first clicked on may be snapped too now that
+                # the extent of the new box is known
+                self.leftdownorigx, self.leftdownorigy = self._SnapPoint(\
+                        (self.leftdownorigx, self.leftdownorigy), (x0, y0))
+
             pos, size = self._HandleBoxDrawingMotion(x0, y0)
 
             self.leftdown = False
@@ -323,7 +584,16 @@ class MainWindow(wx.ScrolledWindow):
             self._EnforceMinPanelSize(size)
 
             self.curpanel.SetPosition(pos)
+
+            if self.curpanelisnew:
+                self.editlog.record_create(self.curpanelkind,\
+                        self.curpanel)
+            else:
+                self.editlog.record_resize(self.curpanelkind,\
+                        self.curpanel, self.curpanelorigbox)
+
             self.curpanel = None
+            self.curpanelkind = None
             self.Refresh()
             self.ReleaseMouse()
     
@@ -356,10 +626,42 @@ class MyFrame(wx.Frame):
         filemenu.Append(wx.ID_SAVE, "S&ave\tShift-Alt-S",\
                 "Save rectangle data")
 
+        # save and reopen the whole annotation session of a page
+        filemenu.Append(ID_SAVE_SESSION, "Save session\tAlt-W",\
+                "Save boxes and notes for reopening the page quickly")
+        filemenu.Append(ID_OPEN_SESSION, "Open session\tAlt-R",\
+                "Reopen a page saved with Save session")
+
+        # load the boxes of the current page from the corpus store
+        filemenu.Append(ID_LOAD_STORE, "Load from store\tAlt-D",\
+                "Load the boxes of this page from the corpus store")
+
+        # automatic box proposals
+        filemenu.Append(ID_PROPOSE_STAVES, "Propose staff boxes\tAlt-P",\
+                "Find the staves and propose staff boxes")
+        self.snapmenuitem = filemenu.AppendCheckItem(ID_SNAP_TO_INK,\
+                "Snap to ink\tAlt-G",\
+                "Pull box edges to the nearest ink boundary or barline")
+        filemenu.Append(ID_TIGHTEN_MODE, "Tighten boxes\tAlt-T",\
+                "Shrink the boxes of the current mode to the ink inside them")
+        filemenu.Append(ID_TIGHTEN_ALL, "Tighten all boxes",\
+                "Shrink all boxes to the ink inside them")
+        self.barpropmenuitem = filemenu.AppendCheckItem(ID_PROPOSE_BARS,\
+                "Propose bar boxes\tAlt-B",\
+                "Propose bar boxes inside the staff boxes as they change")
+        filemenu.Append(ID_ACCEPT_PROPOSALS, "Accept proposals\tAlt-A",\
+                "Accept all proposed boxes of the current mode")
+        filemenu.Append(ID_REJECT_PROPOSALS, "Reject proposals\tAlt-J",\
+                "Reject all proposed boxes of the current mode")
+
         # load some rectangles (for testing usually)
         filemenu.Append(ID_LOAD_BOXES, "L&oad \tAlt-L",\
                 "Load some rectangles")
 
+        # load the barline finder's predictions for a whole corpus
+        filemenu.Append(ID_LOAD_PREDICTIONS, "Load predictions\tAlt-E",\
+                "Load a directory of predicted boxes to propose on each page")
+
         # entries for zooming in and out
         filemenu.Append(ID_ZOOM_IN, "Zoom In\tAlt-+",\
                 "Zoom in the window")
@@ -371,6 +673,11 @@ class MyFrame(wx.Frame):
                 "Increase minimum box size")
         # clear the rectangles
         filemenu.Append(wx.ID_CLEAR, "C&lear", "Clear all rectangles")
+
+        # undo and redo box edits
+        filemenu.Append(wx.ID_UNDO, "Undo\tAlt-Z", "Undo the last box edit")
+        filemenu.Append(wx.ID_REDO, "Redo\tAlt-Y",\
+                "Redo the last undone box edit")
         filemenu.Append(ID_MINBOX_DEC, "Decrease minimum\tAlt-<",\
                 "Decrease minimum box size")
 
@@ -398,7 +705,21 @@ class MyFrame(wx.Frame):
         self.Bind(wx.EVT_MENU, self.OnOpen, id=wx.ID_OPEN)
         self.Bind(wx.EVT_MENU, self.OnSave, id=wx.ID_SAVE)
         self.Bind(wx.EVT_MENU, self.OnClearRect, id=wx.ID_CLEAR)
+        self.Bind(wx.EVT_MENU, self.OnUndo, id=wx.ID_UNDO)
+        self.Bind(wx.EVT_MENU, self.OnRedo, id=wx.ID_REDO)
         self.Bind(wx.EVT_MENU, self.OnLoadRects, id=ID_LOAD_BOXES)
+        self.Bind(wx.EVT_MENU, self.OnLoadPredictions,\
+                id=ID_LOAD_PREDICTIONS)
+        self.Bind(wx.EVT_MENU, self.OnSaveSession, id=ID_SAVE_SESSION)
+        self.Bind(wx.EVT_MENU, self.OnOpenSession, id=ID_OPEN_SESSION)
+        self.Bind(wx.EVT_MENU, self.OnLoadStore, id=ID_LOAD_STORE)
+        self.Bind(wx.EVT_MENU, self.OnProposeStaves, id=ID_PROPOSE_STAVES)
+        self.Bind(wx.EVT_MENU, self.OnProposeBars, id=ID_PROPOSE_BARS)
+        self.Bind(wx.EVT_MENU, self.OnSnapToInk, id=ID_SNAP_TO_INK)
+        self.Bind(wx.EVT_MENU, self.OnTightenMode, id=ID_TIGHTEN_MODE)
+        self.Bind(wx.EVT_MENU, self.OnTightenAll, id=ID_TIGHTEN_ALL)
+        self.Bind(wx.EVT_MENU, self.OnAcceptProposals, id=ID_ACCEPT_PROPOSALS)
+        self.Bind(wx.EVT_MENU, self.OnRejectProposals, id=ID_REJECT_PROPOSALS)
         self.Bind(wx.EVT_MENU, self.OnHelp, id=ID_HELP_DLG)
         self.Bind(wx.EVT_MENU, self.OnRectModeTog, id=ID_TOGGLE_RECT_MODE)
 
@@ -419,6 +740,11 @@ class MyFrame(wx.Frame):
         # name of currently open picture file
         self.curpicfilename = ''
 
+        # path of the original image of the current picture (without its
+        # extension when it was opened from a session), which identifies the
+        # page to the background tasks and among the predictions
+        self.curimagepath = ''
+
         # child window that is the window containing all the elements
         self.scrolledwin = MainWindow(self)
 
@@ -432,8 +758,55 @@ class MyFrame(wx.Frame):
         # initialize gamera so it works
         gamera.core.init_gamera()
 
-        # place to store gamera image proxy for getting dpi basically
-        self.image = None
+        # the page being annotated, memory mapped from its packed file in the
+        # page cache (see gtruth_packed), and its preprocessed image
+        self.page = None
+        self.ppimagepath = None
+
+        # corpus annotation store, only used when GTRUTH_STORE is set
+        self.store = store_from_environment()
+
+        # preprocessing pipeline of the opened pages, set by GTRUTH_PIPELINE
+        self.pipeline = pipeline_from_environment()
+
+        # precomputed ink of the current page, built in the background after
+        # opening it
+        self.inkindex = None
+
+        # cache key of the current page and its connected components, also
+        # built in the background
+        self.pagekey = None
+        self.components = None
+
+        # predicted boxes of the corpus, proposed on each page opened (see
+        # gtruth_predictions), loaded in the background
+        self.predictions = None
+        self.predictionsdir = None
+        settings = predictions_from_environment()
+        if settings != None:
+            self.LoadPredictions(*settings)
+
+        # whether bar boxes are proposed whenever the staff boxes change
+        self.autobarproposals = False
+        self.scrolledwin.editlog.listeners.append(self._OnEditForProposals)
+
+        # autosave journal of the box edits for the current image
+        self.journal = None
+
+        # the day the boxes of the current page were last changed, written in
+        # the MEI header so saving an unchanged page writes the same file;
+        # None until known (and then today's date is written)
+        self.editdate = None
+        self.scrolledwin.editlog.listeners.append(self._OnEditForDate)
+
+        # the journal is synced to disk from a timer so that drawing never
+        # waits on the disk
+        self.journaltimer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.OnJournalTimer, self.journaltimer)
+        self.journaltimer.Start(1000)
+
+        # closing cleanly removes the journal
+        self.Bind(wx.EVT_CLOSE, self.OnClose)
 
     def Zoom(self, factor):
         try:
@@ -496,6 +869,70 @@ class MyFrame(wx.Frame):
         print "Good-bye now!"
         self.Close()
 
+    def OnClose(self, event):
+        # Closing cleanly leaves no journal behind to restore
+        if self.journal != None:
+            self.journal.Discard()
+        self.StopJournal()
+        event.Skip()
+
+    def _OnEditForDate(self, delta):
+        self.editdate = datetime.date.today().isoformat()
+
+    def OnJournalTimer(self, event):
+        if self.journal != None:
+            self.journal.Sync()
+
+    def StopJournal(self):
+        if self.journal == None:
+            return
+        self.scrolledwin.editlog.listeners.remove(self.journal.Record)
+        self.journal.Close()
+        self.journal = None
+
+    def StartJournal(self):
+        '''
+        Start journaling the box edits of the current picture, first offering
+        to restore the boxes of a previous session that was not closed
+        cleanly.
+        '''
+        self.StopJournal()
+
+        path = journal_path(self.curpicfilename)
+
+        restored = False
+        if has_journal(path):
+            restoredlg = wx.MessageDialog(self,\
+                    message="Unsaved boxes were found for this image. Would "\
+                    + "you like to restore them?",\
+                    caption="Restore autosaved boxes",\
+                    style=(wx.YES_NO))
+            if restoredlg.ShowModal() == wx.ID_YES:
+                del self.scrolledwin.barpanels[:]
+                del self.scrolledwin.staffpanels[:]
+                self.scrolledwin.editlog.Reset()
+                with span('open.replay_journal'):
+                    count, skipped = replay_journal(path,\
+                            self.scrolledwin.GetPanels)
+                self.scrolledwin.BoxesChanged()
+                message = "Restored %d autosaved edits." % count
+                if skipped > 0:
+                    message += " Skipped %d edits of missing boxes." % skipped
+                self.GetStatusBar().SetStatusText(message)
+                restored = True
+                self.editdate = datetime.date.fromtimestamp(\
+                        os.path.getmtime(path)).isoformat()
+
+        self.journal = EditJournal(path, self.scrolledwin.GetPanels)
+        if restored:
+            # The restored boxes are still unsaved, so keep them as a
+            # snapshot that does not depend on anything before it
+            self.journal.Compact()
+        else:
+            # Nothing is unsaved yet, the first edit writes a snapshot
+            self.journal.Discard()
+        self.scrolledwin.editlog.listeners.append(self.journal.Record)
+
     def OnOpen(self, event):
 
         fdlg = wx.FileDialog(self)
@@ -511,19 +948,32 @@ class MyFrame(wx.Frame):
 
                 return
 
-            # Load gamera image to run property methods later
-            self.image = gamera.core.load_image(fdlg.GetPath())
-
-            # make image greyscale
-            self.image = self.image.to_greyscale()
-
-            # binarize image
-            self.image = self.image.to_onebit()
+            # Let go of the previous page before preprocessing this one
+            self.scrolledwin.tiles = None
+            self.page = None
+            self.inkindex = None
+            self.components = None
+
+            # The preprocessed image is kept in the page cache, so opening
+            # the page again skips the preprocessing. Only the packed page is
+            # kept open, the gamera image is dropped right away.
+            try:
+                with span('open.preprocess', page=fname):
+                    ppimagepath = preprocess(fdlg.GetPath(), self.pipeline,\
+                            load=False)[1]
+                    self.page = PackedPage(packed_cache_path(ppimagepath))
+            except Exception as err:
+                # The previous page is gone, so are its journal and the
+                # results still being computed for it
+                self.StopJournal()
+                self.curimagepath = ''
+                self.GetStatusBar().SetStatusText(\
+                        "Could not preprocess %s: %s" % (fname, err))
+                return
 
-            # correct the rotation of the image
-            self.image = self.image.correct_rotation(0)
+            self.ppimagepath = ppimagepath
 
-            # TODO: border removal could happen here too
+            self.pagekey = page_key(ppimagepath)
 
             # get an image path that doesn't end in .tiff or .tif
             fname = fdlg.GetPath()
@@ -542,28 +992,252 @@ class MyFrame(wx.Frame):
 
             print "Current picture file name:", self.curpicfilename
 
-            # path to preprocessed image version
-            tempimage = tempfile.NamedTemporaryFile()
-            ppimagepath = tempimage.name
+            self.curimagepath = fname
+
+            self.editdate = None
+
+            self.scrolledwin.SetProposals('BAR', [])
+            self.scrolledwin.SetProposals('STAFF', [])
 
-            self.image.save_tiff(ppimagepath)
+            # The edits of the previous page cannot be undone on this one
+            self.scrolledwin.editlog.Reset()
 
-            # Load the preprocessed image's pixels
-            bmp = wx.Bitmap(ppimagepath, wx.BITMAP_TYPE_TIF)
+            self.StartJournal()
 
-            # a string to print status to
-            statusstr = "File loaded: %s, resolution %d dpi" % \
-                    (ppimagepath, self.image.resolution)
+            self._ShowPage()
 
-            self.scrolledwin.maxWidth = bmp.GetWidth()
+            self._ProposePredictions()
+
+            self._StartPageAnalysis()
+
+    def _StartPageAnalysis(self):
+        '''
+        Start the background precomputations on the newly opened page.
+        '''
+        self.inkindex = None
+        self.components = None
+        builder = InkIndexBuilder(self.page,\
+                sat_cache_path(self.ppimagepath),\
+                lambda index: wx.CallAfter(self._OnInkIndex,\
+                self.curimagepath, index))
+        builder.start()
+        # the page is never labelled in this process, if the components are
+        # not cached they are found in another one
+        builder = ComponentIndexBuilder(self.pagekey, self.page.path,\
+                lambda components: wx.CallAfter(self._OnComponents,\
+                self.curimagepath, components))
+        builder.start()
+
+    def _OnInkIndex(self, imagepath, index):
+        if imagepath != self.curimagepath:
+            # Another image was opened in the meantime
+            return
+        self.inkindex = index
+        if self.scrolledwin.tiles != None and index != None:
+            # zoomed out tiles are computed from its tables from now on
+            self.scrolledwin.tiles.inkindex = index
+        if self.autobarproposals:
+            self.ProposeBars()
+
+    def _OnComponents(self, imagepath, components):
+        if imagepath != self.curimagepath:
+            return
+        self.components = components
+        if components != None:
+            self.GetStatusBar().SetStatusText(\
+                    "Found %d connected components." % len(components))
 
-            self.scrolledwin.maxHeight = bmp.GetHeight()
+    def _ShowPage(self):
+        '''
+        Display the current page. Its pixels are only expanded tile by tile
+        as they come into view.
+        '''
+        # a string to print status to
+        statusstr = "File loaded: %s, resolution %d dpi" % \
+                (self.ppimagepath, self.page.dpi)
 
-            self.scrolledwin.SetVirtualSize((self.scrolledwin.maxWidth,\
-                                            self.scrolledwin.maxHeight))
-            self.scrolledwin.bmp = bmp
+        self.scrolledwin.maxWidth = self.page.width
 
-            self.scrolledwin.Refresh()
+        self.scrolledwin.maxHeight = self.page.height
+
+        self.scrolledwin.SetVirtualSize((self.scrolledwin.maxWidth,\
+                                        self.scrolledwin.maxHeight))
+        self.scrolledwin.tiles = TileCache(self.page)
+
+        self.scrolledwin.Refresh()
+
+    def OnProposeStaves(self, event):
+        '''
+        Find the staves in the background and propose a staff box for each
+        system.
+        '''
+        if self.page == None:
+            self.GetStatusBar().SetStatusText('No image file loaded.')
+            return
+        self.GetStatusBar().SetStatusText('Finding staves...')
+        # the staff finder needs the gamera image, which the proposer loads
+        # from the preprocessed image
+        proposer = StaffProposer(self.ppimagepath,\
+                lambda rects: wx.CallAfter(self._OnStaffProposals,\
+                self.curimagepath, rects))
+        proposer.start()
+
+    def _OnStaffProposals(self, imagepath, rects):
+        if imagepath != self.curimagepath:
+            # Another image was opened in the meantime
+            return
+        if rects == None:
+            self.GetStatusBar().SetStatusText('Could not find the staves.')
+            return
+        self.scrolledwin.SetProposals('STAFF', rects)
+        self.GetStatusBar().SetStatusText(("%d staff boxes proposed, "\
+                + "control-click to accept one, control-right-click to "\
+                + "reject one.") % len(rects))
+
+    def OnSnapToInk(self, event):
+        self.scrolledwin.snaptoink = self.snapmenuitem.IsChecked()
+        if self.scrolledwin.snaptoink and (self.inkindex == None):
+            self.GetStatusBar().SetStatusText('The page is still being '\
+                    + 'analysed, snapping starts when it is done.')
+
+    def _Tighten(self, kinds):
+        counts = [self.scrolledwin.Tighten(kind) for kind in kinds]
+        if None in counts:
+            self.GetStatusBar().SetStatusText('The page is still being '\
+                    + 'analysed, try again in a moment.')
+            return
+        self.GetStatusBar().SetStatusText("Tightened %d boxes." % sum(counts))
+
+    def OnTightenMode(self, event):
+        self._Tighten([self.rectmode])
+
+    def OnTightenAll(self, event):
+        self._Tighten(['STAFF', 'BAR'])
+
+    def OnProposeBars(self, event):
+        self.autobarproposals = self.barpropmenuitem.IsChecked()
+        if self.autobarproposals:
+            self.ProposeBars()
+        else:
+            self.scrolledwin.SetProposals('BAR', [])
+
+    def ProposeBars(self):
+        '''
+        Propose bar boxes between the barlines found in each staff box.
+        '''
+        if self.inkindex == None:
+            self.GetStatusBar().SetStatusText('The page is still being '\
+                    + 'analysed, bars will be proposed when it is done.')
+            return
+        rects = propose_bar_boxes(self.inkindex, self.scrolledwin.staffpanels,\
+                self.scrolledwin.barpanels)
+        self.scrolledwin.SetProposals('BAR', rects)
+        self.GetStatusBar().SetStatusText("%d bar boxes proposed." %\
+                len(rects))
+
+    def _OnEditForProposals(self, delta):
+        # The bar proposals follow the staff boxes
+        if self.autobarproposals and (delta[1] == 'STAFF'):
+            self.ProposeBars()
+
+    def OnAcceptProposals(self, event):
+        count = self.scrolledwin.AcceptProposals(self.rectmode)
+        self.GetStatusBar().SetStatusText("Accepted %d proposals." % count)
+
+    def OnRejectProposals(self, event):
+        count = self.scrolledwin.RejectProposals(self.rectmode)
+        self.GetStatusBar().SetStatusText("Rejected %d proposals." % count)
+
+    def OnSaveSession(self, event):
+        '''
+        Save the boxes, notes and preprocessed image of the current page so it
+        can be reopened without preprocessing or parsing MEI.
+        '''
+        if self.page == None:
+            self.GetStatusBar().SetStatusText('No image file loaded, '\
+                    + 'session not saved.')
+            return
+
+        pppath = preprocessed_path(self.curpicfilename)
+
+        # The preprocessed image only has to be written once per page
+        if not os.path.exists(pppath):
+            with span('session.save_tiff'):
+                shutil.copyfile(self.ppimagepath, pppath)
+
+        session = Session(self.curpicfilename, pppath,\
+                self.page.width, self.page.height, self.page.dpi,\
+                self.scrolledwin.staffpanels, self.scrolledwin.barpanels,\
+                self.textwin.GetText())
+
+        path = session_path(self.curpicfilename)
+        with span('session.save'):
+            save_session(path, session)
+
+        if self.journal != None:
+            self.journal.Discard()
+
+        self.GetStatusBar().SetStatusText("Session saved to: %s" % path)
+
+    def OnOpenSession(self, event):
+        '''
+        Reopen a page saved with OnSaveSession.
+        '''
+        fdlg = wx.FileDialog(self, wildcard="Gtruth sessions (*.gts)|*.gts")
+
+        if fdlg.ShowModal() != wx.ID_OK:
+            return
+
+        try:
+            with span('session.load'):
+                session = load_session(str(fdlg.GetPath()))
+        except (IOError, ValueError) as err:
+            self.GetStatusBar().SetStatusText(\
+                    "Could not open session: %s" % err)
+            return
+
+        if not os.path.exists(session.pppath):
+            self.GetStatusBar().SetStatusText("Preprocessed image %s is "\
+                    % session.pppath + "missing, open the image instead.")
+            return
+
+        # The stored image is already preprocessed
+        try:
+            with span('session.load_image'):
+                self.page = PackedPage(ensure_packed(session.pppath))
+        except (IOError, ValueError) as err:
+            self.GetStatusBar().SetStatusText(\
+                    "Could not open %s: %s" % (session.pppath, err))
+            return
+
+        self.ppimagepath = session.pppath
+
+        self.curpicfilename = session.picpath
+
+        self.curimagepath = session.picpath
+
+        self.pagekey = page_key(session.pppath)
+
+        self.scrolledwin.SetProposals('BAR', [])
+        self.scrolledwin.SetProposals('STAFF', [])
+
+        self.scrolledwin.staffpanels[:] = session.staffpanels
+        self.scrolledwin.barpanels[:] = session.barpanels
+        self.scrolledwin.editlog.Reset()
+        self.scrolledwin.BoxesChanged()
+        self.textwin.SetText(session.notes)
+        self.editdate = datetime.date.fromtimestamp(\
+                os.path.getmtime(str(fdlg.GetPath()))).isoformat()
+
+        self.StartJournal()
+
+        self._ShowPage()
+
+        self._StartPageAnalysis()
+
+        self.GetStatusBar().SetStatusText(\
+                "Session loaded: %d staff boxes, %d bar boxes." %\
+                (len(session.staffpanels), len(session.barpanels)))
 
     def OnSave(self, event):
 
@@ -584,60 +1258,10 @@ class MyFrame(wx.Frame):
             # [staffnumber, topcorner x, topcorner y, bottom corner x, bottom
             # corner y]
 
-            staff_bb = []
-
-            idx = 1 # TODO: Maybe we have to number the staves differently
-            for rect in self.scrolledwin.staffpanels:
-
-                # Find the rectangles this rectangle bounds
-                children = rect.GetRectsInBounds(self.scrolledwin.barpanels)
-
-                # Find rectangle that tightly bounds the rectangles inside of
-                # it.
-
-                try:
-                    brect = get_bounding_rect(children)
-                except ValueError:
-                    print "Tried to get bounding rectangle of empty list."
-                    continue
-
-                # Set its children to the bounded rects
-                
-                brect.SetChildren(children)
-                brect.SetNumber(idx) # Identify the staff with a number, not
-                                     # really important right now
-
-                # We don't use FindChildren because I'm worried some children
-                # might be missing after resizing (this is a stupid worry) but
-                # also due to the order of how this saving is carried out
-
-                # Then save this rect
-
-                xtop, ytop = brect.GetPosition()
-
-                xbot, ybot = brect.GetSize()
-
-                staff_bb.append(brect)
-
-                idx = idx + 1
-
-            # Sort the staves by upper left hand y coordinate and their children
-            # by upper left hand x coordinate so that they may be accurately
-            # numbered
-            staff_bb.sort(key=lambda c: c.pos[1])
-            idx = 1
-            for rect in staff_bb:
-                rect.children.sort(key=lambda c: c.pos[0])
-                # assuming no bars belonging to multiple staves, they may now be
-                # numbered
-                try:
-                    for c in rect.children:
-                        c.SetNumber(idx)
-                        idx = idx + 1
-                except TypeError:
-                    self.GetStatusBar().SetStatusText("Warning: a staff "\
-                            + "contains no bars.")
-                    pass
+            # Group the bars under the staves that enclose them, sort them
+            # in reading order and number them
+            staff_bb = build_staff_hierarchy(self.scrolledwin.staffpanels,\
+                    self.scrolledwin.barpanels)
 
             for b in self.scrolledwin.barpanels:
                 if b.number == -1:
@@ -660,20 +1284,19 @@ class MyFrame(wx.Frame):
             # corner y)
 
             barconverter = gtruth_meicreate.GroundTruthBarlineDataConverter(\
-                    staff_bb, self.scrolledwin.barpanels, True)
-
-            if self.scrolledwin.bmp != None:
+                    staff_bb, self.scrolledwin.barpanels, True,\
+                    date=self.editdate)
 
-                width = self.scrolledwin.bmp.GetWidth()
-
-                height = self.scrolledwin.bmp.GetHeight()
-
-            if self.image == None:
+            if self.page == None:
                 self.GetStatusBar().SetStatusText('No image file loaded, '\
                         + 'saving aborted.')
                 return
             else:
-                dpi = self.image.resolution
+                width = self.page.width
+
+                height = self.page.height
+
+                dpi = self.page.dpi
 
             barconverter.bardata_to_mei(str(self.curpicfilename),\
                     width, height, dpi) # using default dpi
@@ -686,6 +1309,45 @@ class MyFrame(wx.Frame):
             self.GetStatusBar().SetStatusText(("MEI saved to: %s. " +\
                     "Text saved to: %s") % (fdlg.GetPath(), fname))
 
+            if self.store != None:
+                self.store.save_page(Session(self.curpicfilename, '',\
+                        width, height, dpi, self.scrolledwin.staffpanels,\
+                        self.scrolledwin.barpanels, self.textwin.GetText()),\
+                        os.environ.get('USER'))
+
+            if self.journal != None:
+                self.journal.Discard()
+
+    def OnLoadStore(self, event):
+        '''
+        Replace the boxes and notes with those stored for the current page in
+        the corpus store.
+        '''
+        if self.store == None:
+            self.GetStatusBar().SetStatusText("No corpus store, set "\
+                    + "GTRUTH_STORE to use one.")
+            return
+
+        with span('store.load_page'):
+            session = self.store.load_page(self.curpicfilename)
+
+        if session == None:
+            self.GetStatusBar().SetStatusText("Page not in the corpus store.")
+            return
+
+        self.scrolledwin.staffpanels[:] = session.staffpanels
+        self.scrolledwin.barpanels[:] = session.barpanels
+        self.scrolledwin.editlog.Reset()
+        if self.journal != None:
+            # The boxes are the stored ones, so nothing is unsaved
+            self.journal.Discard()
+        self.editdate = export_date(session.updated)
+        self.textwin.SetText(session.notes)
+        self.scrolledwin.BoxesChanged()
+        self.GetStatusBar().SetStatusText(\
+                "Loaded %d staff boxes, %d bar boxes from the store." %\
+                (len(session.staffpanels), len(session.barpanels)))
+
     def OnLoadRects(self, event):
         '''
         Loads rectangles from an mei file.
@@ -698,11 +1360,13 @@ class MyFrame(wx.Frame):
             
             print "File loaded: " + fdlg.GetPath()
 
-            meidoc = XmlImport.documentFromFile(str(fdlg.GetPath()))
+            meidoc = read_mei_document(str(fdlg.GetPath()))
 
             # get all the measure elements
             measures = meidoc.getElementsByName('measure')
 
+            rects = []
+
             # the measures have their coordinates stored in zones
             zones = meidoc.getElementsByName('zone')
 
@@ -728,12 +1392,64 @@ class MyFrame(wx.Frame):
                 # make a new panel
                 # Rect is looking for top (x,y) coordinates and length and
                 # height, so we need to subtract the two corners
-                self.scrolledwin.barpanels.append(\
-                        Rect(ulx, uly, lrx - ulx, lry - uly))
+                rects.append(Rect(ulx, uly, lrx - ulx, lry - uly))
 
-            self.scrolledwin.Refresh()
+            # Recorded as one edit, so loading can be undone and the loaded
+            # boxes are journaled like any other
+            self.scrolledwin.barpanels.extend(rects)
+            self.scrolledwin.editlog.record_add('BAR', rects)
+            self.scrolledwin.BoxesChanged()
 
 
+    def OnLoadPredictions(self, event):
+        '''
+        Load the predicted boxes of a whole corpus from a directory of MEI
+        files, to propose them on every page opened.
+        '''
+        ddlg = wx.DirDialog(self, "Directory of predicted MEI files")
+        if ddlg.ShowModal() == wx.ID_OK:
+            self.LoadPredictions(ddlg.GetPath())
+
+    def LoadPredictions(self, directory, suffix=''):
+        self.predictionsdir = directory
+        self.GetStatusBar().SetStatusText("Loading predictions from %s..." %\
+                directory)
+        loader = PredictionLoader(directory,\
+                lambda predictions: wx.CallAfter(self._OnPredictions,\
+                directory, predictions), suffix=suffix)
+        loader.start()
+
+    def _OnPredictions(self, directory, predictions):
+        if directory != self.predictionsdir:
+            # Other predictions were asked for in the meantime
+            return
+        if predictions == None:
+            self.GetStatusBar().SetStatusText(\
+                    "Could not load the predictions in %s." % directory)
+            return
+        self.predictions = predictions
+        self.GetStatusBar().SetStatusText("Loaded predictions for %d pages."\
+                % len(predictions))
+        if self.page != None and len(self.scrolledwin.proposals['BAR']) == 0\
+                and len(self.scrolledwin.proposals['STAFF']) == 0:
+            self._ProposePredictions()
+
+    def _ProposePredictions(self):
+        '''
+        Propose the predicted boxes of the current page, if there are any.
+        '''
+        if self.predictions == None or self.curimagepath not in\
+                self.predictions:
+            return
+        with span('open.propose_predictions'):
+            for kind in ('STAFF', 'BAR'):
+                self.scrolledwin.SetProposals(kind,\
+                        self.predictions.rects(self.curimagepath, kind))
+        self.GetStatusBar().SetStatusText(("%d staff and %d bar boxes "\
+                + "predicted, accept them with Alt-A in each mode.") %\
+                (len(self.scrolledwin.proposals['STAFF']),\
+                len(self.scrolledwin.proposals['BAR'])))
+
     def OnClearRect(self, event):
         if self.rectmode == 'BAR':
             panels = self.scrolledwin.barpanels
@@ -743,9 +1459,31 @@ class MyFrame(wx.Frame):
             self.GetStatusBar().SetStatusText(\
                     "Unrecognized rectangle mode" + self.parent.rectmode)
             return
+        cleared = list(panels)
         while len(panels) > 0:
             rect = panels.pop()
             del(rect)
+        # Record the whole list as one edit so the clear can be undone in one
+        # step
+        self.scrolledwin.editlog.record_clear(self.rectmode, cleared)
+        self.scrolledwin.Refresh()
+
+    def OnUndo(self, event):
+        delta = self.scrolledwin.editlog.Undo()
+        if delta == None:
+            self.GetStatusBar().SetStatusText("Nothing to undo.")
+            return
+        self.GetStatusBar().SetStatusText("Undid %s of %s box." %\
+                (delta[0], delta[1].lower()))
+        self.scrolledwin.Refresh()
+
+    def OnRedo(self, event):
+        delta = self.scrolledwin.editlog.Redo()
+        if delta == None:
+            self.GetStatusBar().SetStatusText("Nothing to redo.")
+            return
+        self.GetStatusBar().SetStatusText("Redid %s of %s box." %\
+                (delta[0], delta[1].lower()))
         self.scrolledwin.Refresh()
 
 app = MyApp()
@@ -0,0 +1,114 @@
+'''
+Automatic proposals of bar (measure) boxes.
+
+Inside each staff box the vertical projection profile of the ink is taken over
+the rows of the staff lines. Barlines cross every staff line of the system, so
+they show up as narrow runs of columns that are (almost) completely black. The
+gaps between consecutive barlines become the candidate measure boxes.
+
+The profiles come from a precomputed InkIndex (see gtruth_ink), so proposing
+the bars of a page takes milliseconds and can be redone whenever the staff
+boxes change.
+'''
+
+from __future__ import division
+
+import numpy as np
+
+from gtruthrect import Rect
+from gtruth_evaluate import iou_matrix
+from gtruth_profile import span
+
+class BarProposalParams:
+    '''
+    Parameters of the bar proposals.
+    stafflinefill: fraction of a row's width that must be ink for the row to
+    be taken as a staff line.
+    barlinefill: fraction of the staff line rows a column must cover to be
+    part of a barline.
+    maxbarlinewidth: runs of black columns wider than this are not barlines.
+    minbarwidth: measures narrower than this are dropped.
+    '''
+
+    def __init__(self, stafflinefill=0.5, barlinefill=0.9, maxbarlinewidth=12,\
+            minbarwidth=20):
+        self.stafflinefill = stafflinefill
+        self.barlinefill = barlinefill
+        self.maxbarlinewidth = maxbarlinewidth
+        self.minbarwidth = minbarwidth
+
+def runs(mask):
+    '''
+    The (start, end) of each run of True values in a boolean array, end
+    exclusive.
+    '''
+    padded = np.concatenate(([False], mask, [False]))
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    return edges[0::2], edges[1::2]
+
+def find_barlines(inkindex, ulx, uly, lrx, lry, params):
+    '''
+    The x coordinates of the barlines found in a staff box, left to right.
+    '''
+    ulx, uly, lrx, lry = inkindex.clip_box(ulx, uly, lrx, lry)
+    if lrx - ulx < 1 or lry - uly < 1:
+        return np.zeros(0)
+
+    # The barlines are looked for between the top and bottom staff lines only
+    # so that the margins of the box do not count against them
+    rows = inkindex.row_profile(ulx, uly, lrx, lry)
+    stafflines = np.flatnonzero(rows >= params.stafflinefill * (lrx - ulx))
+    if len(stafflines) < 2:
+        return np.zeros(0)
+    top = uly + stafflines[0]
+    bottom = uly + stafflines[-1] + 1
+
+    profile = inkindex.column_profile(ulx, top, lrx, bottom)
+    starts, ends = runs(profile >= params.barlinefill * (bottom - top))
+    narrow = (ends - starts) <= params.maxbarlinewidth
+    return ulx + (starts[narrow] + ends[narrow]) / 2.0
+
+def propose_bars_in_staff(inkindex, staffbox, params):
+    '''
+    The proposed measure boxes (ulx, uly, lrx, lry) inside one staff box. The
+    measures span the staff box vertically and lie between barlines (or the
+    start of the staff and the first barline).
+    '''
+    ulx, uly, lrx, lry = staffbox
+    barlines = find_barlines(inkindex, ulx, uly, lrx, lry, params)
+    if len(barlines) == 0:
+        return []
+    edges = np.concatenate(([ulx], barlines, [lrx]))
+    lefts, rights = edges[:-1], edges[1:]
+    keep = (rights - lefts) >= params.minbarwidth
+    # Whatever follows the last barline is only a measure if the staff goes on
+    # long enough after it, which the width filter takes care of
+    return [(l, uly, r, lry) for l, r in zip(lefts[keep], rights[keep])]
+
+def _overlapping(boxes, existing, threshold=0.5):
+    # Which of boxes overlap one of the existing boxes by more than threshold
+    # of their IoU
+    if len(boxes) == 0 or len(existing) == 0:
+        return np.zeros(len(boxes), dtype=bool)
+    return (iou_matrix(np.asarray(boxes, dtype=np.float64),\
+            np.asarray(existing, dtype=np.float64)) > threshold).any(axis=1)
+
+def propose_bar_boxes(inkindex, staffrects, barrects, params=None):
+    '''
+    Proposed bar Rects for all the staff Rects, leaving out the bars that are
+    already drawn (those that overlap an existing bar Rect).
+    '''
+    if params is None:
+        params = BarProposalParams()
+    boxes = []
+    with span('barprop.propose', count=len(staffrects)):
+        for staff in staffrects:
+            x, y = staff.GetPosition()
+            w, h = staff.GetSize()
+            boxes.extend(propose_bars_in_staff(inkindex, (x, y, x + w, y + h),\
+                    params))
+        existing = [(r.pos[0], r.pos[1], r.pos[0] + r.size[0],\
+                r.pos[1] + r.size[1]) for r in barrects]
+        drawn = _overlapping(boxes, existing)
+    return [Rect(ulx, uly, lrx - ulx, lry - uly)\
+            for (ulx, uly, lrx, lry), skip in zip(boxes, drawn) if not skip]
@@ -0,0 +1,79 @@
+'''
+Benchmarks of the MEI export.
+
+Times the fixed cost every exported document pays (building its meiHead,
+from scratch or cloned from the header template) and the whole export of a
+synthetic page, converting and serializing it, with timeit.
+
+    python gtruth_bench.py [--bars 200] [--staves 20] [--number 1000]
+'''
+
+from __future__ import division
+import os
+import timeit
+import argparse
+import tempfile
+
+import gtruth_meicreate
+from gtruthrect import Rect, build_staff_hierarchy
+
+def synthetic_page(nstaves, nbars):
+    '''
+    Staff and bar Rects of a page with nstaves staves and nbars bars spread
+    evenly across them.
+    '''
+    perstaff = max(1, nbars // max(1, nstaves))
+    staffrects = []
+    barrects = []
+    for s in xrange(nstaves):
+        y = 50 + s * 150
+        staffrects.append(Rect(20, y, 40 + perstaff * 100, 120))
+        for b in xrange(perstaff):
+            barrects.append(Rect(30 + b * 100, y + 10, 95, 100))
+    return staffrects, barrects
+
+def bench(label, function, number, repeat=3):
+    '''
+    Run function number times, repeat times, and print the best time per
+    call.
+    '''
+    best = min(timeit.repeat(function, number=number, repeat=repeat))
+    print("%-40s %10.1f us per call" % (label, best / number * 1e6))
+    return best / number
+
+def run(nstaves, nbars, number):
+    staffrects, barrects = synthetic_page(nstaves, nbars)
+    converter = gtruth_meicreate.GroundTruthBarlineDataConverter(\
+            build_staff_hierarchy(staffrects, barrects), barrects)
+
+    # Per-document header cost
+    built = bench('header built from scratch', converter._build_header,\
+            number)
+    cloned = bench('header cloned from template', converter._create_header,\
+            number)
+    if cloned > 0:
+        print("%-40s %10.1fx" % ('header speedup', built / cloned))
+
+    # Whole documents, conversion and serialization
+    outfile = tempfile.NamedTemporaryFile(suffix='.mei', delete=False)
+    outfile.close()
+    try:
+        def export():
+            converter.bardata_to_mei('page', 5000, 7000, 600)
+            converter.output_mei(outfile.name)
+        pages = max(1, number // 10)
+        bench('export of a %d bar page' % len(barrects), export, pages)
+    finally:
+        os.remove(outfile.name)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(\
+            description='Benchmark the MEI export.')
+    parser.add_argument('--staves', type=int, default=20,\
+            help='number of staves on the synthetic page')
+    parser.add_argument('--bars', type=int, default=200,\
+            help='number of bars on the synthetic page')
+    parser.add_argument('--number', type=int, default=1000,\
+            help='number of calls timed for the header benchmarks')
+    args = parser.parse_args()
+    run(args.staves, args.bars, args.number)
@@ -0,0 +1,63 @@
+'''
+Per-page cache of results that are expensive to compute from an image (staff
+proposals, preprocessed images, ...).
+
+Entries are named by a key derived from the image file (its path, size and
+modification time) and any parameters the result depends on, so changing the
+image or the parameters simply misses the cache. The cache lives in the
+directory named by the GTRUTH_CACHE environment variable, or ~/.gtruth/cache.
+'''
+
+import os
+import json
+import hashlib
+
+def cache_dir():
+    return os.environ.get('GTRUTH_CACHE',\
+            os.path.join(os.path.expanduser('~'), '.gtruth', 'cache'))
+
+def page_key(imagepath, *params):
+    '''
+    The cache key of the image at imagepath for a result computed with params.
+    '''
+    imagepath = os.path.abspath(imagepath)
+    stat = os.stat(imagepath)
+    text = '|'.join([imagepath, str(stat.st_size), repr(stat.st_mtime)] +\
+            [repr(p) for p in params])
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:24]
+
+def cache_path(key, suffix):
+    '''
+    The path of the cache entry key with the given suffix (e.g. '.staves.json').
+    The cache directory is created if needed.
+    '''
+    directory = cache_dir()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return os.path.join(directory, key + suffix)
+
+def atomic_write(path, data, mode='wb'):
+    '''
+    Write data to a temporary file next to path and rename it over path so a
+    partially written entry is never seen.
+    '''
+    temppath = '%s.%d.tmp' % (path, os.getpid())
+    with open(temppath, mode) as fileobj:
+        fileobj.write(data)
+    os.rename(temppath, path)
+
+def load_json(key, suffix):
+    '''
+    The cached JSON entry, or None if there is none.
+    '''
+    path = cache_path(key, suffix)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as fileobj:
+            return json.load(fileobj)
+    except ValueError:
+        return None
+
+def save_json(key, suffix, obj):
+    atomic_write(cache_path(key, suffix), json.dumps(obj), 'w')
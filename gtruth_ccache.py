@@ -0,0 +1,239 @@
+'''
+Cache of the connected components of a preprocessed page.
+
+The bounding boxes of the connected components (8-connected ink regions) of
+the page are kept in arrays, with a uniform grid over the page as a spatial
+index, so the components in a region or near a point are found without
+touching the other components. Labelling a full scan is expensive, so the
+index is saved in the page cache next to the preprocessed image (the batch
+preprocessing in gtruth_preprocess builds it ahead of time) and opening the
+page again just loads the arrays. When the GUI finds no cached index it has
+it built by running this module in a separate process, so the unpacked page
+and its labels never take up the GUI's memory:
+
+    python gtruth_ccache.py page.pbits cachekey
+
+The components are labelled with SciPy when it is installed and with gamera's
+cc_analysis otherwise.
+'''
+
+from __future__ import division
+import os
+import sys
+import argparse
+import threading
+import subprocess
+
+import numpy as np
+
+try:
+    from scipy import ndimage
+except ImportError:
+    ndimage = None
+
+from gtruth_cache import cache_path
+from gtruth_packed import PackedPage
+from gtruth_profile import span
+
+# Suffix of the cached components, next to the preprocessed image
+COMPONENTS_SUFFIX = '.cc.npz'
+
+# Size in pixels of the cells of the spatial index
+GRID_CELL = 128
+
+class ComponentIndex:
+    '''
+    The bounding boxes of a page's connected components.
+    boxes is an (n, 4) int32 array of (ulx, uly, lrx, lry), lrx and lry
+    exclusive, and areas the number of ink pixels of each component.
+    '''
+
+    def __init__(self, boxes, areas, cell=GRID_CELL):
+        self.boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+        self.areas = np.asarray(areas, dtype=np.int64)
+        self.cell = cell
+        self._build_grid()
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def _cell_ranges(self, boxes):
+        c = self.cell
+        return (boxes[:, 0] // c, boxes[:, 1] // c,\
+                np.maximum(boxes[:, 2] - 1, boxes[:, 0]) // c,\
+                np.maximum(boxes[:, 3] - 1, boxes[:, 1]) // c)
+
+    def _build_grid(self):
+        # Every component is listed in each cell it overlaps. The lists of all
+        # cells are stored back to back in cellitems, cell k's list starting
+        # at cellstarts[k].
+        if len(self.boxes) == 0:
+            self.gridwidth = self.gridheight = 1
+            self.cellstarts = np.zeros(2, dtype=np.int64)
+            self.cellitems = np.zeros(0, dtype=np.int64)
+            return
+        cx0, cy0, cx1, cy1 = self._cell_ranges(self.boxes)
+        self.gridwidth = int(cx1.max()) + 1
+        self.gridheight = int(cy1.max()) + 1
+        nx = cx1 - cx0 + 1
+        ny = cy1 - cy0 + 1
+        counts = nx * ny
+        items = np.repeat(np.arange(len(self.boxes)), counts)
+        # position of each entry within its component's block of cells
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts)\
+                - counts, counts)
+        cellx = np.repeat(cx0, counts) + offsets % np.repeat(nx, counts)
+        celly = np.repeat(cy0, counts) + offsets // np.repeat(nx, counts)
+        cells = celly * self.gridwidth + cellx
+        order = np.argsort(cells, kind='mergesort')
+        self.cellitems = items[order]
+        self.cellstarts = np.searchsorted(cells[order],\
+                np.arange(self.gridwidth * self.gridheight + 1))
+
+    def _candidates(self, ulx, uly, lrx, lry):
+        # The components listed in the cells the region overlaps
+        c = self.cell
+        cx0 = max(int(ulx) // c, 0)
+        cy0 = max(int(uly) // c, 0)
+        cx1 = min(int(max(lrx - 1, ulx)) // c, self.gridwidth - 1)
+        cy1 = min(int(max(lry - 1, uly)) // c, self.gridheight - 1)
+        if cx1 < cx0 or cy1 < cy0:
+            return np.zeros(0, dtype=np.int64)
+        chunks = []
+        for cy in xrange(cy0, cy1 + 1):
+            start = self.cellstarts[cy * self.gridwidth + cx0]
+            end = self.cellstarts[cy * self.gridwidth + cx1 + 1]
+            chunks.append(self.cellitems[start:end])
+        return np.unique(np.concatenate(chunks))
+
+    def components_in_rect(self, ulx, uly, lrx, lry, inside=False):
+        '''
+        Indices of the components overlapping the region, or lying entirely
+        inside it if inside is True.
+        '''
+        candidates = self._candidates(ulx, uly, lrx, lry)
+        b = self.boxes[candidates]
+        if inside:
+            keep = (b[:, 0] >= ulx) & (b[:, 1] >= uly) &\
+                    (b[:, 2] <= lrx) & (b[:, 3] <= lry)
+        else:
+            keep = (b[:, 0] < lrx) & (b[:, 1] < lry) &\
+                    (b[:, 2] > ulx) & (b[:, 3] > uly)
+        return candidates[keep]
+
+    def components_near_point(self, x, y, radius):
+        '''
+        Indices of the components whose bounding box is within radius of the
+        point, nearest first.
+        '''
+        candidates = self.components_in_rect(x - radius, y - radius,\
+                x + radius + 1, y + radius + 1)
+        b = self.boxes[candidates]
+        dx = np.maximum(np.maximum(b[:, 0] - x, x - (b[:, 2] - 1)), 0)
+        dy = np.maximum(np.maximum(b[:, 1] - y, y - (b[:, 3] - 1)), 0)
+        distance = np.hypot(dx, dy)
+        keep = distance <= radius
+        order = np.argsort(distance[keep], kind='mergesort')
+        return candidates[keep][order]
+
+    def save(self, path):
+        temppath = '%s.%d.tmp.npz' % (path[:-len('.npz')], os.getpid())
+        np.savez(temppath, boxes=self.boxes, areas=self.areas)
+        os.rename(temppath, path)
+
+    @staticmethod
+    def load(path):
+        data = np.load(path)
+        return ComponentIndex(data['boxes'], data['areas'])
+
+def label_components(ink, image=None):
+    '''
+    Find the connected components of a boolean ink array, or of the onebit
+    gamera image when SciPy is not installed. Returns (boxes, areas).
+    '''
+    if ndimage is not None and ink is not None:
+        labels, count = ndimage.label(ink, structure=np.ones((3, 3)))
+        slices = ndimage.find_objects(labels)
+        boxes = np.array([(s[1].start, s[0].start, s[1].stop, s[0].stop)\
+                for s in slices], dtype=np.int32).reshape(-1, 4)
+        areas = np.bincount(labels.ravel(), minlength=count + 1)[1:]
+        return boxes, areas
+    if image is None:
+        raise ImportError("Labelling the ink array needs SciPy")
+    # cc_analysis labels the pixels of the image it runs on, so run it on a
+    # copy to leave the page alone
+    ccs = image.image_copy().cc_analysis()
+    boxes = np.array([(cc.ul_x, cc.ul_y, cc.lr_x + 1, cc.lr_y + 1)\
+            for cc in ccs], dtype=np.int32).reshape(-1, 4)
+    areas = np.array([cc.black_area()[0] for cc in ccs], dtype=np.int64)
+    return boxes, areas
+
+def load_or_build_components(key, getink, image=None):
+    '''
+    The ComponentIndex of the page whose preprocessed image has the cache
+    key, loaded from the cache or built and saved to it. getink returns the
+    boolean ink array of the page (or None to label the image instead); it is
+    only called if the components are not cached.
+    '''
+    path = cache_path(key, COMPONENTS_SUFFIX)
+    if os.path.exists(path):
+        with span('ccache.load'):
+            return ComponentIndex.load(path)
+    with span('ccache.label'):
+        boxes, areas = label_components(getink(), image)
+    index = ComponentIndex(boxes, areas)
+    index.save(path)
+    return index
+
+def build_components_process(key, packedpath):
+    '''
+    The ComponentIndex of the packed page at packedpath whose preprocessed
+    image has the cache key, loaded from the cache or, if it is not there,
+    labelled by a separate Python process that saves it to the cache.
+    '''
+    path = cache_path(key, COMPONENTS_SUFFIX)
+    if not os.path.exists(path):
+        script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+        with span('ccache.label_process'):
+            subprocess.check_call([sys.executable, script, packedpath, key])
+    with span('ccache.load'):
+        return ComponentIndex.load(path)
+
+class ComponentIndexBuilder(threading.Thread):
+    '''
+    Loads the ComponentIndex of the packed page at packedpath in the
+    background, having it built in a separate process if it is not cached,
+    and calls callback with it when done (or with None if it failed).
+    '''
+
+    def __init__(self, key, packedpath, callback):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.key = key
+        self.packedpath = packedpath
+        self.callback = callback
+        # the exception raised if the index could not be built
+        self.error = None
+
+    def run(self):
+        try:
+            index = build_components_process(self.key, self.packedpath)
+        except Exception as err:
+            self.error = err
+            self.callback(None)
+            return
+        self.callback(index)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(\
+            description='Find the connected components of a packed page '\
+            + 'and save them to the page cache.')
+    parser.add_argument('packed', help='packed page file (.pbits)')
+    parser.add_argument('key', help='cache key of the preprocessed image')
+    args = parser.parse_args()
+
+    page = PackedPage(args.packed)
+    try:
+        load_or_build_components(args.key, page.ink)
+    finally:
+        page.close()
@@ -0,0 +1,264 @@
+'''
+Columnar tables of the boxes of a page or a whole corpus, for training and
+analysis without reparsing MEI.
+
+A box table is a dict of NumPy columns, one row per box:
+
+    page            int32, the row of the box's page in the page columns
+    kind            uint8, KIND_STAFF or KIND_BAR
+    number          int32, the staff or bar number
+    ulx uly lrx lry int32, lrx and lry exclusive as in the MEI zones
+
+and one row per page:
+
+    page_name       bytes, the MEI file name without its suffix
+    page_width page_height page_dpi
+                    int32
+
+Tables are written as uncompressed .npz files, which load_box_table memory
+maps: every column is a view straight into the file, so a whole corpus is
+read with one mapping and no parsing or copying. With pyarrow, tables can
+also be written to and read from Parquet (the page columns are kept in the
+file's metadata, and page_name is repeated per box for other tools).
+
+    python gtruth_columns.py boxes.npz pages/*.mei
+    python gtruth_columns.py boxes.parquet --store corpus.db
+'''
+
+import os
+import sys
+import json
+import mmap
+import struct
+import zipfile
+import argparse
+import multiprocessing
+
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+import gtruth_meicreate
+from gtruthrect import build_staff_hierarchy
+from gtruth_meiload import read_mei_pages, mei_page_name
+from gtruth_store import AnnotationStore, export_names
+
+KIND_STAFF = 0
+KIND_BAR = 1
+
+# The names of the kinds, by value
+KINDS = ('staff', 'bar')
+
+BOX_COLUMNS = ('page', 'kind', 'number', 'ulx', 'uly', 'lrx', 'lry')
+PAGE_COLUMNS = ('page_name', 'page_width', 'page_height', 'page_dpi')
+
+# The key of the page columns in the metadata of Parquet files
+PARQUET_PAGES_KEY = 'gtruth_pages'
+
+# The local file header of a zip member: signature, versions, flags,
+# compression, times, crc, sizes, then the lengths of its name and extra field
+ZIP_LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+
+def _encode(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf-8')
+
+def box_table(pages):
+    '''
+    The box table of pages, a list of (name, MeiPage) (see gtruth_meiload).
+    '''
+    rows = []
+    for index, (name, page) in enumerate(pages):
+        for kind, boxes in ((KIND_STAFF, page.staves), (KIND_BAR, page.bars)):
+            rows.extend([(index, kind) + tuple(box) for box in boxes])
+    array = np.array(rows, dtype=np.int64).reshape(len(rows),\
+            len(BOX_COLUMNS))
+    table = {}
+    for i, column in enumerate(BOX_COLUMNS):
+        table[column] = array[:, i].astype(np.uint8 if column == 'kind'\
+                else np.int32)
+    table['page_name'] = np.array([_encode(name) for name, _ in pages],\
+            dtype=np.bytes_)
+    for column, attribute in (('page_width', 'width'),\
+            ('page_height', 'height'), ('page_dpi', 'dpi')):
+        table[column] = np.array([getattr(page, attribute)\
+                for _, page in pages], dtype=np.int32)
+    return table
+
+def session_to_page(session):
+    '''
+    The MeiPage of a stored page, holding the boxes its MEI export would.
+    '''
+    staff_bb = build_staff_hierarchy(session.staffpanels, session.barpanels)
+    converter = gtruth_meicreate.GroundTruthBarlineDataConverter(staff_bb,\
+            session.barpanels)
+    return converter.bardata_to_page(session.picpath, session.width,\
+            session.height, session.dpi)
+
+def write_box_table(path, table):
+    '''
+    Write a box table as .npz, or as Parquet if path ends in .parquet.
+    '''
+    temppath = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        if path.endswith('.parquet'):
+            _write_parquet(temppath, table)
+        else:
+            # Stored uncompressed, so the columns can be memory mapped
+            with open(temppath, 'wb') as fileobj:
+                np.savez(fileobj, **table)
+    except:
+        if os.path.exists(temppath):
+            os.remove(temppath)
+        raise
+    os.rename(temppath, path)
+
+def load_box_table(path):
+    '''
+    Read a box table written by write_box_table. The columns of an .npz are
+    read-only views into a memory mapping of the file.
+    '''
+    if path.endswith('.parquet'):
+        return _read_parquet(path)
+    return _map_npz(path)
+
+def _map_npz(path):
+    with open(path, 'rb') as fileobj:
+        members = zipfile.ZipFile(fileobj).infolist()
+        if len([m for m in members if m.compress_type != zipfile.ZIP_STORED\
+                or not m.filename.endswith('.npy')]) > 0:
+            # Compressed by some other writer, so read it normally
+            archive = np.load(path)
+            return dict([(name, archive[name]) for name in archive.files])
+        headers = []
+        for member in members:
+            fileobj.seek(member.header_offset)
+            fields = ZIP_LOCAL_HEADER.unpack(\
+                    fileobj.read(ZIP_LOCAL_HEADER.size))
+            fileobj.seek(member.header_offset + ZIP_LOCAL_HEADER.size +\
+                    fields[-2] + fields[-1])
+            version = np.lib.format.read_magic(fileobj)
+            if version == (1, 0):
+                header = np.lib.format.read_array_header_1_0(fileobj)
+            else:
+                header = np.lib.format.read_array_header_2_0(fileobj)
+            headers.append((member.filename[:-len('.npy')], header,\
+                    fileobj.tell()))
+        buf = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+    table = {}
+    for name, (shape, fortran, dtype), offset in headers:
+        count = int(np.prod(shape))
+        if count == 0:
+            table[name] = np.empty(shape, dtype)
+            continue
+        table[name] = np.frombuffer(buf, dtype=dtype, count=count,\
+                offset=offset).reshape(shape, order='F' if fortran else 'C')
+    return table
+
+def _write_parquet(path, table):
+    if pyarrow is None:
+        raise ImportError("Parquet files need the pyarrow module")
+    names = [_encode(name).decode('utf-8') for name in table['page_name']]
+    columns = [table[column] for column in BOX_COLUMNS]
+    columns.append(np.array([names[p] for p in table['page']], dtype=object))
+    arrow = pyarrow.Table.from_arrays([pyarrow.array(c) for c in columns],\
+            list(BOX_COLUMNS) + ['page_name'])
+    pages = dict([(column, table[column].tolist())\
+            for column in PAGE_COLUMNS if column != 'page_name'])
+    pages['page_name'] = names
+    arrow = arrow.replace_schema_metadata({PARQUET_PAGES_KEY:\
+            json.dumps(pages)})
+    pyarrow.parquet.write_table(arrow, path)
+
+def _read_parquet(path):
+    if pyarrow is None:
+        raise ImportError("Parquet files need the pyarrow module")
+    arrow = pyarrow.parquet.read_table(path, columns=list(BOX_COLUMNS),\
+            memory_map=True)
+    metadata = pyarrow.parquet.read_schema(path).metadata or {}
+    pages = json.loads(metadata[_encode(PARQUET_PAGES_KEY)])
+    table = {}
+    for column in BOX_COLUMNS:
+        chunks = [chunk.to_numpy() for chunk in arrow.column(column).chunks]
+        table[column] = np.concatenate(chunks) if len(chunks) > 0 else\
+                np.empty(0, np.uint8 if column == 'kind' else np.int32)
+    table['page_name'] = np.array([_encode(name)\
+            for name in pages['page_name']], dtype=np.bytes_)
+    for column in PAGE_COLUMNS[1:]:
+        table[column] = np.array(pages[column], dtype=np.int32)
+    return table
+
+def _read_named_pages(path):
+    # Run in the worker processes. The pages of a file holding several are
+    # named after their images.
+    pages = read_mei_pages(path)
+    if len(pages) == 1:
+        return [(mei_page_name(path), pages[0])]
+    return [(os.path.basename(page.picpath), page) for page in pages]
+
+def mei_box_table(paths, processes=None):
+    '''
+    The box table of the MEI files at paths, parsed in a pool of processes.
+    Files holding several pages give a row for each.
+    '''
+    pool = multiprocessing.Pool(processes)
+    try:
+        pages = [page for named in pool.map(_read_named_pages, paths,\
+                chunksize=16) for page in named]
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return box_table(pages)
+
+def store_box_table(store):
+    '''
+    The box table of every page in a corpus store (see gtruth_store), named
+    as the store exports them.
+    '''
+    picpaths = store.pages()
+    names = export_names(picpaths)
+    return box_table([(names[picpath],\
+            session_to_page(store.load_page(picpath)))\
+            for picpath in picpaths])
+
+def _mei_paths(paths):
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found.extend(sorted([os.path.join(path, name)\
+                    for name in os.listdir(path)\
+                    if mei_page_name(name) is not None]))
+        else:
+            found.append(path)
+    return found
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(\
+            description='Export the boxes of MEI files or a corpus store '\
+            + 'as a columnar table.')
+    parser.add_argument('output', help='.npz or .parquet file to write')
+    parser.add_argument('paths', nargs='*',\
+            help='MEI files, or directories of them')
+    parser.add_argument('--store', default=None,\
+            help='export the pages of this corpus store instead')
+    parser.add_argument('--processes', type=int, default=None,\
+            help='number of worker processes (default: all cores)')
+    args = parser.parse_args()
+
+    if args.store is not None:
+        store = AnnotationStore(args.store)
+        table = store_box_table(store)
+        store.close()
+    else:
+        table = mei_box_table(_mei_paths(args.paths), args.processes)
+    write_box_table(args.output, table)
+    sys.stderr.write("Wrote %d boxes of %d pages to %s.\n" %\
+            (len(table['page']), len(table['page_name']), args.output))
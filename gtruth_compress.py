@@ -0,0 +1,86 @@
+'''
+Compressed MEI files.
+
+The boxes of a dense page make very repetitive XML, which compresses to a
+small fraction of its size. Files ending in .gz are gzip compressed and files
+ending in .zst zstd compressed (which needs the zstandard module); the MEI
+writers and loaders pick the compression from the file name, so compressed
+files are used just like plain ones.
+
+Compression and decompression stream from file to file a chunk at a time, so
+a large document is never held in memory a second time to compress it, and
+reading a compressed document takes no more memory than parsing a plain one.
+'''
+
+import gzip
+import shutil
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# The compression of a file, by extension
+EXTENSIONS = {'.gz': 'gzip', '.zst': 'zstd'}
+
+# Bytes copied at a time
+CHUNK_SIZE = 1 << 20
+
+def compression_of(path):
+    '''
+    The compression of the file at path ('gzip', 'zstd' or None), from its
+    extension.
+    '''
+    for extension, compression in EXTENSIONS.items():
+        if path.endswith(extension):
+            return compression
+    return None
+
+def extension_of(compression):
+    for extension, name in EXTENSIONS.items():
+        if name == compression:
+            return extension
+    return ''
+
+def _check(compression):
+    if compression not in EXTENSIONS.values():
+        raise ValueError("Unknown compression %r" % compression)
+    if compression == 'zstd' and zstandard is None:
+        raise ImportError("zstd compression needs the zstandard module")
+
+def compress_file(srcpath, dstpath, compression, level=None):
+    '''
+    Compress the file at srcpath into dstpath.
+    '''
+    _check(compression)
+    with open(srcpath, 'rb') as src:
+        with open(dstpath, 'wb') as dst:
+            if compression == 'gzip':
+                # no file name or time stamp in the header, so the same
+                # document always compresses to the same bytes
+                gz = gzip.GzipFile('', 'wb', level or 6, dst, mtime=0)
+                shutil.copyfileobj(src, gz, CHUNK_SIZE)
+                gz.close()
+            else:
+                compressor = zstandard.ZstdCompressor(level=level or 3)
+                compressor.copy_stream(src, dst, read_size=CHUNK_SIZE,\
+                        write_size=CHUNK_SIZE)
+
+def decompress_file(srcpath, dstpath):
+    '''
+    Decompress the file at srcpath into dstpath, a chunk at a time. The
+    compression is taken from the name of srcpath.
+    '''
+    compression = compression_of(srcpath)
+    _check(compression)
+    with open(dstpath, 'wb') as dst:
+        if compression == 'gzip':
+            gz = gzip.open(srcpath, 'rb')
+            try:
+                shutil.copyfileobj(gz, dst, CHUNK_SIZE)
+            finally:
+                gz.close()
+        else:
+            with open(srcpath, 'rb') as src:
+                zstandard.ZstdDecompressor().copy_stream(src, dst,\
+                        read_size=CHUNK_SIZE, write_size=CHUNK_SIZE)
@@ -0,0 +1,220 @@
+'''
+Scoring a whole corpus of barline finder output against the ground truth.
+
+Ground truth and prediction MEI files are paired by file name, scored in a
+pool of processes with gtruth_evaluate and the result of every page is
+appended to a JSONL file as soon as it is ready. Running again with the same
+output file skips the pages already in it, so an interrupted run resumes
+where it stopped. At the end the micro (pooled counts) and macro (mean over
+pages) scores and the worst pages are reported.
+
+    python gtruth_evalrun.py groundtruthdir predictiondir results.jsonl
+'''
+
+from __future__ import division
+import os
+import sys
+import json
+import glob
+import argparse
+import multiprocessing
+
+from gtruth_evaluate import evaluate_files, evaluate_boxes, scores,\
+        DEFAULT_THRESHOLDS
+from gtruth_meiload import read_mei_page, mei_page_name, MEI_SUFFIXES
+
+def threshold_key(threshold):
+    '''
+    Thresholds are stored as strings in the JSON records, e.g. '0.5'.
+    '''
+    return '%g' % threshold
+
+def find_pairs(gtdir, preddir, predsuffix=''):
+    '''
+    Pair every .mei file in gtdir with the file of the same name in preddir
+    (with predsuffix inserted before the extension, if given). Either may be
+    compressed (.mei.gz or .mei.zst). Returns a list of (page, gtpath,
+    predpath), with predpath None for pages the barline finder has no output
+    for.
+    '''
+    pairs = []
+    for gtpath in sorted(glob.glob(os.path.join(gtdir, '*.mei*'))):
+        page = mei_page_name(gtpath)
+        if page is None:
+            continue
+        predpath = None
+        for suffix in MEI_SUFFIXES:
+            path = os.path.join(preddir, page + predsuffix + suffix)
+            if os.path.exists(path):
+                predpath = path
+                break
+        pairs.append((page, gtpath, predpath))
+    return pairs
+
+def read_results(path):
+    '''
+    Read the records of a previous run. Lines that are not whole records,
+    such as the truncated last line left by an interrupted run, are skipped.
+    '''
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path) as fileobj:
+        for line in fileobj:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+def rewrite_results(path, records):
+    '''
+    Replace the file at path with records, one per line, dropping whatever
+    broken lines it had so that new records can be appended to it.
+    '''
+    temppath = '%s.%d.tmp' % (path, os.getpid())
+    with open(temppath, 'w') as fileobj:
+        for record in records:
+            fileobj.write(json.dumps(record, sort_keys=True) + '\n')
+    os.rename(temppath, path)
+
+def score_page(job):
+    '''
+    Score one page, run in the worker processes. Errors are reported in the
+    record rather than raised so one bad file does not stop the run.
+    '''
+    page, gtpath, predpath, thresholds = job
+    record = {'page': page, 'groundtruth': gtpath, 'prediction': predpath}
+    try:
+        if predpath is None:
+            # Every ground truth box of a page the barline finder has no
+            # output for is missed
+            result = evaluate_boxes(read_mei_page(gtpath).bars, [],\
+                    thresholds)
+            record['missing_prediction'] = True
+        else:
+            result = evaluate_files(gtpath, predpath, thresholds)
+    except Exception as err:
+        record['error'] = '%s: %s' % (type(err).__name__, err)
+        return record
+    record['ground_truth'] = result['ground_truth']
+    record['predicted'] = result['predicted']
+    record['scores'] = dict([(threshold_key(t), result[t])\
+            for t in thresholds])
+    return record
+
+def run(pairs, outpath, thresholds=DEFAULT_THRESHOLDS, processes=None):
+    '''
+    Score the pages in pairs that are not already scored in the file at
+    outpath, appending their records to it. Pages recorded with an error are
+    scored again. Returns all the records, old and new.
+    '''
+    records = [r for r in read_results(outpath) if 'error' not in r]
+    done = set([r['page'] for r in records])
+    jobs = [(page, gtpath, predpath, tuple(thresholds))\
+            for page, gtpath, predpath in pairs if page not in done]
+    if len(done) > 0:
+        sys.stderr.write("Resuming: %d pages already scored, %d to go.\n" %\
+                (len(done), len(jobs)))
+    if len(jobs) == 0:
+        return records
+    if os.path.exists(outpath):
+        # Appending right after a truncated line would glue the next record
+        # onto it, and the errors being retried must not be counted twice
+        rewrite_results(outpath, records)
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        with open(outpath, 'a') as outfile:
+            for i, record in enumerate(pool.imap_unordered(score_page, jobs)):
+                outfile.write(json.dumps(record, sort_keys=True) + '\n')
+                outfile.flush()
+                records.append(record)
+                if (i + 1) % 100 == 0:
+                    sys.stderr.write("Scored %d of %d pages.\n" %\
+                            (i + 1, len(jobs)))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return records
+
+def aggregate(records, thresholds=DEFAULT_THRESHOLDS, worst=10):
+    '''
+    Micro and macro scores for each threshold, the pages that failed and the
+    worst pages by F1 at the first threshold. Pages without a prediction are
+    scored, all their ground truth boxes missed.
+    '''
+    scored = [r for r in records if 'error' not in r]
+    report = {'pages': len(records), 'scored': len(scored),\
+            'missing': len([r for r in scored\
+            if r.get('missing_prediction')]),\
+            'errors': [(r['page'], r['error']) for r in records\
+            if 'error' in r], 'thresholds': {}}
+    for t in thresholds:
+        key = threshold_key(t)
+        pagescores = [r['scores'][key] for r in scored]
+        tp = sum([s['tp'] for s in pagescores])
+        ngt = sum([r['ground_truth'] for r in scored])
+        npred = sum([r['predicted'] for r in scored])
+        micro = scores(tp, ngt, npred)
+        del micro['mean_iou']
+        n = len(pagescores)
+        macro = dict([(name, sum([s[name] for s in pagescores]) / n\
+                if n > 0 else 0.0) for name in ('precision', 'recall', 'f1')])
+        report['thresholds'][key] = {'micro': micro, 'macro': macro}
+    if len(thresholds) > 0:
+        key = threshold_key(thresholds[0])
+        ranked = sorted(scored, key=lambda r: r['scores'][key]['f1'])
+        report['worst'] = [(r['page'], r['scores'][key]['f1'])\
+                for r in ranked[:worst]]
+    return report
+
+def format_report(report):
+    lines = ["pages: %d, scored: %d (%d without a prediction), errors: %d"\
+            % (report['pages'], report['scored'], report.get('missing', 0),\
+            len(report['errors'])),\
+            "%8s %10s %10s %10s %10s %10s %10s" % ('IoU', 'micro P',\
+            'micro R', 'micro F1', 'macro P', 'macro R', 'macro F1')]
+    for key in sorted(report['thresholds'], key=float):
+        micro = report['thresholds'][key]['micro']
+        macro = report['thresholds'][key]['macro']
+        lines.append("%8s %10.4f %10.4f %10.4f %10.4f %10.4f %10.4f" %\
+                (key, micro['precision'], micro['recall'], micro['f1'],\
+                macro['precision'], macro['recall'], macro['f1']))
+    if len(report.get('worst', [])) > 0:
+        lines.append("worst pages:")
+        for page, f1 in report['worst']:
+            lines.append("    %-40s f1 %.4f" % (page, f1))
+    for page, error in report['errors']:
+        lines.append("error on %s: %s" % (page, error))
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(\
+            description='Score a corpus of barline finder output.')
+    parser.add_argument('groundtruthdir', help='directory of ground truth MEI')
+    parser.add_argument('predictiondir', help='directory of predicted MEI')
+    parser.add_argument('output', help='JSONL file of per-page results, '\
+            + 'a run is resumed if it exists')
+    parser.add_argument('--suffix', default='',\
+            help='suffix of the prediction file names before .mei')
+    parser.add_argument('--thresholds', type=float, nargs='+',\
+            default=list(DEFAULT_THRESHOLDS), help='IoU thresholds')
+    parser.add_argument('--processes', type=int, default=None,\
+            help='number of worker processes (default: all cores)')
+    parser.add_argument('--worst', type=int, default=10,\
+            help='number of worst pages to list')
+    parser.add_argument('--report', default=None,\
+            help='also write the aggregate report to this JSON file')
+    args = parser.parse_args()
+
+    pairs = find_pairs(args.groundtruthdir, args.predictiondir, args.suffix)
+    records = run(pairs, args.output, args.thresholds, args.processes)
+    report = aggregate(records, args.thresholds, args.worst)
+    if args.report is not None:
+        with open(args.report, 'w') as fileobj:
+            json.dump(report, fileobj, indent=2, sort_keys=True)
+    print(format_report(report))
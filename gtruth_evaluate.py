@@ -0,0 +1,225 @@
+'''
+Scoring barline finder output against the ground truth.
+
+The measure zones of a ground truth MEI file and a predicted MEI file are
+loaded as arrays of (ulx, uly, lrx, lry) and their intersection over union is
+computed with NumPy. Only pairs of boxes that can overlap are ever compared:
+the boxes are sorted vertically and each block of ground truth boxes is
+compared against the window of predictions whose rows it can reach, so pages
+with tens of thousands of measures are scored in a fraction of a second.
+
+Boxes are matched one-to-one so that the total IoU is maximal (with SciPy's
+linear_sum_assignment on each connected group of overlapping boxes, or
+greedily when SciPy is not installed) and precision, recall and F1 are
+reported for each IoU threshold.
+
+    python gtruth_evaluate.py groundtruth.mei prediction.mei
+'''
+
+from __future__ import division
+import argparse
+
+import numpy as np
+
+try:
+    from scipy.optimize import linear_sum_assignment
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+except ImportError:
+    linear_sum_assignment = None
+
+from gtruth_meiload import read_mei_page
+from gtruth_profile import span
+
+# The IoU thresholds results are reported at by default
+DEFAULT_THRESHOLDS = (0.5, 0.75, 0.9)
+
+# Number of ground truth boxes compared at once
+BLOCK_SIZE = 512
+
+def boxes_to_array(boxes):
+    '''
+    Make an (n, 4) float array of (ulx, uly, lrx, lry) from a sequence of
+    boxes. Boxes given as (number, ulx, uly, lrx, lry), as returned by
+    gtruth_meiload, have their number dropped.
+    '''
+    boxes = np.asarray(boxes, dtype=np.float64)
+    if boxes.size == 0:
+        return np.zeros((0, 4))
+    if boxes.shape[1] == 5:
+        boxes = boxes[:, 1:]
+    return boxes
+
+def iou_matrix(gt, pred):
+    '''
+    The dense matrix of IoUs between every box in gt and every box in pred.
+    '''
+    ulx = np.maximum(gt[:, 0, np.newaxis], pred[np.newaxis, :, 0])
+    uly = np.maximum(gt[:, 1, np.newaxis], pred[np.newaxis, :, 1])
+    lrx = np.minimum(gt[:, 2, np.newaxis], pred[np.newaxis, :, 2])
+    lry = np.minimum(gt[:, 3, np.newaxis], pred[np.newaxis, :, 3])
+    inter = np.clip(lrx - ulx, 0, None) * np.clip(lry - uly, 0, None)
+    gtarea = (gt[:, 2] - gt[:, 0]) * (gt[:, 3] - gt[:, 1])
+    predarea = (pred[:, 2] - pred[:, 0]) * (pred[:, 3] - pred[:, 1])
+    union = gtarea[:, np.newaxis] + predarea[np.newaxis, :] - inter
+    return np.where(union > 0, inter / np.where(union > 0, union, 1), 0.0)
+
+def overlapping_pairs(gt, pred, blocksize=BLOCK_SIZE):
+    '''
+    Find every pair of overlapping boxes. Returns the arrays (gtindex,
+    predindex, iou) of the pairs with a non-zero IoU.
+    '''
+    empty = (np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp),\
+            np.zeros(0))
+    if len(gt) == 0 or len(pred) == 0:
+        return empty
+
+    gtorder = np.argsort(gt[:, 1], kind='mergesort')
+    predorder = np.argsort(pred[:, 1], kind='mergesort')
+    sortedpred = pred[predorder]
+    # A prediction can only reach a row if its top is within its height of it
+    maxpredheight = (sortedpred[:, 3] - sortedpred[:, 1]).max()
+
+    gis, pjs, ious = [], [], []
+    for start in xrange(0, len(gt), blocksize):
+        block = gtorder[start:start + blocksize]
+        gtblock = gt[block]
+        lo = np.searchsorted(sortedpred[:, 1],\
+                gtblock[:, 1].min() - maxpredheight, side='left')
+        hi = np.searchsorted(sortedpred[:, 1], gtblock[:, 3].max(),\
+                side='right')
+        if hi <= lo:
+            continue
+        iou = iou_matrix(gtblock, sortedpred[lo:hi])
+        bi, bj = np.nonzero(iou)
+        gis.append(block[bi])
+        pjs.append(predorder[lo + bj])
+        ious.append(iou[bi, bj])
+
+    if len(gis) == 0:
+        return empty
+    return np.concatenate(gis), np.concatenate(pjs), np.concatenate(ious)
+
+def _greedy_match(gi, pj, ious):
+    # Take pairs in order of decreasing IoU, skipping boxes already matched
+    order = np.argsort(-ious, kind='mergesort')
+    usedgt, usedpred = set(), set()
+    keep = []
+    for k in order:
+        if gi[k] in usedgt or pj[k] in usedpred:
+            continue
+        usedgt.add(gi[k])
+        usedpred.add(pj[k])
+        keep.append(k)
+    keep = np.array(keep, dtype=np.intp)
+    return gi[keep], pj[keep], ious[keep]
+
+def match_boxes(ngt, npred, gi, pj, ious, threshold):
+    '''
+    Match ground truth and predicted boxes one-to-one among the pairs with an
+    IoU of at least threshold, maximising the total IoU. Returns the matched
+    (gtindex, predindex, iou) arrays.
+    '''
+    keep = ious >= threshold
+    gi, pj, ious = gi[keep], pj[keep], ious[keep]
+    if len(gi) == 0 or linear_sum_assignment is None:
+        return _greedy_match(gi, pj, ious)
+
+    # Split the pairs into groups of boxes connected by an overlap. Most
+    # groups are a single pair, which needs no assignment at all.
+    graph = coo_matrix((np.ones(len(gi)), (gi, ngt + pj)),\
+            shape=(ngt + npred, ngt + npred))
+    ncomponents, labels = connected_components(graph, directed=False)
+    pairlabels = labels[gi]
+    sizes = np.bincount(pairlabels, minlength=ncomponents)
+    single = sizes[pairlabels] == 1
+
+    mgi, mpj, mious = [gi[single]], [pj[single]], [ious[single]]
+
+    multi = np.nonzero(~single)[0]
+    multi = multi[np.argsort(pairlabels[multi], kind='mergesort')]
+    bounds = np.nonzero(np.diff(pairlabels[multi]))[0] + 1
+    for group in np.split(multi, bounds):
+        if len(group) == 0:
+            continue
+        rows, rowindex = np.unique(gi[group], return_inverse=True)
+        cols, colindex = np.unique(pj[group], return_inverse=True)
+        weights = np.zeros((len(rows), len(cols)))
+        weights[rowindex, colindex] = ious[group]
+        r, c = linear_sum_assignment(-weights)
+        matched = weights[r, c] >= threshold
+        mgi.append(rows[r[matched]])
+        mpj.append(cols[c[matched]])
+        mious.append(weights[r[matched], c[matched]])
+
+    return np.concatenate(mgi), np.concatenate(mpj), np.concatenate(mious)
+
+def evaluate_boxes(gt, pred, thresholds=DEFAULT_THRESHOLDS):
+    '''
+    Score the predicted boxes against the ground truth boxes. Returns a
+    dictionary with the number of boxes of each and, for each threshold, a
+    dictionary of tp, fp, fn, precision, recall, f1 and the mean IoU of the
+    matched boxes.
+    '''
+    gt = boxes_to_array(gt)
+    pred = boxes_to_array(pred)
+    with span('evaluate.overlaps', count=len(gt)):
+        gi, pj, ious = overlapping_pairs(gt, pred)
+    result = {'ground_truth': len(gt), 'predicted': len(pred)}
+    with span('evaluate.matching', count=len(gi)):
+        for threshold in thresholds:
+            mgi, mpj, mious = match_boxes(len(gt), len(pred), gi, pj, ious,\
+                    threshold)
+            result[threshold] = scores(len(mgi), len(gt), len(pred),\
+                    mious.sum())
+    return result
+
+def scores(tp, ngt, npred, iousum=0.0):
+    '''
+    Precision, recall and F1 from a number of true positives.
+    '''
+    fp = npred - tp
+    fn = ngt - tp
+    precision = tp / npred if npred > 0 else 1.0
+    recall = tp / ngt if ngt > 0 else 1.0
+    if precision + recall > 0:
+        f1 = 2 * precision * recall / (precision + recall)
+    else:
+        f1 = 0.0
+    return {'tp': tp, 'fp': fp, 'fn': fn, 'precision': precision,\
+            'recall': recall, 'f1': f1,\
+            'mean_iou': iousum / tp if tp > 0 else 0.0}
+
+def evaluate_files(gtpath, predpath, thresholds=DEFAULT_THRESHOLDS):
+    '''
+    Score the measures of the MEI file at predpath against those of the
+    ground truth MEI file at gtpath.
+    '''
+    with span('evaluate.load'):
+        gtpage = read_mei_page(gtpath)
+        predpage = read_mei_page(predpath)
+    return evaluate_boxes(gtpage.bars, predpage.bars, thresholds)
+
+def format_result(result, thresholds=DEFAULT_THRESHOLDS):
+    lines = ["ground truth boxes: %d, predicted boxes: %d" %\
+            (result['ground_truth'], result['predicted']),\
+            "%8s %6s %6s %6s %10s %10s %10s %10s" % ('IoU', 'tp', 'fp', 'fn',\
+            'precision', 'recall', 'f1', 'mean IoU')]
+    for threshold in thresholds:
+        s = result[threshold]
+        lines.append("%8.2f %6d %6d %6d %10.4f %10.4f %10.4f %10.4f" %\
+                (threshold, s['tp'], s['fp'], s['fn'], s['precision'],\
+                s['recall'], s['f1'], s['mean_iou']))
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(\
+            description='Score barline finder output against ground truth.')
+    parser.add_argument('groundtruth', help='ground truth MEI file')
+    parser.add_argument('prediction', help='barline finder MEI file')
+    parser.add_argument('--thresholds', type=float, nargs='+',\
+            default=list(DEFAULT_THRESHOLDS), help='IoU thresholds')
+    args = parser.parse_args()
+    result = evaluate_files(args.groundtruth, args.prediction,\
+            args.thresholds)
+    print(format_result(result, args.thresholds))
@@ -0,0 +1,341 @@
+'''
+Precomputed ink counts of a preprocessed page.
+
+Two summed-area tables (integral images) of the page's ink are kept, each
+sampled at the boundaries of square blocks of BLOCK_SIZE pixels along one axis
+only:
+
+    rowsums     entry (j, x) holds the number of ink pixels above row
+                j * BLOCK_SIZE and left of column x
+    colsums     entry (y, i) holds the number of ink pixels above row y and
+                left of column i * BLOCK_SIZE
+
+The ink count of a box whose top and bottom are block boundaries is four
+lookups in rowsums, and that of a box whose sides are is four lookups in
+colsums. The counts of the single columns of a box, e.g. for its projection
+profile, are looked up in rowsums over its whole block rows, and only the
+strips of less than a block above and below them are counted from the bits of
+the packed page (see gtruth_packed); the same goes for its rows with colsums.
+So a query reads a bounded number of bytes however large the box is. Counts
+are computed for whole arrays of boxes at once. Building the tables takes a
+while on a large page, so the GUI builds them in a background thread right
+after opening it.
+
+Each table takes 4 bytes per BLOCK_SIZE pixels, as much memory as the packed
+page, where a table of every pixel would take 32 times the packed page. They
+are stored as uint32 and allowed to wrap around: the wrapped differences are
+still exact as long as a box holds fewer than 2**32 pixels, so they work for
+pages of any size.
+
+The tables are built a strip of rows at a time and saved in the page cache so
+reopening the page reuses them.
+'''
+
+import os
+import threading
+
+import numpy as np
+
+from gtruth_packed import POPCOUNT
+from gtruth_profile import span
+
+# Side in pixels of the square blocks at whose boundaries the tables are
+# sampled, a multiple of 8 so that blocks are whole bytes of a packed page
+BLOCK_SIZE = 32
+
+class InkIndex:
+    '''
+    The ink of a PackedPage and its summed-area tables.
+    '''
+
+    def __init__(self, page, rowsums=None, colsums=None, block=BLOCK_SIZE):
+        self.page = page
+        self.height, self.width = page.height, page.width
+        self.block = block
+        if rowsums is None or colsums is None:
+            with span('ink.summed_area_tables'):
+                rowsums, colsums = ink_tables(page, block)
+        self.rowsums = rowsums
+        self.colsums = colsums
+        # the number of blocks along each side, the last ones may be partial
+        self.nblocksy = rowsums.shape[0] - 1
+        self.nblocksx = colsums.shape[1] - 1
+
+    @staticmethod
+    def from_packed(page, tablepath):
+        '''
+        Build the index of a PackedPage, with the tables loaded from tablepath
+        (built and saved there first if it does not exist or is stale).
+        '''
+        shapes = table_shapes(page.width, page.height, BLOCK_SIZE)
+        tables = None
+        if os.path.exists(tablepath):
+            with np.load(tablepath) as saved:
+                tables = (saved['rowsums'], saved['colsums'])
+            if [table.shape for table in tables] != shapes or\
+                    any(table.dtype != np.uint32 for table in tables):
+                tables = None
+        if tables is None:
+            with span('ink.summed_area_tables', packed=True):
+                tables = ink_tables(page, BLOCK_SIZE)
+                temppath = '%s.%d.tmp.npz' % (tablepath[:-len('.npz')],\
+                        os.getpid())
+                np.savez(temppath, rowsums=tables[0], colsums=tables[1])
+                os.rename(temppath, tablepath)
+        return InkIndex(page, *tables)
+
+    def clip_box(self, ulx, uly, lrx, lry):
+        '''
+        Round a box to whole pixels and clip it to the page.
+        '''
+        ulx = min(max(int(round(ulx)), 0), self.width)
+        lrx = min(max(int(round(lrx)), ulx), self.width)
+        uly = min(max(int(round(uly)), 0), self.height)
+        lry = min(max(int(round(lry)), uly), self.height)
+        return ulx, uly, lrx, lry
+
+    def clip_boxes(self, boxes):
+        '''
+        clip_box for an (n, 4) array of (ulx, uly, lrx, lry), returning the
+        four integer coordinate arrays.
+        '''
+        boxes = np.rint(np.asarray(boxes, dtype=np.float64)).astype(np.int64)
+        ulx = np.clip(boxes[:, 0], 0, self.width)
+        lrx = np.clip(boxes[:, 2], ulx, self.width)
+        uly = np.clip(boxes[:, 1], 0, self.height)
+        lry = np.clip(boxes[:, 3], uly, self.height)
+        return ulx, uly, lrx, lry
+
+    def column_profile(self, ulx, uly, lrx, lry):
+        '''
+        Number of ink pixels in each column of the box, from ulx to lrx
+        (exclusive).
+        '''
+        ulx, uly, lrx, lry = self.clip_box(ulx, uly, lrx, lry)
+        starts = np.arange(ulx, lrx, self.block)
+        return self.column_counts(starts, np.repeat(uly, len(starts)),\
+                np.repeat(lry, len(starts))).ravel()[:lrx - ulx]
+
+    def row_profile(self, ulx, uly, lrx, lry):
+        '''
+        Number of ink pixels in each row of the box, from uly to lry
+        (exclusive).
+        '''
+        ulx, uly, lrx, lry = self.clip_box(ulx, uly, lrx, lry)
+        starts = np.arange(uly, lry, self.block)
+        return self.row_counts(starts, np.repeat(ulx, len(starts)),\
+                np.repeat(lrx, len(starts))).ravel()[:lry - uly]
+
+    def _boundary(self, v, size, nblocks):
+        # The index in a table of the block boundary v, the edge of the page
+        # counting as one
+        return np.where(v == size, nblocks, v // self.block)
+
+    def _inner(self, lo, hi, size):
+        # The block boundaries a <= b between lo and hi that enclose the whole
+        # blocks of the span from lo to hi, the edge of the page counting as
+        # one; a == b if there are none
+        inner0 = np.minimum(-(-lo // self.block) * self.block, hi)
+        inner1 = np.maximum(np.where(hi == size, hi,\
+                hi // self.block * self.block), inner0)
+        return inner0, inner1
+
+    def count_y_aligned(self, ulx, uly, lrx, lry):
+        '''
+        Number of ink pixels in boxes given as integer arrays of coordinates
+        clipped to the page, whose top and bottom are block boundaries (or
+        the edges of the page), from rowsums alone.
+        '''
+        j0 = self._boundary(uly, self.height, self.nblocksy)
+        j1 = self._boundary(lry, self.height, self.nblocksy)
+        sums = self.rowsums
+        # The tables wrap around but their differences are exact
+        return ((sums[j1, lrx] - sums[j1, ulx]) -\
+                (sums[j0, lrx] - sums[j0, ulx])).astype(np.int64)
+
+    def count_x_aligned(self, ulx, uly, lrx, lry):
+        '''
+        count_y_aligned for boxes whose sides are block boundaries (or the
+        edges of the page), from colsums alone.
+        '''
+        i0 = self._boundary(ulx, self.width, self.nblocksx)
+        i1 = self._boundary(lrx, self.width, self.nblocksx)
+        sums = self.colsums
+        return ((sums[lry, i1] - sums[uly, i1]) -\
+                (sums[lry, i0] - sums[uly, i0])).astype(np.int64)
+
+    def _packed(self, rows, columns):
+        # The packed bytes at the rows (n, r) and byte columns (n, c) of n
+        # boxes as an (n, r, c) array, those past the page repeating the last
+        # row or column
+        index = np.minimum(rows, self.height - 1)[:, :, np.newaxis]\
+                * self.page.rowbytes + np.minimum(columns,\
+                self.page.rowbytes - 1)[:, np.newaxis, :]
+        return self.page.rows.ravel().take(index)
+
+    def _row_bits(self, y0, spans):
+        # The number of ink pixels in each of the block rows from y0 between
+        # the columns lo and hi, less than a block apart, of each (lo, hi) in
+        # spans, counted from the packed bytes; rows past the page are
+        # garbage
+        nbytes = self.block // 8 + 1
+        columns = np.hstack([lo[:, np.newaxis] // 8 + np.arange(nbytes)\
+                for lo, hi in spans])
+        offsets = 8 * columns
+        lows = np.repeat(np.column_stack([lo for lo, hi in spans]), nbytes,\
+                axis=1)
+        highs = np.repeat(np.column_stack([hi for lo, hi in spans]), nbytes,\
+                axis=1)
+        masks = (0xff >> np.clip(lows - offsets, 0, 8)) &\
+                ~(0xff >> np.clip(highs - offsets, 0, 8))
+        packed = self._packed(y0[:, np.newaxis] + np.arange(self.block),\
+                columns)
+        return POPCOUNT[packed & masks.astype(np.uint8)[:, np.newaxis, :]]\
+                .sum(axis=2, dtype=np.int64)
+
+    def _column_bits(self, x0, spans):
+        # The number of ink pixels in each of the block columns from x0
+        # between the rows lo and hi, less than a block apart, of each (lo,
+        # hi) in spans, counted from the packed bytes; columns past the page
+        # are garbage
+        rows = np.hstack([lo[:, np.newaxis] + np.arange(self.block)\
+                for lo, hi in spans])
+        inspans = np.hstack([lo[:, np.newaxis] + np.arange(self.block) <\
+                hi[:, np.newaxis] for lo, hi in spans])
+        first = x0 // 8
+        packed = self._packed(rows, first[:, np.newaxis] +\
+                np.arange(self.block // 8 + 1))
+        packed &= np.where(inspans, 0xff, 0).astype(np.uint8)\
+                [:, :, np.newaxis]
+        bits = np.unpackbits(packed, axis=2)
+        # The rows are summed eight columns at a time as the bytes of 64 bit
+        # words, no column holding enough ink to carry over
+        counts = bits.view(np.uint64).sum(axis=1).view(np.uint8)
+        offsets = (x0 - 8 * first)[:, np.newaxis] + np.arange(self.block)
+        return counts[np.arange(len(x0))[:, np.newaxis], offsets]\
+                .astype(np.int64)
+
+    def column_counts(self, x0, uly, lry):
+        '''
+        The number of ink pixels between rows uly and lry in each of the
+        block columns from x0 (not necessarily a block boundary), for integer
+        arrays of n boxes clipped to the page, as an (n, block) array; columns
+        past the page have none. Only the strips of less than a block above
+        and below the whole block rows are read from the page.
+        '''
+        if self.width == 0 or self.height == 0:
+            return np.zeros((len(x0), self.block), dtype=np.int64)
+        columns = x0[:, np.newaxis] + np.arange(self.block)
+        inpage = columns < self.width
+        columns = np.minimum(columns, self.width - 1)
+        iy0, iy1 = self._inner(uly, lry, self.height)
+        j0 = self._boundary(iy0, self.height, self.nblocksy)[:, np.newaxis]
+        j1 = self._boundary(iy1, self.height, self.nblocksy)[:, np.newaxis]
+        sums = self.rowsums
+        counts = ((sums[j1, columns + 1] - sums[j1, columns]) -\
+                (sums[j0, columns + 1] - sums[j0, columns])).astype(np.int64)
+        counts += self._column_bits(x0, ((uly, iy0), (iy1, lry)))
+        return np.where(inpage, counts, 0)
+
+    def row_counts(self, y0, ulx, lrx):
+        '''
+        column_counts for the block rows from y0 between columns ulx and
+        lrx.
+        '''
+        if self.width == 0 or self.height == 0:
+            return np.zeros((len(y0), self.block), dtype=np.int64)
+        rows = y0[:, np.newaxis] + np.arange(self.block)
+        inpage = rows < self.height
+        rows = np.minimum(rows, self.height - 1)
+        ix0, ix1 = self._inner(ulx, lrx, self.width)
+        i0 = self._boundary(ix0, self.width, self.nblocksx)[:, np.newaxis]
+        i1 = self._boundary(ix1, self.width, self.nblocksx)[:, np.newaxis]
+        sums = self.colsums
+        counts = ((sums[rows + 1, i1] - sums[rows, i1]) -\
+                (sums[rows + 1, i0] - sums[rows, i0])).astype(np.int64)
+        counts += self._row_bits(y0, ((ulx, ix0), (ix1, lrx)))
+        return np.where(inpage, counts, 0)
+
+    def grid_counts(self, xs, ys):
+        '''
+        The number of ink pixels in each cell of the grid between the column
+        boundaries xs and row boundaries ys (see PackedPage.cell_counts), from
+        the tables alone, or None unless all the row boundaries or all the
+        column boundaries are those of blocks (or the edges of the page).
+        '''
+        xs = np.asarray(xs)
+        ys = np.asarray(ys)
+        b = self.block
+        if ((ys % b == 0) | (ys == self.height)).all():
+            j = self._boundary(ys, self.height, self.nblocksy)
+            sums = self.rowsums[j[:, np.newaxis], xs[np.newaxis, :]]
+        elif ((xs % b == 0) | (xs == self.width)).all():
+            i = self._boundary(xs, self.width, self.nblocksx)
+            sums = self.colsums[ys[:, np.newaxis], i[np.newaxis, :]]
+        else:
+            return None
+        return np.diff(np.diff(sums, axis=0), axis=1)
+
+def table_shape(size, block):
+    '''
+    The number of blocks along a side of size pixels.
+    '''
+    return -(-size // block)
+
+def table_shapes(width, height, block):
+    '''
+    The shapes of the rowsums and colsums tables of a page.
+    '''
+    return [(table_shape(height, block) + 1, width + 1),\
+            (height + 1, table_shape(width, block) + 1)]
+
+def ink_tables(page, block=BLOCK_SIZE, strip=256):
+    '''
+    The rowsums and colsums tables of page, built a strip of rows (a multiple
+    of block) at a time.
+    '''
+    rowsums, colsums = [np.zeros(shape, dtype=np.uint32) for shape\
+            in table_shapes(page.width, page.height, block)]
+    if page.width == 0 or page.height == 0:
+        return rowsums, colsums
+    strip -= strip % block
+    xs = np.arange(0, page.width, block)
+    for y in xrange(0, page.height, strip):
+        lry = min(y + strip, page.height)
+        ink = page.region(0, y, page.width, lry)
+        j = y // block
+        rowsums[j + 1:j + 1 + table_shape(lry - y, block), 1:] =\
+                np.add.reduceat(ink, np.arange(0, lry - y, block), axis=0,\
+                dtype=np.uint32)
+        colsums[y + 1:lry + 1, 1:] = np.add.reduceat(ink, xs, axis=1,\
+                dtype=np.uint32)
+    for table in (rowsums, colsums):
+        np.cumsum(table, axis=0, out=table)
+        np.cumsum(table, axis=1, out=table)
+    return rowsums, colsums
+
+class InkIndexBuilder(threading.Thread):
+    '''
+    Builds the InkIndex of a PackedPage in the background, with its tables
+    cached at tablepath, and calls callback with it when done (or with None if
+    it failed). The GUI should pass a callback that hands the result to the
+    GUI thread, e.g. with wx.CallAfter.
+    '''
+
+    def __init__(self, page, tablepath, callback):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.page = page
+        self.tablepath = tablepath
+        self.callback = callback
+        # the exception raised if the index could not be built
+        self.error = None
+
+    def run(self):
+        try:
+            index = InkIndex.from_packed(self.page, self.tablepath)
+        except Exception as err:
+            self.error = err
+            self.callback(None)
+            return
+        self.callback(index)
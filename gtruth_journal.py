@@ -0,0 +1,179 @@
+'''
+Crash-safe autosave journal for the Ground Truth system.
+
+Every box edit recorded by the EditLog (see gtruth_undo) is appended to a
+journal file next to the image as one JSON array per line. The file is flushed
+on every edit but only fsync'ed in batches (see Sync, which the GUI calls from
+a timer), so a crash loses at most the last interval of work without slowing
+down drawing. Once the journal grows long it is compacted into a single
+snapshot of the boxes.
+
+On startup the journal is replayed onto empty panel lists, which restores the
+boxes without parsing any MEI. The journal is removed once the boxes are
+saved and when the program is closed cleanly, and the first edit after that
+starts it again from a snapshot.
+'''
+
+import os
+import json
+import time
+
+from gtruthrect import Rect, reserve_rect_ids
+from gtruth_undo import apply_delta, BULK_EDITS
+
+# The journal is kept next to the image, with this extension
+JOURNAL_EXTENSION = '.gtj'
+
+# The kinds of boxes stored in a snapshot
+KINDS = ('BAR', 'STAFF')
+
+def journal_path(picfilename):
+    '''
+    The path of the journal for an image whose path, without extension, is
+    picfilename.
+    '''
+    return picfilename + JOURNAL_EXTENSION
+
+class EditJournal:
+    '''
+    Appends box edits to the file at path.
+    getpanels is a function returning the list of Rects for a kind, it is used
+    to write a snapshot when compacting.
+    The file is fsync'ed at most every syncinterval seconds and compacted once
+    it holds more than compactafter records.
+    '''
+
+    def __init__(self, path, getpanels, syncinterval=1.0, compactafter=5000):
+        self.path = path
+        self.getpanels = getpanels
+        self.syncinterval = syncinterval
+        self.compactafter = compactafter
+        # the journal is only opened once there is one, see Compact
+        self.fileobj = None
+        self.records = 0
+        if os.path.exists(path):
+            self.fileobj = open(path, 'a')
+            self.records = _count_lines(path)
+        self.dirty = False
+        self.lastsync = time.time()
+
+    def Record(self, delta):
+        '''
+        Append one edit. Can be used directly as an EditLog listener.
+        '''
+        if self.records == 0:
+            # A new journal has nothing to replay the edit onto, so it
+            # starts from a snapshot, which already holds the edit
+            self.Compact()
+            return
+        self.fileobj.write(json.dumps(delta, separators=(',', ':')) + '\n')
+        self.fileobj.flush()
+        self.records += 1
+        self.dirty = True
+        if self.records > self.compactafter:
+            self.Compact()
+        elif time.time() - self.lastsync >= self.syncinterval:
+            self.Sync()
+
+    def Sync(self):
+        '''
+        Force the recorded edits to disk if there are any that are not there
+        yet.
+        '''
+        if not self.dirty:
+            return
+        os.fsync(self.fileobj.fileno())
+        self.dirty = False
+        self.lastsync = time.time()
+
+    def Compact(self):
+        '''
+        Replace the journal with a single snapshot of the current boxes. The
+        snapshot is written to a temporary file that is renamed over the
+        journal so a crash never leaves a partial journal behind.
+        '''
+        snapshot = ['snapshot', dict([(kind, [[r.id, list(r.GetBox())]\
+                for r in self.getpanels(kind)]) for kind in KINDS])]
+        temppath = self.path + '.tmp'
+        with open(temppath, 'w') as tempfile:
+            tempfile.write(json.dumps(snapshot, separators=(',', ':')) + '\n')
+            tempfile.flush()
+            os.fsync(tempfile.fileno())
+        if self.fileobj is not None:
+            self.fileobj.close()
+        os.rename(temppath, self.path)
+        self.fileobj = open(self.path, 'a')
+        self.records = 1
+        self.dirty = False
+        self.lastsync = time.time()
+
+    def Discard(self):
+        '''
+        Remove the journal, e.g. when the user declines to restore it or the
+        boxes have been saved. The next edit starts a new one.
+        '''
+        if self.fileobj is not None:
+            self.fileobj.close()
+            self.fileobj = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.records = 0
+        self.dirty = False
+
+    def Close(self):
+        self.Sync()
+        if self.fileobj is not None:
+            self.fileobj.close()
+            self.fileobj = None
+
+def _count_lines(path):
+    count = 0
+    with open(path) as fileobj:
+        for line in fileobj:
+            count += 1
+    return count
+
+def has_journal(path):
+    '''
+    True if there is a journal at path.
+    '''
+    return os.path.exists(path)
+
+def replay_journal(path, getpanels):
+    '''
+    Apply the edits in the journal at path to the panel lists returned by
+    getpanels and return the number of edits applied and the number skipped.
+    A truncated last line, as left by a crash in the middle of a write, is
+    ignored, and so are edits of boxes that are not there, e.g. from a
+    journal that was written without a snapshot of the boxes it started from.
+    '''
+    applied = 0
+    skipped = 0
+    maxid = 0
+    with open(path) as fileobj:
+        for line in fileobj:
+            try:
+                delta = json.loads(line)
+            except ValueError:
+                # Only the last line can be incomplete
+                break
+            if delta[0] == 'snapshot':
+                for kind in KINDS:
+                    panels = getpanels(kind)
+                    panels[:] = [Rect(g[0], g[1], g[2], g[3], boxid=boxid)\
+                            for boxid, g in delta[1].get(kind, [])]
+                    maxid = max([maxid] + [r.id for r in panels])
+            else:
+                try:
+                    apply_delta(getpanels, delta)
+                except KeyError:
+                    skipped += 1
+                    continue
+                if delta[0] in BULK_EDITS:
+                    maxid = max([maxid] + [b[0] for b in delta[2]])
+                else:
+                    maxid = max(maxid, delta[2])
+            applied += 1
+    # Boxes drawn from now on must not reuse the ids of the restored boxes
+    reserve_rect_ids(maxid)
+    return applied, skipped
@@ -0,0 +1,153 @@
+'''
+Level of detail for drawing boxes when zoomed far out.
+
+Zoomed out, thousands of box outlines a few pixels wide overlap into a solid
+mass and each still costs a draw call. Instead, when the boxes of a list are
+typically smaller on the screen than a given size, they are drawn as one
+density map: a grid of cells of a few screen pixels, each tinted by the
+number of boxes covering it, drawn as a single bitmap. The map is computed
+from an array of the boxes with NumPy and kept until the boxes change or the
+zoom moves to another cell size, so painting takes the same time however
+many boxes there are. Zooming back in, above the size, draws the outlines
+again.
+'''
+
+from __future__ import division
+import os
+import math
+
+import numpy as np
+import wx
+
+# Typical on-screen size (in pixels, of the smaller side) of the boxes below
+# which they are drawn as a density map
+LOD_SIZE = 8
+
+# On-screen size in pixels of the cells of the density map, at least
+CELL_PIXELS = 4
+
+# Opacity of a cell covered by one box, and the added opacity of each further
+# box, out of 255
+BASE_ALPHA = 90
+ALPHA_PER_BOX = 40
+MAX_ALPHA = 220
+
+def lod_size_from_environment():
+    '''
+    The on-screen size set by the GTRUTH_LOD_SIZE environment variable, or
+    LOD_SIZE. 0 always draws the outlines.
+    '''
+    try:
+        return float(os.environ.get('GTRUTH_LOD_SIZE', LOD_SIZE))
+    except ValueError:
+        return LOD_SIZE
+
+def box_array(rects):
+    '''
+    The (posx, posy, sizex, sizey) of rects as an (n, 4) float array.
+    '''
+    return np.array([r.GetBox() for r in rects], dtype=np.float64)\
+            .reshape(len(rects), 4)
+
+def typical_size(boxes):
+    '''
+    The median of the smaller side of the boxes, 0 if there are none.
+    '''
+    if len(boxes) == 0:
+        return 0.0
+    return float(np.median(np.minimum(np.abs(boxes[:, 2]),\
+            np.abs(boxes[:, 3]))))
+
+def cell_size(scale):
+    '''
+    The side in page pixels of the cells of the density map at a zoom of
+    scale, a power of two so that small zoom steps keep the same map.
+    '''
+    return 2 ** max(0, int(math.ceil(math.log(CELL_PIXELS / scale, 2))))
+
+def density_grid(boxes, cell, width, height):
+    '''
+    The number of boxes covering each cell of a grid of cell by cell page
+    pixels over a width by height page, as an (rows, columns) int32 array.
+    '''
+    ncols = max(1, int(math.ceil(width / cell)))
+    nrows = max(1, int(math.ceil(height / cell)))
+    # Every box adds one to a rectangle of cells, through the corners of a
+    # difference array that is summed up along both axes
+    diff = np.zeros((nrows + 1, ncols + 1), dtype=np.int32)
+    if len(boxes) > 0:
+        ulx = np.minimum(boxes[:, 0], boxes[:, 0] + boxes[:, 2])
+        uly = np.minimum(boxes[:, 1], boxes[:, 1] + boxes[:, 3])
+        lrx = ulx + np.abs(boxes[:, 2])
+        lry = uly + np.abs(boxes[:, 3])
+        x0 = np.clip(np.floor(ulx / cell), 0, ncols - 1).astype(np.intp)
+        y0 = np.clip(np.floor(uly / cell), 0, nrows - 1).astype(np.intp)
+        x1 = np.clip(np.floor(lrx / cell), 0, ncols - 1).astype(np.intp) + 1
+        y1 = np.clip(np.floor(lry / cell), 0, nrows - 1).astype(np.intp) + 1
+        np.add.at(diff, (y0, x0), 1)
+        np.add.at(diff, (y0, x1), -1)
+        np.add.at(diff, (y1, x0), -1)
+        np.add.at(diff, (y1, x1), 1)
+    return diff.cumsum(axis=0).cumsum(axis=1)[:nrows, :ncols]
+
+def density_bitmap(grid, colour):
+    '''
+    A bitmap of the grid, one pixel per cell, in colour (a wx.Colour) with
+    the opacity growing with the number of boxes.
+    '''
+    nrows, ncols = grid.shape
+    alpha = np.where(grid > 0, np.minimum(BASE_ALPHA +\
+            ALPHA_PER_BOX * (grid - 1), MAX_ALPHA), 0).astype(np.uint8)
+    rgba = np.empty((nrows, ncols, 4), dtype=np.uint8)
+    rgba[:, :, 0] = colour.Red()
+    rgba[:, :, 1] = colour.Green()
+    rgba[:, :, 2] = colour.Blue()
+    rgba[:, :, 3] = alpha
+    return wx.BitmapFromBufferRGBA(ncols, nrows, rgba.tostring())
+
+class BoxLOD:
+    '''
+    The density maps of the box lists drawn on a page, each kept until its
+    list changes. A list is known by a name and its version, which must
+    change whenever its boxes do.
+    '''
+
+    def __init__(self, lodsize=LOD_SIZE):
+        self.lodsize = lodsize
+        # name -> (version, boxes, typical size)
+        self.boxes = {}
+        # name -> (version, cell, bitmap)
+        self.maps = {}
+
+    def _Boxes(self, name, version, rects):
+        entry = self.boxes.get(name)
+        if entry is None or entry[0] != version:
+            boxes = box_array(rects)
+            entry = (version, boxes, typical_size(boxes))
+            self.boxes[name] = entry
+        return entry
+
+    def DensityMap(self, name, version, rects, scale, width, height, colour):
+        '''
+        The (cell, bitmap) of the density map of rects at a zoom of scale, or
+        None if they are large enough on the screen to be drawn as outlines.
+        '''
+        if self.lodsize <= 0 or len(rects) == 0:
+            return None
+        _, boxes, size = self._Boxes(name, version, rects)
+        if size * scale >= self.lodsize:
+            return None
+        cell = cell_size(scale)
+        entry = self.maps.get(name)
+        if entry is None or entry[0] != version or entry[1] != cell:
+            # boxes may reach past the page, or there may be no page yet
+            width = max(width, (boxes[:, 0] + boxes[:, 2]).max())
+            height = max(height, (boxes[:, 1] + boxes[:, 3]).max())
+            grid = density_grid(boxes, cell, width, height)
+            entry = (version, cell, density_bitmap(grid, colour))
+            self.maps[name] = entry
+        return entry[1], entry[2]
+
+    def Clear(self):
+        self.boxes.clear()
+        self.maps.clear()
@@ -14,31 +14,170 @@ import os
 import re
 import sys
 import datetime
+import shutil
+import tempfile
 
 from pymei import MeiDocument, MeiElement, XmlExport
 
 from gtruthrect import *
+from gtruth_profile import span, profiled
+from gtruth_compress import compression_of, compress_file, CHUNK_SIZE
+from gtruth_meiload import MeiPage
+
+# The meiHead of every document is the same except for the date, so it is
+# built once per application version and cloned for each document
+_header_templates = {}
+
+def _clone_element(element):
+    '''
+    A deep copy of a pymei element, or None if this version of pymei cannot
+    copy elements.
+    '''
+    try:
+        clone = MeiElement(element)
+    except TypeError:
+        return None
+    if len(clone.getChildren()) != len(element.getChildren()):
+        return None
+    return clone
+
+# Compact names of the elements given ids from box numbers, for short ids
+SHORT_KINDS = {'zone': 'z', 'staffzone': 'sz', 'measure': 'm', 'sb': 'sb',\
+        'staff': 's'}
+
+class ElementIds:
+    '''
+    Deterministic xml:ids for the elements of a document, so that exporting
+    the same boxes twice gives the same file.
+    Zones, measures, system breaks and staves are named after the page and
+    the number of their box, e.g. page1-measure-12, or m12 with short ids
+    (which leave the page out). All other elements are named after their
+    element name and their position among the elements of that name, in
+    document order.
+    prefix, if given, starts every id instead of the page name, and used is
+    the set of the ids already taken, for the pages of a document that holds
+    several.
+    '''
+
+    def __init__(self, page='', short=False, prefix=None, used=None):
+        self.short = short
+        if prefix is not None:
+            self.prefix = prefix
+        elif short:
+            self.prefix = ''
+        else:
+            # xml:ids may only contain some characters and not start with a
+            # digit
+            page = re.sub(r'[^A-Za-z0-9_.-]', '_', os.path.basename(page))
+            if len(page) > 0 and not (page[0].isalpha() or page[0] == '_'):
+                page = '_' + page
+            self.prefix = page + '-' if len(page) > 0 else ''
+        self.used = used if used is not None else set()
+
+    def _unique(self, base):
+        # Numbers of boxes can repeat (e.g. bars outside every staff), the
+        # repeats get a suffix
+        newid = base
+        k = 1
+        while newid in self.used:
+            k = k + 1
+            newid = '%s_%d' % (base, k)
+        self.used.add(newid)
+        return newid
+
+    def _name(self, kind, numbers):
+        # boxes without a number (-1) are called x
+        numbers = [str(n) if n >= 0 else 'x' for n in numbers]
+        if self.short:
+            return self.prefix + SHORT_KINDS.get(kind, kind) +\
+                    '.'.join(numbers)
+        return self.prefix + '-'.join([kind] + numbers)
+
+    def assign(self, element, kind, *numbers):
+        element.setId(self._unique(self._name(kind, numbers)))
+        return element
+
+    def assign_remaining(self, root):
+        '''
+        Name the elements under root that were not assigned an id, and point
+        the references to them (facs and target attributes) to the new ids.
+        '''
+        renamed = {}
+        counts = {}
+        stack = [root]
+        elements = []
+        while len(stack) > 0:
+            element = stack.pop()
+            elements.append(element)
+            stack.extend(reversed(element.getChildren()))
+        for element in elements:
+            if element.getId() in self.used:
+                continue
+            name = element.getName()
+            counts[name] = counts.get(name, 0) + 1
+            newid = self._unique(self._name(name, [counts[name]]))
+            renamed[element.getId()] = newid
+            element.setId(newid)
+        for element in elements:
+            for attribute in element.getAttributes():
+                if attribute.getName() not in ('facs', 'target'):
+                    continue
+                value = attribute.getValue()
+                if value.startswith('#') and value[1:] in renamed:
+                    attribute.setValue('#' + renamed[value[1:]])
+
+def _finish_output(temppath, output_path, compression=None):
+    '''
+    Compress the document written to temppath if compression (or the
+    extension of output_path) asks for it, and rename it over output_path.
+    '''
+    if compression is None:
+        compression = compression_of(output_path)
+    if compression is not None:
+        # The XML is compressed from the file it was written to, so the
+        # document is not serialized into memory a second time
+        xmlpath = temppath
+        temppath = '%s.%d.ctmp' % (output_path, os.getpid())
+        try:
+            compress_file(xmlpath, temppath, compression)
+        except:
+            if os.path.exists(temppath):
+                os.remove(temppath)
+            raise
+        finally:
+            os.remove(xmlpath)
+    os.rename(temppath, output_path)
+
+def _child(element, *names):
+    # Follow the path of child element names down from element
+    for name in names:
+        children = element.getChildrenByName(name)
+        if len(children) == 0:
+            return None
+        element = children[0]
+    return element
 
 class GroundTruthBarlineDataConverter:
     '''
-    Convert the stored measures of the Ground Truth System to MEI.
-    TODO: Only considers barpanels, not staffpanels
+    Convert the stored staves and measures of the Ground Truth System to MEI.
     '''
 
-    def __init__(self, staffbb, barbb, verbose=False):
+    def __init__(self, staffbb, barbb, verbose=False, shortids=False,\
+            date=None):
         '''
         Constructor of converter.
         staffbb are the boxes bouding the staves (or systems)
         barbb are the boxes bounding the measures (or bars)
-        These are passed in as lists of Rects defined in gtruth-rect
+        These are passed in as lists of Rects defined in gtruth-rect, the
+        staves holding their bars as children, as grouped by
+        build_staff_hierarchy
         '''
 
         # Print errors / messages
         self.verbose = verbose
 
-        # The coordinates of the staves stored in the format:
-        # [index, top-corner x, top-corner y, bottom-corner x, bottom-corner y]
-        # (note this is a python list)
+        # The staves, in reading order, each with the bars it holds as its
+        # children, left to right.
         # To get an idea of what the staves are, image a piano score where each
         # system consists (usually) of a treble staff and bass staff. This
         # system is divided into measures and you can divide the measure into
@@ -61,19 +200,30 @@ class GroundTruthBarlineDataConverter:
 
         self.meidoc = None;
 
+        # Whether the ids of the elements are the short ones of ElementIds
+        self.shortids = shortids
+
+        # The date written in the header, today's if None
+        self.date = date
+
+        # The ids of the document being created
+        self.ids = None
+
     def bardata_to_mei(self, imagepath, imagewidth, imageheight, imagedpi=72):
         '''
         Perform the data conversion to MEI
         '''
 
         self.meidoc = MeiDocument()
+        self.ids = ElementIds(imagepath, self.shortids)
         mei = MeiElement('mei')
         self.meidoc.setRootElement(mei)
 
         ###########################
         #         MetaData        #
         ###########################
-        mei_head = self._create_header()
+        with span('converter._create_header'):
+            mei_head = self._create_header()
         mei.addChild(mei_head)
 
         ###########################
@@ -104,36 +254,126 @@ class GroundTruthBarlineDataConverter:
         score.addChild(score_def)
         score.addChild(section)
 
-        barmeasdict = dict()
+        with span('converter.zones_measures', count=len(self.barbb)):
+            self._add_boxes(surface, section)
+
+        # Everything else is named in document order
+        self.ids.assign_remaining(mei)
 
-        # Only add the bar bounding boxes
+    def _add_boxes(self, surface, section):
+        '''
+        Add the zones of the staves and bars to surface and their system
+        breaks and measures to section
+        '''
+        # The bars come already grouped under their staves and sorted, so
+        # everything is written in one pass: each staff gets a zone and a
+        # system break pointing to it, followed by the measures of its bars,
+        # which point back to the staff zone.
+        grouped = set()
+        for staff in self.staffbb:
+            # Zone is the coordinates where the staff is found in the image
+            staffzone = self.ids.assign(\
+                    self._create_zone(*self._rect_box(staff)),\
+                    'staffzone', staff.number)
+            surface.addChild(staffzone)
+            section.addChild(self.ids.assign(self._create_system_break(\
+                    staff.number, staffzone), 'sb', staff.number))
+            for bar in staff.children:
+                self._add_bar(surface, section, bar, staff.number, staffzone)
+                grouped.add(bar.id)
+
+        # Bars that are not inside any staff are still written, after the
+        # staves
         for bar in self.barbb:
-            # Zone is the coordinates where the measure is found in the image
-            zone = self._create_zone(\
-                    int(bar.pos[0]),int(bar.pos[1]),\
-                    int(bar.pos[0])+int(bar.size[0]),\
-                    int(bar.pos[1])+int(bar.size[1]));
-            # Zone is a child element of the surface
-            surface.addChild(zone)
-            # The measure is found in the zone
-            measure = self._create_measure(bar.number,zone);
-            section.addChild(measure);
-            # store which measure this bar corresponds to so we can add it as a
-            # child to the staff bounding boxes later TODO: We don't do this
-            # right now
-            barmeasdict[bar] = measure
-
-        # Add the staff bounding boxes
-        # We don't do this but when we do, the staff needs to look up its
-        # children in barmeasdict
+            if bar.id not in grouped:
+                self._add_bar(surface, section, bar)
+
+    def bardata_to_page(self, imagepath, imagewidth, imageheight,\
+            imagedpi=72):
+        '''
+        The boxes bardata_to_mei would write, as the MeiPage that reading the
+        document back would give, without building the document
+        '''
+        page = MeiPage(imagepath, imagewidth, imageheight, imagedpi)
+        grouped = set()
+        for staff in self.staffbb:
+            page.staves.append((staff.number,) + self._rect_box(staff))
+            for bar in staff.children:
+                page.bars.append((bar.number,) + self._rect_box(bar))
+                grouped.add(bar.id)
+        for bar in self.barbb:
+            if bar.id not in grouped:
+                page.bars.append((bar.number,) + self._rect_box(bar))
+        return page
+
+    def _rect_box(self, rect):
+        '''
+        The (ulx, uly, lrx, lry) of a Rect in whole pixels
+        '''
+        return (int(rect.pos[0]), int(rect.pos[1]),\
+                int(rect.pos[0]) + int(rect.size[0]),\
+                int(rect.pos[1]) + int(rect.size[1]))
+
+    def _add_bar(self, surface, section, bar, staffn=None, staffzone=None):
+        '''
+        Add the zone and measure of a bar, linked to its staff if it has one
+        '''
+        # Zone is the coordinates where the measure is found in the image
+        zone = self.ids.assign(self._create_zone(*self._rect_box(bar)),\
+                'zone', bar.number)
+        # Zone is a child element of the surface
+        surface.addChild(zone)
+        # The measure is found in the zone
+        measure = self.ids.assign(self._create_measure(bar.number, zone),\
+                'measure', bar.number)
+        if staffzone is not None:
+            measure.addChild(self.ids.assign(self._create_staff(staffn,\
+                    staffzone), 'staff', bar.number))
+        section.addChild(measure)
+
+    def _today(self):
+        if self.date is not None:
+            return self.date
+        return datetime.date.today().isoformat()
 
     def _create_header(self, rodan_version='0.1'):
         '''
-        Create a meiHead element
+        Create a meiHead element, cloned from the header template of
+        rodan_version with today's date and the id of its application patched
+        in (or built from scratch if pymei cannot clone elements)
+        '''
+
+        template = _header_templates.get(rodan_version)
+        if template is None:
+            template = self._build_header(rodan_version)
+            _header_templates[rodan_version] = template
+
+        mei_head = _clone_element(template)
+        if mei_head is None:
+            return self._build_header(rodan_version)
+
+        application = _child(mei_head, 'encodingDesc', 'appInfo',\
+                'application')
+        change = _child(mei_head, 'revisionDesc', 'change')
+        ref = _child(change, 'changeDesc', 'p', 'ref')
+        date = _child(change, 'date')
+        if None in (application, ref, date):
+            return self._build_header(rodan_version)
+
+        # the clone may have new ids, so the reference to the application is
+        # set again
+        ref.getAttribute('target').setValue('#'+application.getId())
+        date.setValue(self._today())
+
+        return mei_head
+
+    def _build_header(self, rodan_version='0.1'):
+        '''
+        Build a meiHead element from scratch
         '''
 
         mei_head = MeiElement('meiHead')
-        today = datetime.date.today().isoformat()
+        today = self._today()
 
         app_name = 'gtruth_write_mei'
 
@@ -234,6 +474,30 @@ class GroundTruthBarlineDataConverter:
 
         return measure
 
+    def _create_system_break(self, n, zone):
+        '''
+        Create a system break (sb) element starting a staff, referring to the
+        zone of the staff
+        '''
+
+        sb = MeiElement('sb')
+        sb.addAttribute('n', str(n))
+        sb.addAttribute('facs', '#'+zone.getId())
+
+        return sb
+
+    def _create_staff(self, n, zone):
+        '''
+        Create a staff element placing a measure on the staff whose zone is
+        given
+        '''
+
+        staff = MeiElement('staff')
+        staff.addAttribute('n', str(n))
+        staff.addAttribute('facs', '#'+zone.getId())
+
+        return staff
+
     def _create_zone(self, ulx, uly, lrx, lry):
         '''
         Create a zone element
@@ -247,9 +511,12 @@ class GroundTruthBarlineDataConverter:
 
         return zone
 
-    def output_mei(self, output_path):
+    @profiled('converter.output_mei')
+    def output_mei(self, output_path, compression=None):
         '''
-        Write the generated mei to disk
+        Write the generated mei to disk, atomically. compression is 'gzip' or
+        'zstd' (see gtruth_compress), by default chosen from the extension of
+        output_path.
         '''
 
         # output mei file
@@ -257,5 +524,173 @@ class GroundTruthBarlineDataConverter:
             raise Warning('The MEI document has not yet been created');
             return
 
-        XmlExport.meiDocumentToFile(self.meidoc, output_path)
+        # The document is written next to its destination and renamed over
+        # it, so a partially written file is never seen
+        temppath = '%s.%d.tmp' % (output_path, os.getpid())
+        if not XmlExport.meiDocumentToFile(self.meidoc, temppath):
+            if os.path.exists(temppath):
+                os.remove(temppath)
+            raise IOError('Could not write ' + output_path)
+
+        _finish_output(temppath, output_path, compression)
+
+# The ids of the stand-ins for the surfaces and the measures of the pages in
+# the skeleton of a multi-page document
+_SURFACES_MARK = 'gtruth-surfaces'
+_MEASURES_MARK = 'gtruth-measures'
+
+def _encode(text):
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+def _split_at(text, name, markid):
+    # The text before and after the empty element name with id markid
+    match = re.search(r'<%s\b[^>]*"%s"[^>]*/>' % (name, markid), text)
+    if match is None:
+        raise ValueError('No %s stand-in in the document skeleton' % name)
+    return text[:match.start()], text[match.end():]
+
+class MultiPageMeiWriter:
+    '''
+    Write the pages of a whole source (a book or a part) as one MEI document,
+    with a single header, a facsimile holding a surface for each page and a
+    section holding the measures of every page, each page starting with a
+    page break (pb) pointing to its surface.
+
+    Pages are converted and written one at a time with add_page: the
+    surfaces go straight to the output and the section is spooled to a
+    temporary file and appended by close, so only one page is held in memory
+    however long the source is. The document is written next to
+    output_path and renamed over it (compressed if asked, as by output_mei)
+    when it is closed.
+    '''
+
+    def __init__(self, output_path, shortids=False, date=None,\
+            compression=None):
+        self.output_path = output_path
+        self.shortids = shortids
+        self.date = date
+        self.compression = compression
+        self.npages = 0
+
+        # The ids used so far, to keep them unique across the pages
+        self.used = set([_SURFACES_MARK, _MEASURES_MARK])
+
+        head, self.middle, self.tail = self._skeleton()
+        self.temppath = '%s.%d.tmp' % (output_path, os.getpid())
+        self.outfile = open(self.temppath, 'wb')
+        self.spool = tempfile.TemporaryFile()
+        self.outfile.write(_encode(head))
+
+    def _skeleton(self):
+        '''
+        The text of the document before the surfaces, between the surfaces
+        and the measures, and after the measures
+        '''
+        converter = GroundTruthBarlineDataConverter([], [], date=self.date)
+        meidoc = MeiDocument()
+        mei = MeiElement('mei')
+        meidoc.setRootElement(mei)
+        mei.addChild(converter._create_header())
+
+        music = MeiElement('music')
+        facsimile = MeiElement('facsimile')
+        body = MeiElement('body')
+        mdiv = MeiElement('mdiv')
+        score = MeiElement('score')
+        section = MeiElement('section')
+        mei.addChild(music)
+        music.addChild(facsimile)
+        music.addChild(body)
+        body.addChild(mdiv)
+        mdiv.addChild(score)
+        score.addChild(MeiElement('scoreDef'))
+        score.addChild(section)
+
+        surfaces = MeiElement('surface')
+        surfaces.setId(_SURFACES_MARK)
+        facsimile.addChild(surfaces)
+        measures = MeiElement('pb')
+        measures.setId(_MEASURES_MARK)
+        section.addChild(measures)
+
+        ElementIds('', self.shortids, used=self.used).assign_remaining(mei)
+        text = XmlExport.meiDocumentToText(meidoc)
+        head, rest = _split_at(text, 'surface', _SURFACES_MARK)
+        middle, tail = _split_at(rest, 'pb', _MEASURES_MARK)
+        return head, middle, tail
+
+    @profiled('multipage.add_page')
+    def add_page(self, staffbb, barbb, imagepath, imagewidth, imageheight,\
+            imagedpi=72):
+        '''
+        Write the next page of the source, its staves and bars given as to
+        GroundTruthBarlineDataConverter
+        '''
+        self.npages += 1
+        converter = GroundTruthBarlineDataConverter(staffbb, barbb,\
+                shortids=self.shortids, date=self.date)
+        # Short ids leave out the page name, so they are told apart by the
+        # number of the page instead
+        prefix = 'p%d-' % self.npages if self.shortids else None
+        converter.ids = ElementIds(imagepath, self.shortids, prefix,\
+                self.used)
 
+        surface = MeiElement('surface')
+        surface.addChild(converter._create_graphic(imagepath, imagewidth,\
+                imageheight, imagedpi))
+        section = MeiElement('section')
+        pb = MeiElement('pb')
+        pb.addAttribute('n', str(self.npages))
+        pb.addAttribute('facs', '#'+surface.getId())
+        section.addChild(pb)
+        converter._add_boxes(surface, section)
+
+        # The page is serialized on its own, in a document that is only a
+        # container for its surface and section
+        page = MeiElement('mei')
+        page.addChild(surface)
+        page.addChild(section)
+        converter.ids.assign_remaining(page)
+        meidoc = MeiDocument()
+        meidoc.setRootElement(page)
+        text = _encode(XmlExport.meiDocumentToText(meidoc))
+
+        surfacetext = re.search(r'<surface\b.*</surface>', text, re.DOTALL)
+        sectiontext = re.search(r'<section\b[^>]*>(.*)</section>', text,\
+                re.DOTALL)
+        if surfacetext is None or sectiontext is None:
+            raise ValueError('Could not serialize the page ' + imagepath)
+        self.outfile.write(surfacetext.group(0) + '\n')
+        self.spool.write(sectiontext.group(1))
+
+    def close(self):
+        '''
+        Finish the document and move it to output_path
+        '''
+        self.outfile.write(_encode(self.middle))
+        self.spool.seek(0)
+        shutil.copyfileobj(self.spool, self.outfile, CHUNK_SIZE)
+        self.outfile.write(_encode(self.tail))
+        self.spool.close()
+        self.outfile.close()
+        _finish_output(self.temppath, self.output_path, self.compression)
+
+    def abort(self):
+        '''
+        Drop the document, leaving output_path as it was
+        '''
+        self.spool.close()
+        self.outfile.close()
+        if os.path.exists(self.temppath):
+            os.remove(self.temppath)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exctype, value, traceback):
+        if exctype is None:
+            self.close()
+        else:
+            self.abort()
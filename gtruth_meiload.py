@@ -0,0 +1,148 @@
+'''
+Reading the boxes back out of MEI files written by the Ground Truth system (or
+by the barline finder, which uses the same layout).
+'''
+
+import os
+import tempfile
+
+from pymei import XmlImport
+
+from gtruth_compress import compression_of, decompress_file, EXTENSIONS
+
+# The endings of MEI file names, plain or compressed
+MEI_SUFFIXES = ('.mei',) + tuple(['.mei' + extension for extension\
+        in sorted(EXTENSIONS)])
+
+class MeiPage:
+    '''
+    The image metadata and boxes found in one MEI file. Boxes are tuples of
+    (number, ulx, uly, lrx, lry).
+    '''
+
+    def __init__(self, picpath='', width=0, height=0, dpi=72, bars=None,\
+            staves=None):
+        self.picpath = picpath
+        self.width = width
+        self.height = height
+        self.dpi = dpi
+        self.bars = bars if bars is not None else []
+        self.staves = staves if staves is not None else []
+
+def _int_attribute(element, name, default=0):
+    if not element.hasAttribute(name):
+        return default
+    return int(float(element.getAttribute(name).getValue()))
+
+def _zone_box(meidoc, element):
+    # the id of the zone that has the coordinates is stored in 'facs' with a
+    # preceding # sign
+    if not element.hasAttribute('facs'):
+        return None
+    zone = meidoc.getElementById(element.getAttribute('facs').getValue()[1:])
+    if zone is None:
+        return None
+    return (_int_attribute(zone, 'ulx'), _int_attribute(zone, 'uly'),\
+            _int_attribute(zone, 'lrx'), _int_attribute(zone, 'lry'))
+
+def read_mei_page(path):
+    '''
+    Read the graphic, the staff boxes and the measure boxes of the MEI file at
+    path.
+    '''
+    return mei_document_to_page(read_mei_document(path))
+
+def read_mei_document(path):
+    '''
+    Read the MEI file at path, decompressing it first if its name ends in
+    .gz or .zst. Compressed files are decompressed to a temporary file that
+    is parsed like a plain one, rather than into memory.
+    '''
+    if compression_of(path) is None:
+        return XmlImport.documentFromFile(str(path))
+    fd, temppath = tempfile.mkstemp(suffix='.mei')
+    os.close(fd)
+    try:
+        decompress_file(path, temppath)
+        return XmlImport.documentFromFile(temppath)
+    finally:
+        os.remove(temppath)
+
+def mei_page_name(path):
+    '''
+    The file name of path without its MEI suffix, or None if it is not an MEI
+    file.
+    '''
+    name = os.path.basename(path)
+    for suffix in MEI_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return None
+
+def _graphic_page(graphic):
+    page = MeiPage()
+    if graphic is None:
+        return page
+    if graphic.hasAttribute('target'):
+        page.picpath = graphic.getAttribute('target').getValue()
+    page.width = _int_attribute(graphic, 'width')
+    page.height = _int_attribute(graphic, 'height')
+    page.dpi = _int_attribute(graphic, 'resolution', 72)
+    return page
+
+def mei_document_to_page(meidoc):
+    graphics = meidoc.getElementsByName('graphic')
+    page = _graphic_page(graphics[0] if len(graphics) > 0 else None)
+
+    for measure in meidoc.getElementsByName('measure'):
+        box = _zone_box(meidoc, measure)
+        if box is None:
+            continue
+        page.bars.append((_int_attribute(measure, 'n', -1),) + box)
+
+    # each staff starts with a system break pointing to its zone
+    for sb in meidoc.getElementsByName('sb'):
+        box = _zone_box(meidoc, sb)
+        if box is None:
+            continue
+        page.staves.append((_int_attribute(sb, 'n', -1),) + box)
+
+    return page
+
+def read_mei_pages(path):
+    '''
+    Read every page of the MEI file at path, which may hold several (see
+    gtruth_meicreate.MultiPageMeiWriter).
+    '''
+    return mei_document_to_pages(read_mei_document(path))
+
+def mei_document_to_pages(meidoc):
+    '''
+    The pages of a document, one for each surface. Boxes belong to the page
+    whose surface holds their zone.
+    '''
+    surfaces = meidoc.getElementsByName('surface')
+    if len(surfaces) <= 1:
+        return [mei_document_to_page(meidoc)]
+
+    pages = []
+    zonepages = {}
+    for surface in surfaces:
+        graphics = surface.getChildrenByName('graphic')
+        page = _graphic_page(graphics[0] if len(graphics) > 0 else None)
+        pages.append(page)
+        for zone in surface.getChildrenByName('zone'):
+            zonepages[zone.getId()] = page
+
+    for name, boxes in (('measure', 'bars'), ('sb', 'staves')):
+        for element in meidoc.getElementsByName(name):
+            if not element.hasAttribute('facs'):
+                continue
+            page = zonepages.get(element.getAttribute('facs').getValue()[1:])
+            box = _zone_box(meidoc, element)
+            if page is None or box is None:
+                continue
+            getattr(page, boxes).append((_int_attribute(element, 'n', -1),)\
+                    + box)
+
+    return pages
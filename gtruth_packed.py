@@ -0,0 +1,135 @@
+'''
+Packed onebit page files, read by memory mapping.
+
+A preprocessed page is stored as one bit per pixel, eight pixels to a byte,
+most significant bit first and each row padded to whole bytes, after a fixed
+header:
+
+    header      HEADER (see below)
+    rows        height rows of rowbytes bytes, 1 bits are ink
+
+The file is memory mapped, so only the rows that are actually read (e.g. the
+visible part of the page) are paged in and the file is never copied into
+memory as a whole. A 600 dpi large-format page that takes hundreds of MB as a
+greyscale image takes a few tens of MB here.
+
+The file is written a strip of rows at a time from the gamera image, so
+writing it does not need a second copy of the page either.
+'''
+
+import os
+import mmap
+import struct
+
+import numpy as np
+
+PACKED_MAGIC = 'GTPB'
+PACKED_VERSION = 1
+
+# magic, version, reserved, width, height, bytes per row, dpi
+HEADER = struct.Struct('<4sHHIIIf')
+
+# Rows converted at a time when writing a page
+STRIP_ROWS = 256
+
+# The number of 1 bits of each byte value
+POPCOUNT = np.array([bin(value).count('1') for value in xrange(256)],\
+        dtype=np.uint8)
+
+def _write_packed(path, width, height, dpi, strips):
+    # Write the header and the packed strips to a temporary file and rename it
+    # over path so an interrupted write is never taken for a page
+    temppath = '%s.%d.tmp' % (path, os.getpid())
+    with open(temppath, 'wb') as fileobj:
+        fileobj.write(HEADER.pack(PACKED_MAGIC, PACKED_VERSION, 0, width,\
+                height, (width + 7) // 8, dpi))
+        for strip in strips:
+            fileobj.write(np.packbits(strip, axis=1).tostring())
+    os.rename(temppath, path)
+
+def write_packed(path, ink, dpi=0):
+    '''
+    Write a boolean ink array (True for ink) as a packed page.
+    '''
+    height, width = ink.shape
+    _write_packed(path, width, height, dpi, (ink[y:y + STRIP_ROWS]\
+            for y in xrange(0, height, STRIP_ROWS)))
+
+def write_packed_image(path, image):
+    '''
+    Write a onebit gamera image as a packed page, converting it a strip of
+    rows at a time.
+    '''
+    width, height = image.ncols, image.nrows
+    def strips():
+        for y in xrange(0, height, STRIP_ROWS):
+            lry = min(y + STRIP_ROWS, height) - 1
+            yield image.subimage((0, y), (width - 1, lry)).to_numpy() != 0
+    _write_packed(path, width, height, image.resolution, strips())
+
+class PackedPage:
+    '''
+    A memory mapped packed page. rows is the (height, rowbytes) uint8 array of
+    packed rows, backed by the file.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fileobj:
+            self.map = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < HEADER.size:
+            self.map.close()
+            raise ValueError("Not a packed page: " + path)
+        magic, version, _, self.width, self.height, self.rowbytes, self.dpi\
+                = HEADER.unpack_from(self.map, 0)
+        if magic != PACKED_MAGIC or version != PACKED_VERSION or\
+                len(self.map) < HEADER.size + self.height * self.rowbytes:
+            self.map.close()
+            raise ValueError("Not a packed page: " + path)
+        self.shape = (self.height, self.width)
+        self.rows = np.frombuffer(self.map, dtype=np.uint8,\
+                count=self.height * self.rowbytes,\
+                offset=HEADER.size).reshape(self.height, self.rowbytes)
+
+    def clip_box(self, ulx, uly, lrx, lry):
+        ulx = min(max(int(ulx), 0), self.width)
+        lrx = min(max(int(lrx), ulx), self.width)
+        uly = min(max(int(uly), 0), self.height)
+        lry = min(max(int(lry), uly), self.height)
+        return ulx, uly, lrx, lry
+
+    def region(self, ulx, uly, lrx, lry):
+        '''
+        The ink of a box (lrx and lry exclusive, clipped to the page) as a
+        boolean array. Only the bytes covering the box are unpacked.
+        '''
+        ulx, uly, lrx, lry = self.clip_box(ulx, uly, lrx, lry)
+        first = ulx // 8
+        bits = np.unpackbits(self.rows[uly:lry, first:(lrx + 7) // 8], axis=1)
+        return bits[:, ulx - 8 * first:lrx - 8 * first].astype(bool)
+
+    def ink(self):
+        '''
+        The ink of the whole page, for the analyses that need all of it.
+        '''
+        return self.region(0, 0, self.width, self.height)
+
+    def cell_counts(self, xs, ys):
+        '''
+        The number of ink pixels in each cell of a grid over the page, whose
+        cells lie between the increasing column boundaries xs and row
+        boundaries ys, as a (len(ys) - 1, len(xs) - 1) uint32 array. The
+        column boundaries must be multiples of 8 (or the width of the page)
+        so that the bytes are counted without unpacking them.
+        '''
+        first = xs[0] // 8
+        counts = POPCOUNT[self.rows[ys[0]:ys[-1], first:(xs[-1] + 7) // 8]]
+        counts = np.add.reduceat(counts, np.asarray(ys[:-1]) - ys[0],\
+                axis=0, dtype=np.uint32)
+        return np.add.reduceat(counts, np.asarray(xs[:-1]) // 8 - first,\
+                axis=1)
+
+    def close(self):
+        # The array must go before the map it points into
+        self.rows = None
+        self.map.close()
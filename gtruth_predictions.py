@@ -0,0 +1,186 @@
+'''
+Bulk loading of barline finder predictions, as starting points for
+correction.
+
+The prediction MEI files of a whole corpus (plain, compressed or holding
+several pages) are parsed in a pool of processes, in the background, and
+their boxes gathered into one box table (see gtruth_columns). Forking a pool
+from a thread of the GUI can deadlock the children on locks held by other
+threads, so the GUI has the table built by running gtruth_columns in a new
+Python process, which starts the pool itself. The table is
+kept in the page cache under a key made from the files' paths, sizes and
+modification times, so loading the same predictions again memory maps the
+table instead of parsing any XML.
+
+The boxes of a page are then looked up by the name of its image and handed
+out as arrays, so opening a page with thousands of predicted boxes does no
+parsing at all.
+'''
+
+import os
+import sys
+import hashlib
+import threading
+import subprocess
+
+import numpy as np
+
+import gtruth_columns
+from gtruthrect import Rect
+from gtruth_cache import cache_path
+from gtruth_columns import mei_box_table, write_box_table, load_box_table,\
+        KIND_STAFF, KIND_BAR
+from gtruth_meiload import mei_page_name
+from gtruth_profile import span
+
+# Suffix of the cached box tables of prediction corpora
+PREDICTIONS_SUFFIX = '.pred.npz'
+
+# The kind of the boxes of each rectangle mode
+MODE_KINDS = {'STAFF': KIND_STAFF, 'BAR': KIND_BAR}
+
+# Extensions left out of page names, so pages named after their image files
+# are found either way
+IMAGE_EXTENSIONS = ('.tiff', '.tif', '.png', '.jpg')
+
+def prediction_files(directory):
+    '''
+    The MEI files in directory, sorted by name.
+    '''
+    return sorted([os.path.join(directory, name)\
+            for name in os.listdir(directory)\
+            if mei_page_name(name) is not None])
+
+def predictions_key(paths):
+    '''
+    The cache key of the predictions in the files at paths.
+    '''
+    digest = hashlib.sha1()
+    for path in paths:
+        stat = os.stat(path)
+        digest.update('|'.join([os.path.abspath(path), str(stat.st_size),\
+                repr(stat.st_mtime)]).encode('utf-8') + b'\n')
+    return digest.hexdigest()[:24]
+
+def page_name(path):
+    '''
+    The name predictions of the image (or MEI file) at path are found under.
+    '''
+    name = os.path.basename(path)
+    base, extension = os.path.splitext(name)
+    if extension.lower() in IMAGE_EXTENSIONS:
+        return base
+    return name
+
+class PredictionSet:
+    '''
+    The predicted boxes of a corpus, from a box table whose rows are grouped
+    by page, as box_table writes them. suffix is left out of the page names
+    (e.g. '_pred' for page1_pred.mei).
+    '''
+
+    def __init__(self, table, suffix=''):
+        self.table = table
+        names = table['page_name']
+        self.pages = {}
+        for i, name in enumerate(names):
+            name = name.decode('utf-8')
+            if len(suffix) > 0 and name.endswith(suffix):
+                name = name[:-len(suffix)]
+            self.pages.setdefault(page_name(name), i)
+        # The rows of page i are starts[i]:starts[i + 1]
+        self.starts = np.searchsorted(table['page'],\
+                np.arange(len(names) + 1))
+
+    def __len__(self):
+        return len(self.table['page_name'])
+
+    def __contains__(self, imagepath):
+        return page_name(imagepath) in self.pages
+
+    def boxes(self, imagepath, mode):
+        '''
+        The predicted boxes of a rectangle mode ('BAR' or 'STAFF') on the
+        page of imagepath, as an (n, 5) array of number, ulx, uly, lrx, lry.
+        '''
+        i = self.pages.get(page_name(imagepath))
+        if i is None:
+            return np.empty((0, 5), np.int32)
+        rows = slice(self.starts[i], self.starts[i + 1])
+        ofkind = self.table['kind'][rows] == MODE_KINDS[mode]
+        return np.column_stack([self.table[column][rows][ofkind]\
+                for column in ('number', 'ulx', 'uly', 'lrx', 'lry')])
+
+    def rects(self, imagepath, mode):
+        '''
+        The predicted boxes as Rects, e.g. to propose them.
+        '''
+        return [Rect(ulx, uly, lrx - ulx, lry - uly, number)\
+                for number, ulx, uly, lrx, lry\
+                in self.boxes(imagepath, mode).tolist()]
+
+def load_predictions(directory, processes=None, suffix='', spawn=False):
+    '''
+    The PredictionSet of the MEI files in directory, parsed in a pool of
+    processes unless the cache has them already. If spawn is True the pool
+    is started by a new Python process rather than forked from this one.
+    '''
+    paths = prediction_files(directory)
+    path = cache_path(predictions_key(paths), PREDICTIONS_SUFFIX)
+    if not os.path.exists(path):
+        with span('predictions.parse', count=len(paths)):
+            if spawn:
+                _spawn_box_table(path, directory, processes)
+            else:
+                write_box_table(path, mei_box_table(paths, processes))
+    with span('predictions.load'):
+        return PredictionSet(load_box_table(path), suffix)
+
+def _spawn_box_table(path, directory, processes=None):
+    # The command line of gtruth_columns finds the same files in the
+    # directory as prediction_files
+    script = os.path.splitext(os.path.abspath(gtruth_columns.__file__))[0]\
+            + '.py'
+    command = [sys.executable, script, path, directory]
+    if processes is not None:
+        command.extend(['--processes', str(processes)])
+    subprocess.check_call(command)
+
+class PredictionLoader(threading.Thread):
+    '''
+    Loads the predictions in a directory in the background and calls callback
+    with the PredictionSet, or with None if they could not be loaded. The
+    files are parsed by a new process (see load_predictions), so it is safe
+    to start from the GUI.
+    '''
+
+    def __init__(self, directory, callback, processes=None, suffix=''):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.directory = directory
+        self.callback = callback
+        self.processes = processes
+        self.suffix = suffix
+        # the exception raised if the predictions could not be loaded
+        self.error = None
+
+    def run(self):
+        try:
+            predictions = load_predictions(self.directory, self.processes,\
+                    self.suffix, spawn=True)
+        except Exception as err:
+            self.error = err
+            self.callback(None)
+            return
+        self.callback(predictions)
+
+def predictions_from_environment():
+    '''
+    The directory of predictions named by the GTRUTH_PREDICTIONS environment
+    variable and the suffix of their file names (GTRUTH_PREDICTIONS_SUFFIX),
+    or None when it is not set.
+    '''
+    directory = os.environ.get('GTRUTH_PREDICTIONS', '')
+    if not directory:
+        return None
+    return directory, os.environ.get('GTRUTH_PREDICTIONS_SUFFIX', '')
@@ -0,0 +1,348 @@
+'''
+The preprocessing pipeline that turns a scanned page into the onebit image
+the boxes are drawn on.
+
+A pipeline is a list of named stages, each with its parameters, run in order
+on the gamera image:
+
+    greyscale                   convert to greyscale
+    border_removal              mask out the dark scan borders (greyscale)
+    binarize method=otsu        convert to onebit (default, otsu, threshold,
+                                sauvola, niblack, bernsen, djvu, ...)
+    rotation staffline_height=0 correct the skew of the staves (onebit)
+
+The default pipeline is greyscale, binarize, rotation, what the GUI always
+did. Another one is chosen with the GTRUTH_PIPELINE environment variable,
+either the path of a JSON file holding a list of [stage, {params}] pairs or a
+spec such as
+
+    greyscale,border_removal,binarize:method=sauvola:k=0.3,rotation
+
+The pipeline is part of the cache key of the preprocessed image, so changing
+it preprocesses the pages again instead of reusing stale images.
+
+Running this module warms the cache ahead of an annotation session: every
+TIFF image under the given files and directories is preprocessed with the
+pipeline, and its connected components found, in a pool of processes using
+all cores. Pages already in the cache are skipped, and the throughput is
+reported as it goes:
+
+    python gtruth_preprocess.py [--pipeline SPEC] corpusdir page.tiff ...
+'''
+
+from __future__ import division
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+
+import gamera.core
+from gamera.toolkits import musicstaves, border_removal
+
+from gtruth_cache import page_key, cache_path
+from gtruth_ccache import COMPONENTS_SUFFIX, load_or_build_components
+from gtruth_packed import PackedPage, write_packed_image
+from gtruth_profile import span
+
+# Suffix of the cached preprocessed images
+PREPROCESSED_SUFFIX = '.pp.tiff'
+
+# Suffixes of the packed page and summed-area tables kept for a preprocessed
+# image (see gtruth_packed and gtruth_ink)
+PACKED_SUFFIX = '.pbits'
+SAT_SUFFIX = '.inksums.npz'
+
+# Extensions of the page images
+IMAGE_EXTENSIONS = ('.tiff', '.tif')
+
+# Seconds between throughput reports of a batch run
+REPORT_INTERVAL = 10.0
+
+# Bump whenever a stage changes what it computes so that stale images are not
+# reused
+PREPROCESS_VERSION = 1
+
+def _greyscale(image):
+    return image.to_greyscale()
+
+def _border_removal(image, **params):
+    # border_removal returns a onebit mask of the page content; everything
+    # outside it is set to white
+    mask = image.border_removal(**params)
+    return image.mask(mask)
+
+def _binarize(image, method='default', **params):
+    if method == 'default':
+        return image.to_onebit()
+    if method == 'threshold':
+        return image.threshold(params.get('value', 128))
+    # otsu, sauvola, niblack, bernsen, abutaleb, djvu, ... are all gamera
+    # plugins named <method>_threshold
+    return getattr(image, method + '_threshold')(**params)
+
+def _rotation(image, staffline_height=0):
+    return image.correct_rotation(staffline_height)
+
+# The stages a pipeline can use, by name
+STAGES = {
+    'greyscale': _greyscale,
+    'border_removal': _border_removal,
+    'binarize': _binarize,
+    'rotation': _rotation,
+}
+
+DEFAULT_PIPELINE = (('greyscale', {}), ('binarize', {}), ('rotation', {}))
+
+def _parse_value(text):
+    for convert in (int, float):
+        try:
+            return convert(text)
+        except ValueError:
+            pass
+    return text
+
+def parse_pipeline(spec):
+    '''
+    Parse a pipeline spec, stages separated by commas and each stage's
+    parameters by colons, e.g. 'greyscale,binarize:method=sauvola:k=0.3'.
+    '''
+    pipeline = []
+    for stagespec in spec.split(','):
+        fields = stagespec.strip().split(':')
+        params = {}
+        for field in fields[1:]:
+            if '=' not in field:
+                raise ValueError("Bad stage parameter %r" % field)
+            name, value = field.split('=', 1)
+            params[name.strip()] = _parse_value(value.strip())
+        pipeline.append((fields[0].strip(), params))
+    return check_pipeline(pipeline)
+
+def check_pipeline(pipeline):
+    '''
+    Check the stage names of a pipeline and return it as a tuple of
+    (name, params) pairs.
+    '''
+    pipeline = tuple([(name, dict(params)) for name, params in pipeline])
+    for name, params in pipeline:
+        if name not in STAGES:
+            raise ValueError("Unknown preprocessing stage %r" % name)
+    return pipeline
+
+def pipeline_from_spec(spec):
+    '''
+    The pipeline named by spec: a JSON file, a spec string, or the default
+    pipeline if spec is empty.
+    '''
+    if not spec:
+        return DEFAULT_PIPELINE
+    if os.path.exists(spec):
+        with open(spec) as fileobj:
+            return check_pipeline(json.load(fileobj))
+    return parse_pipeline(spec)
+
+def pipeline_from_environment():
+    return pipeline_from_spec(os.environ.get('GTRUTH_PIPELINE'))
+
+def pipeline_key(pipeline):
+    '''
+    A canonical string of the pipeline for cache keys.
+    '''
+    return json.dumps([PREPROCESS_VERSION] + [[name, params]\
+            for name, params in pipeline], sort_keys=True)
+
+def run_pipeline(image, pipeline, page=None):
+    for name, params in pipeline:
+        with span('preprocess.' + name, page=page):
+            image = STAGES[name](image, **params)
+    return image
+
+def preprocessed_cache_path(imagepath, pipeline):
+    return cache_path(page_key(imagepath, pipeline_key(pipeline)),\
+            PREPROCESSED_SUFFIX)
+
+def packed_cache_path(ppimagepath):
+    return cache_path(page_key(ppimagepath), PACKED_SUFFIX)
+
+def sat_cache_path(ppimagepath):
+    return cache_path(page_key(ppimagepath), SAT_SUFFIX)
+
+def ensure_packed(ppimagepath, image=None):
+    '''
+    The path of the packed page of the preprocessed image at ppimagepath,
+    written first if it is missing, from image if given or else from the
+    image loaded from ppimagepath.
+    '''
+    packedpath = packed_cache_path(ppimagepath)
+    if not os.path.exists(packedpath):
+        if image is None:
+            with span('preprocess.load_cached'):
+                image = gamera.core.load_image(ppimagepath)
+        with span('preprocess.save_packed'):
+            write_packed_image(packedpath, image)
+    return packedpath
+
+def preprocess(imagepath, pipeline, load=True):
+    '''
+    Preprocess the image at imagepath, or take it from the cache if it was
+    preprocessed with the same pipeline before, and make sure its packed page
+    is in the cache too. Returns (image, ppimagepath); image is None if load
+    is False and the page was already in the cache.
+    '''
+    page = os.path.basename(imagepath)
+    ppimagepath = preprocessed_cache_path(imagepath, pipeline)
+    if os.path.exists(ppimagepath):
+        image = None
+        if load:
+            with span('preprocess.load_cached', page=page):
+                image = gamera.core.load_image(ppimagepath)
+        ensure_packed(ppimagepath, image)
+        return image, ppimagepath
+
+    # The loaded image is only referenced by run_pipeline, so each stage's
+    # input is freed as soon as the stage is done
+    with span('preprocess.pipeline', page=page):
+        image = run_pipeline(gamera.core.load_image(imagepath), pipeline,\
+                page)
+
+    # written under a temporary name so that an interrupted save is never
+    # taken for a cached image
+    with span('preprocess.save_tiff', page=page):
+        temppath = '%s.%d.tmp' % (ppimagepath, os.getpid())
+        image.save_tiff(temppath)
+        os.rename(temppath, ppimagepath)
+    ensure_packed(ppimagepath, image)
+    return image, ppimagepath
+
+def components_cache_path(ppimagepath):
+    return cache_path(page_key(ppimagepath), COMPONENTS_SUFFIX)
+
+def is_cached(imagepath, pipeline, components=True):
+    '''
+    Whether the page is already preprocessed with the pipeline (and its
+    components found, if components is True).
+    '''
+    ppimagepath = preprocessed_cache_path(imagepath, pipeline)
+    if not os.path.exists(ppimagepath) or\
+            not os.path.exists(packed_cache_path(ppimagepath)):
+        return False
+    return not components or\
+            os.path.exists(components_cache_path(ppimagepath))
+
+def find_images(paths):
+    '''
+    The page images among paths, directories being searched recursively.
+    '''
+    images = []
+    for path in paths:
+        if not os.path.isdir(path):
+            images.append(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            images.extend([os.path.join(dirpath, name)\
+                    for name in sorted(filenames)\
+                    if name.lower().endswith(IMAGE_EXTENSIONS)])
+    return images
+
+def preprocess_page(job):
+    '''
+    Preprocess one page, and find its components if components is True, the
+    same as the GUI does when opening it. Run in the worker processes; errors
+    are reported in the record rather than raised so one bad file does not
+    stop the run.
+    '''
+    imagepath, pipeline, components = job
+    record = {'page': imagepath}
+    start = time.time()
+    try:
+        image, ppimagepath = preprocess(imagepath, pipeline, load=False)
+        record['preprocessed'] = ppimagepath
+        # the components are labelled on the packed page, so the image is
+        # not needed any more
+        image = None
+        if components and\
+                not os.path.exists(components_cache_path(ppimagepath)):
+            page = PackedPage(packed_cache_path(ppimagepath))
+            try:
+                with span('preprocess.components', page=imagepath):
+                    load_or_build_components(page_key(ppimagepath),\
+                            page.ink)
+            finally:
+                page.close()
+    except Exception as err:
+        record['error'] = '%s: %s' % (type(err).__name__, err)
+    record['seconds'] = time.time() - start
+    return record
+
+def preprocess_corpus(imagepaths, pipeline, processes=None, components=True):
+    '''
+    Preprocess all the images in a pool of processes, yielding the record of
+    each page as it is done.
+    '''
+    jobs = [(path, pipeline, components) for path in imagepaths]
+    if len(jobs) == 0:
+        return
+    pool = multiprocessing.Pool(processes, gamera.core.init_gamera)
+    try:
+        for record in pool.imap_unordered(preprocess_page, jobs):
+            yield record
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def warm_cache(paths, pipeline, processes=None, components=True,\
+        out=sys.stderr):
+    '''
+    Preprocess the pages under paths that are not in the cache yet, writing
+    progress and throughput to out. Returns the list of page records.
+    '''
+    images = find_images(paths)
+    pending = [path for path in images\
+            if not is_cached(path, pipeline, components)]
+    out.write("%d pages, %d already cached, %d to preprocess.\n" %\
+            (len(images), len(images) - len(pending), len(pending)))
+
+    records = []
+    start = lastreport = time.time()
+    for record in preprocess_corpus(pending, pipeline, processes, components):
+        records.append(record)
+        if 'error' in record:
+            out.write("error on %s: %s\n" % (record['page'], record['error']))
+        now = time.time()
+        if now - lastreport >= REPORT_INTERVAL:
+            lastreport = now
+            rate = len(records) / (now - start) * 60
+            out.write("%d/%d pages, %.1f pages/min, %.0f min to go\n" %\
+                    (len(records), len(pending), rate,\
+                    (len(pending) - len(records)) / rate))
+
+    elapsed = time.time() - start
+    errors = len([r for r in records if 'error' in r])
+    out.write("Preprocessed %d pages in %.1f s (%.1f pages/min), %d errors.\n"\
+            % (len(records) - errors, elapsed,\
+            len(records) / elapsed * 60 if elapsed > 0 else 0.0, errors))
+    return records
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(\
+            description='Preprocess a corpus of page images into the cache.')
+    parser.add_argument('paths', nargs='+',\
+            help='TIFF images of the pages or directories holding them')
+    parser.add_argument('--pipeline', default=os.environ.get(\
+            'GTRUTH_PIPELINE'), help='pipeline spec or JSON file '\
+            + '(default: GTRUTH_PIPELINE or the default pipeline)')
+    parser.add_argument('--processes', type=int, default=None,\
+            help='number of worker processes (default: all cores)')
+    parser.add_argument('--no-components', dest='components',\
+            action='store_false', help='do not find the connected components')
+    args = parser.parse_args()
+
+    records = warm_cache(args.paths, pipeline_from_spec(args.pipeline),\
+            args.processes, args.components)
+    sys.exit(1 if any(['error' in r for r in records]) else 0)
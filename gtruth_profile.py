@@ -0,0 +1,230 @@
+'''
+Profiling spans for the Ground Truth system.
+
+A span times one stage of work (loading an image, writing the MEI, ...) and
+hands a record of it to a sink. Spans are used either as a context manager:
+
+    with span('open.to_onebit', page=fname):
+        image = image.to_onebit()
+
+or as a decorator:
+
+    @profiled('converter.output_mei')
+    def output_mei(self, path): ...
+
+No sink is installed by default so spans cost next to nothing until profiling
+is switched on, either with set_sink() or by setting the GTRUTH_PROFILE
+environment variable to 'stderr', 'memory' or the path of a JSONL file.
+
+Running this module on one or more JSONL files prints the aggregated cost of
+each stage, which is how batch runs over a corpus are summarised:
+
+    python gtruth_profile.py run1.jsonl run2.jsonl
+'''
+
+import os
+import sys
+import json
+import argparse
+import functools
+import threading
+import timeit
+
+# Highest resolution wall clock available on this platform
+_clock = timeit.default_timer
+
+class StderrSink:
+    '''
+    Writes one human readable line per span to stderr.
+    '''
+
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def emit(self, record):
+        stream = self.stream or sys.stderr
+        stream.write("[gtruth profile] %-32s %10.3f ms\n" %\
+                (record['name'], record['seconds'] * 1000.0))
+
+    def close(self):
+        pass
+
+class JsonlSink:
+    '''
+    Appends one JSON object per span to a file so that runs can be aggregated
+    later.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fileobj = open(path, 'a')
+
+    def emit(self, record):
+        line = json.dumps(record, sort_keys=True)
+        with self.lock:
+            self.fileobj.write(line + '\n')
+            self.fileobj.flush()
+
+    def close(self):
+        with self.lock:
+            self.fileobj.close()
+
+class MemorySink:
+    '''
+    Keeps the records in a list, for inspecting from the interpreter or for
+    reporting at the end of a batch run.
+    '''
+
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+
+    def emit(self, record):
+        with self.lock:
+            self.records.append(record)
+
+    def report(self):
+        return format_report(aggregate(self.records))
+
+    def close(self):
+        pass
+
+# The sink spans are currently reported to, None when profiling is off
+_sink = None
+
+def set_sink(sink):
+    '''
+    Install sink as the destination of all span records and return the one it
+    replaces. Pass None to turn profiling off.
+    '''
+    global _sink
+    old = _sink
+    _sink = sink
+    return old
+
+def get_sink():
+    return _sink
+
+def sink_from_spec(spec):
+    '''
+    Make a sink from a string as found in the GTRUTH_PROFILE environment
+    variable: 'stderr', 'memory' or a path to a JSONL file. Returns None for an
+    empty spec.
+    '''
+    if not spec:
+        return None
+    if spec == 'stderr':
+        return StderrSink()
+    if spec == 'memory':
+        return MemorySink()
+    return JsonlSink(spec)
+
+class span:
+    '''
+    Times the enclosed block and emits a record named name to the current
+    sink. Any keyword arguments are stored in the record, which is useful for
+    telling pages apart in a batch run.
+    '''
+
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+        self.start = None
+
+    def __enter__(self):
+        if _sink is not None:
+            self.start = _clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        sink = _sink
+        if (sink is None) or (self.start is None):
+            return False
+        record = dict(self.fields)
+        record['name'] = self.name
+        record['seconds'] = _clock() - self.start
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        sink.emit(record)
+        return False
+
+def profiled(name=None):
+    '''
+    Decorator that runs the decorated function inside a span. The span is
+    named after the function when name is not given.
+    '''
+    def decorate(func):
+        spanname = name or func.__name__
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _sink is None:
+                return func(*args, **kwargs)
+            with span(spanname):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def aggregate(records):
+    '''
+    Group the records by span name and return a dictionary mapping each name
+    to its count, total, mean, minimum and maximum duration in seconds.
+    '''
+    stats = dict()
+    for record in records:
+        seconds = record['seconds']
+        entry = stats.get(record['name'])
+        if entry is None:
+            stats[record['name']] = {'count': 1, 'total': seconds,\
+                    'min': seconds, 'max': seconds}
+            continue
+        entry['count'] += 1
+        entry['total'] += seconds
+        entry['min'] = min(entry['min'], seconds)
+        entry['max'] = max(entry['max'], seconds)
+    for entry in stats.values():
+        entry['mean'] = entry['total'] / entry['count']
+    return stats
+
+def format_report(stats):
+    '''
+    Return the aggregated statistics as a table sorted by total cost, most
+    expensive stage first.
+    '''
+    lines = ["%-32s %8s %12s %12s %12s %12s" % ('stage', 'count',\
+            'total (s)', 'mean (ms)', 'min (ms)', 'max (ms)')]
+    grandtotal = 0.0
+    for name, entry in sorted(stats.items(),\
+            key=lambda item: item[1]['total'], reverse=True):
+        lines.append("%-32s %8d %12.3f %12.3f %12.3f %12.3f" % (name,\
+                entry['count'], entry['total'], entry['mean'] * 1000.0,\
+                entry['min'] * 1000.0, entry['max'] * 1000.0))
+        grandtotal += entry['total']
+    lines.append("%-32s %8s %12.3f" % ('all stages', '', grandtotal))
+    return '\n'.join(lines)
+
+def load_jsonl(path):
+    '''
+    Read back the records written by a JsonlSink.
+    '''
+    records = []
+    with open(path) as fileobj:
+        for line in fileobj:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    return records
+
+# Honour the environment so that the GUI and batch tools can be profiled
+# without changing any code.
+set_sink(sink_from_spec(os.environ.get('GTRUTH_PROFILE', '')))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(\
+            description='Aggregate per-stage costs from profile JSONL files.')
+    parser.add_argument('files', nargs='+', help='JSONL files to aggregate')
+    args = parser.parse_args()
+    records = []
+    for path in args.files:
+        records.extend(load_jsonl(path))
+    print(format_report(aggregate(records)))
@@ -0,0 +1,141 @@
+'''
+Binary session files for reopening annotated pages quickly.
+
+A session stores everything needed to carry on annotating a page: the image
+paths and metadata, the staff and bar boxes and the text notes. The layout is
+a fixed header followed by fixed size box records, so the file is read by
+memory mapping it and unpacking the records in place, without any XML parsing.
+
+    header      HEADER (see below)
+    picpath     utf-8, the image path without extension
+    pppath      utf-8, the preprocessed image
+    padding     to a multiple of 4 bytes
+    staves      nstaves records of BOX
+    bars        nbars records of BOX
+    notes       utf-8
+
+Writing MEI is unaffected and stays a separate step.
+'''
+
+import os
+import mmap
+import struct
+
+from gtruthrect import Rect, reserve_rect_ids
+
+# The session is kept next to the image, with this extension
+SESSION_EXTENSION = '.gts'
+
+# The preprocessed image saved with a session, so reopening does not have to
+# preprocess again
+PREPROCESSED_EXTENSION = '.pp.tiff'
+
+SESSION_MAGIC = 'GTS1'
+SESSION_VERSION = 1
+
+# magic, version, reserved, width, height, dpi, number of staff boxes, number
+# of bar boxes, length of picpath, length of pppath, length of notes
+HEADER = struct.Struct('<4sHHiiiIIIII')
+
+# id, number, posx, posy, sizex, sizey
+BOX = struct.Struct('<iiffff')
+
+class Session:
+    '''
+    The contents of a session file.
+    '''
+
+    def __init__(self, picpath='', pppath='', width=0, height=0, dpi=72,\
+            staffpanels=None, barpanels=None, notes=u''):
+        self.picpath = picpath
+        self.pppath = pppath
+        self.width = width
+        self.height = height
+        self.dpi = dpi
+        self.staffpanels = staffpanels if staffpanels is not None else []
+        self.barpanels = barpanels if barpanels is not None else []
+        self.notes = notes
+        # when the page was last saved to a corpus store (an ISO 8601 time),
+        # for pages loaded from one
+        self.updated = None
+
+def session_path(picfilename):
+    '''
+    The path of the session for an image whose path, without extension, is
+    picfilename.
+    '''
+    return picfilename + SESSION_EXTENSION
+
+def preprocessed_path(picfilename):
+    return picfilename + PREPROCESSED_EXTENSION
+
+def _encode(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf-8')
+
+def _pack_boxes(rects):
+    return b''.join([BOX.pack(r.id, r.number, r.pos[0], r.pos[1],\
+            r.size[0], r.size[1]) for r in rects])
+
+def save_session(path, session):
+    '''
+    Write session to path. The file is written next to its destination and
+    then renamed over it so an interrupted save leaves the old session intact.
+    '''
+    picpath = _encode(session.picpath)
+    pppath = _encode(session.pppath)
+    notes = _encode(session.notes)
+    header = HEADER.pack(SESSION_MAGIC, SESSION_VERSION, 0,\
+            int(session.width), int(session.height), int(session.dpi),\
+            len(session.staffpanels), len(session.barpanels),\
+            len(picpath), len(pppath), len(notes))
+    strings = picpath + pppath
+    padding = b'\0' * ((-(HEADER.size + len(strings))) % 4)
+    temppath = path + '.tmp'
+    with open(temppath, 'wb') as fileobj:
+        fileobj.write(b''.join([header, strings, padding,\
+                _pack_boxes(session.staffpanels),\
+                _pack_boxes(session.barpanels), notes]))
+    os.rename(temppath, path)
+
+def _unpack_boxes(buf, offset, count):
+    rects = []
+    for i in xrange(count):
+        boxid, num, posx, posy, sizex, sizey = BOX.unpack_from(buf,\
+                offset + i * BOX.size)
+        rects.append(Rect(posx, posy, sizex, sizey, num, boxid=boxid))
+    return rects
+
+def load_session(path):
+    '''
+    Read the session at path. Raises ValueError if it is not a session file.
+    '''
+    with open(path, 'rb') as fileobj:
+        buf = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if len(buf) < HEADER.size:
+            raise ValueError("Not a session file: " + path)
+        magic, version, _, width, height, dpi, nstaves, nbars, piclen,\
+                pplen, noteslen = HEADER.unpack_from(buf, 0)
+        if magic != SESSION_MAGIC:
+            raise ValueError("Not a session file: " + path)
+        if version != SESSION_VERSION:
+            raise ValueError("Unsupported session version %d" % version)
+        offset = HEADER.size
+        picpath = buf[offset:offset + piclen].decode('utf-8')
+        offset += piclen
+        pppath = buf[offset:offset + pplen].decode('utf-8')
+        offset += pplen
+        offset += (-offset) % 4
+        staffpanels = _unpack_boxes(buf, offset, nstaves)
+        offset += nstaves * BOX.size
+        barpanels = _unpack_boxes(buf, offset, nbars)
+        offset += nbars * BOX.size
+        notes = buf[offset:offset + noteslen].decode('utf-8')
+    finally:
+        buf.close()
+    # Boxes drawn from now on must not reuse the ids of the loaded boxes
+    reserve_rect_ids(max([0] + [r.id for r in staffpanels + barpanels]))
+    return Session(picpath, pppath, width, height, dpi, staffpanels,\
+            barpanels, notes)
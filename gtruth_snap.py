@@ -0,0 +1,66 @@
+'''
+Snapping box edges to the ink of the page.
+
+While a box is drawn or resized its edges can be pulled to the nearest ink
+boundary (where the ink inside the box begins or ends) or barline within a
+small radius. The ink counts of the candidate columns and rows are looked up
+in the summed-area tables of an InkIndex (see gtruth_ink), plus the bits of
+less than a block at the box's ends, so each query takes the same short time
+during a drag however large the box is.
+'''
+
+from __future__ import division
+
+import numpy as np
+
+# Columns (rows) at least this full of ink over the box count as a barline
+# (staff line) that edges snap onto
+LINE_FILL = 0.9
+
+def _snap(counts, positions, length, target):
+    '''
+    Pick the position nearest to target among the candidates of a window.
+    counts[i] is the ink count of the column (row) at positions[i] over the
+    span of the box, which is length pixels long. An edge lies between
+    positions[i-1] and positions[i] when one of them is empty and the other is
+    not, and on positions[i] when it is a line.
+    '''
+    inked = counts > 0
+    edges = np.flatnonzero(inked[1:] != inked[:-1]) + 1
+    lines = np.flatnonzero(counts >= LINE_FILL * length)
+    candidates = np.concatenate((positions[edges], positions[lines]))
+    if len(candidates) == 0:
+        return target
+    return candidates[np.argmin(np.abs(candidates - target))]
+
+def snap_x(inkindex, x, uly, lry, radius):
+    '''
+    Snap a vertical edge at x of a box spanning uly to lry to the nearest ink
+    boundary or barline within radius pixels.
+    '''
+    x0, uly, x1, lry = inkindex.clip_box(x - radius, uly, x + radius + 1, lry)
+    if x1 - x0 < 2 or lry - uly < 1:
+        return x
+    counts = inkindex.column_profile(x0, uly, x1, lry)
+    return _snap(counts, np.arange(x0, x1), lry - uly, x)
+
+def snap_y(inkindex, y, ulx, lrx, radius):
+    '''
+    Snap a horizontal edge at y of a box spanning ulx to lrx to the nearest
+    ink boundary or staff line within radius pixels.
+    '''
+    ulx, y0, lrx, y1 = inkindex.clip_box(ulx, y - radius, lrx, y + radius + 1)
+    if y1 - y0 < 2 or lrx - ulx < 1:
+        return y
+    counts = inkindex.row_profile(ulx, y0, lrx, y1)
+    return _snap(counts, np.arange(y0, y1), lrx - ulx, y)
+
+def snap_point(inkindex, point, anchor, radius):
+    '''
+    Snap the moving corner point of a box whose opposite corner is anchor.
+    '''
+    x, y = point
+    ax, ay = anchor
+    snappedx = snap_x(inkindex, x, min(y, ay), max(y, ay), radius)
+    snappedy = snap_y(inkindex, y, min(x, ax), max(x, ax), radius)
+    return (float(snappedx), float(snappedy))
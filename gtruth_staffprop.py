@@ -0,0 +1,143 @@
+'''
+Automatic proposals of staff boxes.
+
+A musicstaves staff finder is run on the preprocessed (onebit, deskewed) page.
+The staves it finds are grouped into systems by the vertical gaps between
+them, and each system becomes a candidate staff box the user can accept or
+reject. Finding staves takes a while, so it runs in a background thread and
+its results are cached per preprocessed image, so per page and pipeline.
+'''
+
+from __future__ import division
+import threading
+
+import gamera.core
+from gamera.toolkits import musicstaves
+
+from gtruthrect import Rect
+from gtruth_cache import page_key, load_json, save_json
+from gtruth_profile import span
+
+# Suffix of the cached proposals
+STAFF_CACHE_SUFFIX = '.staves.json'
+
+class StaffProposalParams:
+    '''
+    Parameters of the staff proposals.
+    systemgap: staves closer than this many staff heights belong to the same
+    system.
+    margin: how many staff spaces the boxes extend above and below the outer
+    staff lines, so that the bars drawn inside them (ledger lines and all) fit.
+    '''
+
+    def __init__(self, systemgap=1.2, margin=3.0, numlines=0):
+        self.systemgap = systemgap
+        self.margin = margin
+        # number of lines per staff, 0 lets the staff finder decide
+        self.numlines = numlines
+
+    def key(self):
+        return ('staves', self.systemgap, self.margin, self.numlines)
+
+def find_staves(image, numlines=0):
+    '''
+    Find the staves on a onebit image. Returns a list of (ulx, uly, lrx, lry,
+    staffspace) for each staff, top to bottom.
+    '''
+    with span('staffprop.find_staves'):
+        finder = musicstaves.StaffFinder_miyao(image)
+        finder.find_staves(num_lines=numlines)
+        staves = finder.get_average()
+
+    found = []
+    for staff in staves:
+        if len(staff) == 0:
+            continue
+        top = min([line.average_y for line in staff])
+        bottom = max([line.average_y for line in staff])
+        left = min([line.left_x for line in staff])
+        right = max([line.right_x for line in staff])
+        if len(staff) > 1:
+            staffspace = (bottom - top) / (len(staff) - 1)
+        else:
+            staffspace = 0
+        found.append((left, top, right, bottom, staffspace))
+    found.sort(key=lambda s: s[1])
+    return found
+
+def group_systems(staves, params):
+    '''
+    Group the staves into systems and return one box (ulx, uly, lrx, lry) per
+    system. Staves whose gap is smaller than params.systemgap times the staff
+    height are put in the same system.
+    '''
+    systems = []
+    current = None
+    for ulx, uly, lrx, lry, staffspace in staves:
+        height = lry - uly
+        margin = params.margin * staffspace
+        box = [ulx, uly - margin, lrx, lry + margin]
+        if current is not None and\
+                (uly - current['bottom']) < params.systemgap * height:
+            # Continue the current system
+            cbox = current['box']
+            current['box'] = [min(cbox[0], box[0]), cbox[1],\
+                    max(cbox[2], box[2]), box[3]]
+            current['bottom'] = lry
+            continue
+        current = {'box': box, 'bottom': lry}
+        systems.append(current)
+    return [tuple(s['box']) for s in systems]
+
+def propose_staff_boxes(image, params):
+    '''
+    The proposed staff boxes of a onebit image, as (ulx, uly, lrx, lry).
+    The boxes are clipped to the image.
+    '''
+    width, height = image.ncols, image.nrows
+    boxes = group_systems(find_staves(image, params.numlines), params)
+    return [(max(0, b[0]), max(0, b[1]), min(width - 1, b[2]),\
+            min(height - 1, b[3])) for b in boxes]
+
+def boxes_to_rects(boxes):
+    return [Rect(ulx, uly, lrx - ulx, lry - uly)\
+            for ulx, uly, lrx, lry in boxes]
+
+class StaffProposer(threading.Thread):
+    '''
+    Computes the staff proposals of a page in the background and calls
+    callback with the list of proposed Rects when done (or with None if it
+    failed). The GUI should pass a callback that hands the result to the GUI
+    thread, e.g. with wx.CallAfter.
+    pppath is the path of the preprocessed image the staves are found on,
+    whose cache key depends on the preprocessing pipeline, so the proposals
+    are cached under it. If image is None the preprocessed image is loaded
+    from pppath, in the background as well.
+    '''
+
+    def __init__(self, pppath, callback, params=None, image=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.image = image
+        self.pppath = pppath
+        self.callback = callback
+        self.params = params if params is not None else StaffProposalParams()
+        # the exception raised if the proposals could not be computed
+        self.error = None
+
+    def run(self):
+        try:
+            key = page_key(self.pppath, *self.params.key())
+            boxes = load_json(key, STAFF_CACHE_SUFFIX)
+            if boxes is None:
+                image = self.image
+                if image is None:
+                    with span('staffprop.load_image'):
+                        image = gamera.core.load_image(self.pppath)
+                boxes = propose_staff_boxes(image, self.params)
+                save_json(key, STAFF_CACHE_SUFFIX, boxes)
+        except Exception as err:
+            self.error = err
+            self.callback(None)
+            return
+        self.callback(boxes_to_rects(boxes))
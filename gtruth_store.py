@@ -0,0 +1,403 @@
+'''
+SQLite store for the annotations of a whole corpus.
+
+Each page's image metadata, staff boxes, bar boxes and notes are kept in their
+own tables, indexed by page and by geometry, so questions about the whole
+corpus are answered by a single query instead of reparsing every .mei and .txt
+file.
+
+The GUI uses the store when the GTRUTH_STORE environment variable names a
+database file. Running this module manages a store from the command line:
+
+    python gtruth_store.py corpus.db import page1.mei page2.mei ...
+    python gtruth_store.py corpus.db export outdir [--compress gzip]
+    python gtruth_store.py corpus.db export-source book.mei
+    python gtruth_store.py corpus.db stats
+
+Exporting keeps a manifest in the output directory with a hash of what each
+page's files were made from (image metadata, boxes, notes and export
+options), so exporting again only rewrites the pages that changed.
+'''
+
+from __future__ import division
+import os
+import sys
+import json
+import hashlib
+import sqlite3
+import argparse
+import datetime
+
+import gtruth_meicreate
+from gtruthrect import Rect, build_staff_hierarchy
+from gtruth_session import Session
+from gtruth_meiload import read_mei_page
+from gtruth_cache import atomic_write
+from gtruth_compress import extension_of
+from gtruth_profile import span
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pages (
+    id INTEGER PRIMARY KEY,
+    picpath TEXT NOT NULL UNIQUE,
+    width INTEGER,
+    height INTEGER,
+    dpi INTEGER,
+    annotator TEXT,
+    updated TEXT
+);
+CREATE TABLE IF NOT EXISTS staff_boxes (
+    page_id INTEGER NOT NULL REFERENCES pages(id) ON DELETE CASCADE,
+    number INTEGER,
+    ulx REAL, uly REAL, lrx REAL, lry REAL
+);
+CREATE TABLE IF NOT EXISTS bar_boxes (
+    page_id INTEGER NOT NULL REFERENCES pages(id) ON DELETE CASCADE,
+    number INTEGER,
+    ulx REAL, uly REAL, lrx REAL, lry REAL
+);
+CREATE TABLE IF NOT EXISTS notes (
+    page_id INTEGER PRIMARY KEY REFERENCES pages(id) ON DELETE CASCADE,
+    text TEXT
+);
+CREATE INDEX IF NOT EXISTS staff_boxes_page ON staff_boxes (page_id);
+CREATE INDEX IF NOT EXISTS staff_boxes_geometry
+    ON staff_boxes (ulx, uly, lrx, lry);
+CREATE INDEX IF NOT EXISTS bar_boxes_page ON bar_boxes (page_id, number);
+CREATE INDEX IF NOT EXISTS bar_boxes_geometry
+    ON bar_boxes (ulx, uly, lrx, lry);
+'''
+
+# The box tables for each rectangle mode
+BOX_TABLES = {'STAFF': 'staff_boxes', 'BAR': 'bar_boxes'}
+
+# The manifest of an export directory
+MANIFEST_NAME = 'manifest.json'
+
+# Bump whenever the exported files change for the same page, so that every
+# page is exported again
+EXPORT_VERSION = 1
+
+def _box_rows(page_id, rects):
+    for r in rects:
+        yield (page_id, r.number, r.pos[0], r.pos[1],\
+                r.pos[0] + r.size[0], r.pos[1] + r.size[1])
+
+class AnnotationStore:
+    '''
+    A corpus of annotated pages stored in the SQLite database at path.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA foreign_keys = ON')
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def save_page(self, session, annotator=None):
+        '''
+        Store the page held in session (see gtruth_session.Session), replacing
+        what was stored for it before.
+        '''
+        self.save_pages([session], annotator)
+
+    def save_pages(self, sessions, annotator=None):
+        '''
+        Store many pages in one transaction, which is much faster than saving
+        them one by one.
+        '''
+        now = datetime.datetime.now().isoformat()
+        with span('store.save_pages', count=len(sessions)):
+            with self.conn:
+                for session in sessions:
+                    self.conn.execute('DELETE FROM pages WHERE picpath = ?',\
+                            (session.picpath,))
+                    cursor = self.conn.execute('INSERT INTO pages '\
+                            + '(picpath, width, height, dpi, annotator, '\
+                            + 'updated) VALUES (?, ?, ?, ?, ?, ?)',\
+                            (session.picpath, session.width, session.height,\
+                            session.dpi, annotator, now))
+                    page_id = cursor.lastrowid
+                    self.conn.executemany('INSERT INTO staff_boxes VALUES '\
+                            + '(?, ?, ?, ?, ?, ?)',\
+                            _box_rows(page_id, session.staffpanels))
+                    self.conn.executemany('INSERT INTO bar_boxes VALUES '\
+                            + '(?, ?, ?, ?, ?, ?)',\
+                            _box_rows(page_id, session.barpanels))
+                    self.conn.execute('INSERT INTO notes VALUES (?, ?)',\
+                            (page_id, session.notes))
+
+    def load_page(self, picpath):
+        '''
+        Return the stored page as a Session, or None if it is not stored.
+        '''
+        row = self.conn.execute('SELECT id, width, height, dpi, updated '\
+                + 'FROM pages WHERE picpath = ?', (picpath,)).fetchone()
+        if row is None:
+            return None
+        page_id, width, height, dpi, updated = row
+        session = Session(picpath, '', width, height, dpi)
+        session.updated = updated
+        for kind, panels in (('STAFF', session.staffpanels),\
+                ('BAR', session.barpanels)):
+            for number, ulx, uly, lrx, lry in self.conn.execute(\
+                    'SELECT number, ulx, uly, lrx, lry FROM %s '\
+                    % BOX_TABLES[kind] + 'WHERE page_id = ? ORDER BY rowid',\
+                    (page_id,)):
+                panels.append(Rect(ulx, uly, lrx - ulx, lry - uly, number))
+        note = self.conn.execute('SELECT text FROM notes WHERE page_id = ?',\
+                (page_id,)).fetchone()
+        if note is not None and note[0] is not None:
+            session.notes = note[0]
+        return session
+
+    def last_updated(self):
+        '''
+        When a page was last saved to the store (an ISO 8601 time), or None
+        if it is empty.
+        '''
+        return self.conn.execute('SELECT MAX(updated) FROM pages')\
+                .fetchone()[0]
+
+    def pages(self):
+        '''
+        The image paths of all stored pages.
+        '''
+        return [row[0] for row in\
+                self.conn.execute('SELECT picpath FROM pages ORDER BY picpath')]
+
+    def boxes_in_region(self, kind, ulx, uly, lrx, lry):
+        '''
+        All the boxes of kind ('BAR' or 'STAFF') in the corpus that lie
+        entirely within the region, as (picpath, number, ulx, uly, lrx, lry).
+        '''
+        return self.conn.execute('SELECT p.picpath, b.number, b.ulx, b.uly, '\
+                + 'b.lrx, b.lry FROM %s b JOIN pages p ON p.id = b.page_id '\
+                % BOX_TABLES[kind] + 'WHERE b.ulx >= ? AND b.uly >= ? AND '\
+                + 'b.lrx <= ? AND b.lry <= ?', (ulx, uly, lrx, lry)).fetchall()
+
+    def statistics(self):
+        '''
+        Corpus wide counts and mean bar box size, computed in one query.
+        '''
+        row = self.conn.execute('''
+            SELECT (SELECT COUNT(*) FROM pages),
+                   (SELECT COUNT(*) FROM staff_boxes),
+                   COUNT(*), AVG(lrx - ulx), AVG(lry - uly),
+                   (SELECT COUNT(*) FROM notes WHERE text != '')
+            FROM bar_boxes''').fetchone()
+        return dict(zip(('pages', 'staff_boxes', 'bar_boxes',\
+                'mean_bar_width', 'mean_bar_height', 'pages_with_notes'), row))
+
+    def bar_counts(self):
+        '''
+        Number of bar boxes on each page, as (picpath, count) pairs.
+        '''
+        return self.conn.execute('SELECT p.picpath, COUNT(b.page_id) FROM '\
+                + 'pages p LEFT JOIN bar_boxes b ON b.page_id = p.id '\
+                + 'GROUP BY p.id ORDER BY p.picpath').fetchall()
+
+def store_from_environment():
+    '''
+    Open the store named by the GTRUTH_STORE environment variable, or return
+    None when it is not set.
+    '''
+    path = os.environ.get('GTRUTH_STORE', '')
+    if not path:
+        return None
+    return AnnotationStore(path)
+
+def mei_to_session(meipath):
+    '''
+    Read an MEI file written by the Ground Truth system, and the notes in the
+    .txt file next to it, into a Session.
+    '''
+    page = read_mei_page(meipath)
+    session = Session(page.picpath, '', page.width, page.height, page.dpi)
+    session.barpanels = [Rect(ulx, uly, lrx - ulx, lry - uly, n)\
+            for n, ulx, uly, lrx, lry in page.bars]
+    session.staffpanels = [Rect(ulx, uly, lrx - ulx, lry - uly, n)\
+            for n, ulx, uly, lrx, lry in page.staves]
+    txtpath = meipath[:meipath.rfind('.mei')] + '.txt'
+    if os.path.exists(txtpath):
+        with open(txtpath) as fileobj:
+            session.notes = fileobj.read().decode('utf-8')
+    return session
+
+def export_date(updated):
+    '''
+    The date written in the header of exported MEI: the day of updated, when
+    the pages were last saved to the store, so exporting unchanged pages
+    again writes the same files. None (today) if updated is not known.
+    '''
+    if not updated:
+        return None
+    return updated[:len('YYYY-MM-DD')]
+
+def export_page_mei(session, outpath, shortids=False):
+    '''
+    Write the MEI for a stored page.
+    '''
+    staff_bb = build_staff_hierarchy(session.staffpanels, session.barpanels)
+    converter = gtruth_meicreate.GroundTruthBarlineDataConverter(staff_bb,\
+            session.barpanels, shortids=shortids,\
+            date=export_date(session.updated))
+    converter.bardata_to_mei(str(session.picpath), session.width,\
+            session.height, session.dpi)
+    converter.output_mei(outpath)
+    txtpath = outpath[:outpath.rfind('.mei')] + '.txt'
+    atomic_write(txtpath, session.notes.encode('utf-8'))
+
+def page_digest(session, shortids=False, compression=None):
+    '''
+    A hash of everything the exported files of a page are made from,
+    including how the MEI is compressed.
+    '''
+    digest = hashlib.sha1()
+    digest.update(repr((EXPORT_VERSION, shortids, compression,\
+            session.picpath, session.width, session.height, session.dpi,\
+            export_date(session.updated))))
+    for rects in (session.staffpanels, session.barpanels):
+        digest.update(repr([(r.number, r.pos[0], r.pos[1], r.size[0],\
+                r.size[1]) for r in rects]))
+    digest.update(session.notes.encode('utf-8'))
+    return digest.hexdigest()
+
+def read_manifest(outdir):
+    path = os.path.join(outdir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as fileobj:
+            return json.load(fileobj)
+    except ValueError:
+        return {}
+
+def export_names(picpaths):
+    '''
+    The names the pages at picpaths are exported under, by path: their paths
+    relative to the deepest directory holding them all, so that pages of the
+    same name in different directories do not overwrite each other.
+    '''
+    parts = dict([(picpath, os.path.abspath(picpath).split(os.sep))\
+            for picpath in picpaths])
+    common = None
+    for path in parts.values():
+        directory = path[:-1]
+        if common is None:
+            common = directory
+            continue
+        n = 0
+        while n < min(len(common), len(directory)) and\
+                common[n] == directory[n]:
+            n += 1
+        common = common[:n]
+    return dict([(picpath, '/'.join(path[len(common):]))\
+            for picpath, path in parts.items()])
+
+def export_pages(store, outdir, shortids=False, force=False,\
+        compression=None):
+    '''
+    Export every stored page to outdir, skipping the pages whose files are
+    up to date according to the manifest (unless force is True). The files
+    are named as export_names gives, in subdirectories of outdir where the
+    pages are in subdirectories. The MEI files are compressed if compression
+    is 'gzip' or 'zstd'. Returns the number of pages exported and skipped.
+    '''
+    manifest = read_manifest(outdir)
+    exported = skipped = 0
+    picpaths = store.pages()
+    exportnames = export_names(picpaths)
+    names = set()
+    try:
+        for picpath in picpaths:
+            name = exportnames[picpath]
+            names.add(name)
+            outpath = os.path.join(outdir, *(name + '.mei' +\
+                    extension_of(compression)).split('/'))
+            if not os.path.isdir(os.path.dirname(outpath)):
+                os.makedirs(os.path.dirname(outpath))
+            session = store.load_page(picpath)
+            digest = page_digest(session, shortids, compression)
+            if not force and manifest.get(name) == digest and\
+                    os.path.exists(outpath):
+                skipped += 1
+                continue
+            with span('store.export_page', page=name):
+                export_page_mei(session, outpath, shortids)
+            manifest[name] = digest
+            exported += 1
+        # Forget the pages that are not in the store any more
+        manifest = dict([(name, digest) for name, digest\
+                in manifest.items() if name in names])
+    finally:
+        # Written even if the export stopped half way, so the pages done
+        # so far are not exported again
+        atomic_write(os.path.join(outdir, MANIFEST_NAME),\
+                json.dumps(manifest, indent=1, sort_keys=True), 'w')
+    return exported, skipped
+
+def export_source(store, outpath, shortids=False):
+    '''
+    Write every stored page, in the order of their image paths, as one MEI
+    document with a surface for each page (compressed if outpath ends in .gz
+    or .zst). The notes are not part of it. The header is dated the last
+    day a page was saved to the store.
+    '''
+    date = export_date(store.last_updated())
+    with gtruth_meicreate.MultiPageMeiWriter(outpath, shortids, date)\
+            as writer:
+        for picpath in store.pages():
+            session = store.load_page(picpath)
+            writer.add_page(build_staff_hierarchy(session.staffpanels,\
+                    session.barpanels), session.barpanels,\
+                    str(session.picpath), session.width, session.height,\
+                    session.dpi)
+    return writer.npages
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(\
+            description='Manage a corpus annotation store.')
+    parser.add_argument('store', help='SQLite database file')
+    subparsers = parser.add_subparsers(dest='command')
+    importparser = subparsers.add_parser('import',\
+            help='import .mei files (and their .txt notes)')
+    importparser.add_argument('files', nargs='+')
+    importparser.add_argument('--annotator', default=None)
+    exportparser = subparsers.add_parser('export',\
+            help='write an .mei and .txt file for every stored page')
+    exportparser.add_argument('outdir')
+    exportparser.add_argument('--short-ids', action='store_true',\
+            help='use short element ids (m12 rather than page-measure-12)')
+    exportparser.add_argument('--force', action='store_true',\
+            help='export every page, even those that did not change')
+    exportparser.add_argument('--compress', choices=['gzip', 'zstd'],\
+            default=None, help='compress the MEI files')
+    sourceparser = subparsers.add_parser('export-source',\
+            help='write every stored page into one multi-page .mei file')
+    sourceparser.add_argument('outpath')
+    sourceparser.add_argument('--short-ids', action='store_true',\
+            help='use short element ids (p1-m12 rather than page-measure-12)')
+    subparsers.add_parser('stats', help='print corpus statistics')
+    args = parser.parse_args()
+
+    store = AnnotationStore(args.store)
+    if args.command == 'import':
+        store.save_pages([mei_to_session(f) for f in args.files],\
+                args.annotator)
+        sys.stderr.write("Imported %d pages.\n" % len(args.files))
+    elif args.command == 'export':
+        exported, skipped = export_pages(store, args.outdir, args.short_ids,\
+                args.force, args.compress)
+        sys.stderr.write("Exported %d pages, %d unchanged.\n" %\
+                (exported, skipped))
+    elif args.command == 'export-source':
+        count = export_source(store, args.outpath, args.short_ids)
+        sys.stderr.write("Exported %d pages to %s.\n" % (count, args.outpath))
+    elif args.command == 'stats':
+        for key, value in sorted(store.statistics().items()):
+            print("%-20s %s" % (key, value))
+    store.close()
@@ -0,0 +1,145 @@
+'''
+Tightening boxes to the ink inside them.
+
+Each box is shrunk to the bounding box of the ink pixels it contains, for all
+the boxes at once. The ink counts come from the summed-area tables of an
+InkIndex (see gtruth_ink). Each edge of a box is first looked for in the
+block of lines (columns or rows) at that end of the box; if that block holds
+no ink, the first inked block is found by bisection on the counts between
+block boundaries, which are table lookups only, and the edge is then read off
+that block's line counts. A batch of n boxes takes about log2(page size /
+BLOCK_SIZE) array passes of length n plus a few of n blocks, rather than a
+scan of each box's pixels.
+'''
+
+import numpy as np
+
+from gtruth_profile import span
+
+def _bisect(lo, hi, test):
+    '''
+    For each element, the smallest k in (lo, hi] for which test(k) is True,
+    assuming test is monotonic and test(hi) is True.
+    '''
+    while True:
+        active = (hi - lo) > 1
+        if not active.any():
+            return hi
+        mid = (lo + hi) // 2
+        ok = test(mid)
+        hi = np.where(active & ok, mid, hi)
+        lo = np.where(active & ~ok, mid, lo)
+
+def _low_edges(lo, hi, block, windows, between):
+    '''
+    The first inked line from lo to hi (exclusive) of each box, and whether
+    the box holds any ink at all. windows(which, starts) gives the counts of
+    the block of lines from each start of the boxes at the indices which, and
+    between(which, a, b) their counts from the block boundary a to the
+    boundary b.
+    '''
+    offsets = np.arange(block)
+    ends = np.minimum((lo // block + 1) * block, hi)
+    counts = windows(np.arange(len(lo)), lo) *\
+            (offsets < (ends - lo)[:, np.newaxis])
+    edges = lo + np.argmax(counts > 0, axis=1)
+    inked = counts.max(axis=1) > 0
+    # The blocks of whole lines past the first one, then the lines of less
+    # than a block at the end
+    rest = np.flatnonzero(~inked & (ends < hi))
+    first, last = ends[rest], hi[rest] // block * block
+    inblocks = between(rest, first, last) > 0
+    k = _bisect(first // block, last // block,\
+            lambda k: between(rest, first, k * block) > 0)
+    starts = np.where(inblocks, (k - 1) * block, last)
+    counts = windows(rest, starts) *\
+            (offsets < (hi[rest] - starts)[:, np.newaxis])
+    edges[rest] = starts + np.argmax(counts > 0, axis=1)
+    inked[rest] = counts.max(axis=1) > 0
+    return edges, inked
+
+def _high_edges(lo, hi, block, windows, between):
+    '''
+    One past the last inked line from lo to hi (exclusive) of boxes holding
+    ink, see _low_edges.
+    '''
+    offsets = np.arange(block)
+    starts = np.maximum((hi - 1) // block * block, lo)
+    counts = windows(np.arange(len(lo)), starts) *\
+            (offsets < (hi - starts)[:, np.newaxis])
+    edges = starts + block - np.argmax(counts[:, ::-1] > 0, axis=1)
+    rest = np.flatnonzero(counts.max(axis=1) == 0)
+    if len(rest) == 0:
+        return edges
+    # The last block of lines before starts[rest] that holds ink, counting
+    # the blocks back from there
+    end, lo = starts[rest], lo[rest]
+    firstblock = lo // block
+    d = _bisect(np.zeros_like(end), end // block - firstblock,\
+            lambda d: (end // block - d == firstblock) |\
+            (between(rest, np.maximum((end // block - d) * block, lo),\
+            end) > 0))
+    starts = (end // block - d) * block
+    counts = windows(rest, starts) *\
+            (offsets >= (lo - starts)[:, np.newaxis])
+    edges[rest] = starts + block - np.argmax(counts[:, ::-1] > 0, axis=1)
+    return edges
+
+def tighten_boxes(inkindex, boxes):
+    '''
+    Tighten an (n, 4) array of boxes (ulx, uly, lrx, lry). Returns the
+    tightened boxes as a float array of whole pixels; boxes without any ink
+    are returned exactly as they were given, only clipped to the page.
+    '''
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    if len(boxes) == 0:
+        return np.zeros((0, 4), dtype=np.float64)
+    ulx, uly, lrx, lry = inkindex.clip_boxes(boxes)
+
+    result = boxes.copy()
+    result[:, 0::2] = np.clip(result[:, 0::2], 0, inkindex.width)
+    result[:, 1::2] = np.clip(result[:, 1::2], 0, inkindex.height)
+    block = inkindex.block
+
+    columns = lambda which, starts: inkindex.column_counts(starts,\
+            uly[which], lry[which])
+    between_columns = lambda which, x0, x1: inkindex.count_x_aligned(x0,\
+            uly[which], x1, lry[which])
+    left, inked = _low_edges(ulx, lrx, block, columns, between_columns)
+    ulx, uly, lrx, lry = ulx[inked], uly[inked], lrx[inked], lry[inked]
+    left = left[inked]
+    right = _high_edges(ulx, lrx, block, columns, between_columns)
+
+    rows = lambda which, starts: inkindex.row_counts(starts, left[which],\
+            right[which])
+    between_rows = lambda which, y0, y1: inkindex.count_y_aligned(\
+            left[which], y0, right[which], y1)
+    top = _low_edges(uly, lry, block, rows, between_rows)[0]
+    bottom = _high_edges(uly, lry, block, rows, between_rows)
+
+    result[inked] = np.column_stack((left, top, right, bottom))
+    return result
+
+def tighten_rects(inkindex, rects):
+    '''
+    Tighten Rects in place. Returns the list of (rect, oldbox) for the Rects
+    that changed, oldbox being the (posx, posy, sizex, sizey) box before.
+    '''
+    if len(rects) == 0:
+        return []
+    boxes = np.array([(r.pos[0], r.pos[1], r.pos[0] + r.size[0],\
+            r.pos[1] + r.size[1]) for r in rects])
+    with span('tighten.boxes', count=len(rects)):
+        tight = tighten_boxes(inkindex, boxes)
+    changed = []
+    for rect, old, new in zip(rects, boxes.tolist(), tight.tolist()):
+        # Compared as corners, as the sizes computed back from them may be
+        # off in the last bit
+        if new == old:
+            continue
+        ulx, uly, lrx, lry = new
+        oldbox = rect.GetBox()
+        rect.SetPosition((ulx, uly))
+        rect.SetSize((lrx - ulx, lry - uly))
+        changed.append((rect, oldbox))
+    return changed
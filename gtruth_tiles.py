@@ -0,0 +1,117 @@
+'''
+Tiled display of a packed onebit page.
+
+Instead of decoding the whole preprocessed page into one full colour
+wx.Bitmap, the page stays packed (see gtruth_packed) and only the tiles in
+view are expanded into bitmaps when they are painted. The expanded tiles are
+kept in a small LRU cache, so scrolling back and forth does not expand them
+again, and the memory used for display is bounded by the size of the cache
+rather than the size of the page.
+
+When zoomed out, tiles are drawn from a level of detail where each pixel is
+the mean of 2**level by 2**level page pixels, as 8-bit grey, rather than
+expanding every page pixel only for the DC to shrink it. The means come from
+the summed-area tables of the page's InkIndex once it is built, at the
+levels whose pixels are whole blocks, and otherwise from the bits of the
+packed page, counted a byte at a time when a tile pixel covers whole bytes.
+'''
+
+from __future__ import division
+import math
+import collections
+
+import numpy as np
+import wx
+
+# Size in pixels of the (square) tiles, at every level
+TILE_SIZE = 512
+
+# Number of expanded tiles kept; a tile takes about 1MB
+MAX_TILES = 32
+
+# Coarsest level of detail
+MAX_LEVEL = 5
+
+def level_for_scale(scale):
+    '''
+    The level of detail to draw at a zoom of scale, the coarsest one that
+    still has at least one tile pixel per screen pixel.
+    '''
+    if scale >= 1.0:
+        return 0
+    return min(int(math.floor(math.log(1.0 / scale, 2))), MAX_LEVEL)
+
+def tile_box(page, level, tx, ty):
+    '''
+    The region (ulx, uly, lrx, lry) of the page covered by a tile.
+    '''
+    span = TILE_SIZE * 2 ** level
+    return (tx * span, ty * span, min((tx + 1) * span, page.width),\
+            min((ty + 1) * span, page.height))
+
+def tile_pixels(page, level, tx, ty, inkindex=None):
+    '''
+    The grey levels of a tile as a uint8 array, ink black and paper white.
+    '''
+    ulx, uly, lrx, lry = tile_box(page, level, tx, ty)
+    if level == 0:
+        return np.where(page.region(ulx, uly, lrx, lry), 0, 255)\
+                .astype(np.uint8)
+    factor = 2 ** level
+    xs = np.minimum(np.arange(ulx, lrx + factor, factor), lrx)
+    ys = np.minimum(np.arange(uly, lry + factor, factor), lry)
+    counts = None
+    if inkindex is not None:
+        counts = inkindex.grid_counts(xs, ys)
+    if counts is None and factor % 8 == 0:
+        counts = page.cell_counts(xs, ys)
+    if counts is None:
+        ink = page.region(ulx, uly, lrx, lry)
+        counts = np.add.reduceat(np.add.reduceat(ink, ys[:-1] - uly, axis=0,\
+                dtype=np.int64), xs[:-1] - ulx, axis=1)
+    areas = np.outer(np.diff(ys), np.diff(xs))
+    return (255 - (255 * counts.astype(np.int64)) // areas).astype(np.uint8)
+
+def pixels_to_bitmap(pixels):
+    height, width = pixels.shape
+    rgb = np.repeat(pixels[:, :, np.newaxis], 3, axis=2)
+    return wx.BitmapFromBuffer(width, height, rgb.tostring())
+
+class TileCache:
+    '''
+    The expanded tiles of a page, at most maxtiles of them, the least recently
+    drawn dropped first. inkindex is set once the page's InkIndex is built.
+    '''
+
+    def __init__(self, page, maxtiles=MAX_TILES):
+        self.page = page
+        self.maxtiles = maxtiles
+        self.inkindex = None
+        self.tiles = collections.OrderedDict()
+
+    def GetTile(self, level, tx, ty):
+        key = (level, tx, ty)
+        bmp = self.tiles.pop(key, None)
+        if bmp is None:
+            bmp = pixels_to_bitmap(tile_pixels(self.page, level, tx, ty,\
+                    self.inkindex))
+            while len(self.tiles) >= self.maxtiles:
+                self.tiles.popitem(last=False)
+        self.tiles[key] = bmp
+        return bmp
+
+    def VisibleTiles(self, level, ulx, uly, lrx, lry):
+        '''
+        The (tx, ty, bitmap) of the tiles of a level overlapping the region of
+        the page (ulx, uly, lrx, lry).
+        '''
+        span = TILE_SIZE * 2 ** level
+        ulx, uly, lrx, lry = self.page.clip_box(ulx, uly, lrx, lry)
+        tiles = []
+        for ty in xrange(uly // span, (lry + span - 1) // span):
+            for tx in xrange(ulx // span, (lrx + span - 1) // span):
+                tiles.append((tx, ty, self.GetTile(level, tx, ty)))
+        return tiles
+
+    def Clear(self):
+        self.tiles.clear()
@@ -0,0 +1,206 @@
+'''
+Undo and redo of box edits for the Ground Truth system.
+
+Every edit is recorded as a small delta rather than a copy of the panel lists:
+
+    ('create', kind, boxid, geom)
+    ('resize', kind, boxid, oldgeom, newgeom)
+    ('delete', kind, boxid, geom, index)
+    ('clear',  kind, ((boxid, geom), ...))
+    ('add',    kind, ((boxid, geom), ...))
+    ('reshape', kind, ((boxid, oldgeom, newgeom), ...))
+
+kind is the rectangle mode the box belongs to ('BAR' or 'STAFF'), boxid is the
+Rect's id and geom is its (posx, posy, sizex, sizey) box. Undoing a clear
+rebuilds the whole list in one pass, and adding or resizing many boxes at
+once (e.g. accepting proposals or tightening a page) is undone in one pass as
+well.
+'''
+
+from gtruthrect import Rect
+
+# Edits whose third element is a tuple of (boxid, geom) rather than one box
+BULK_EDITS = ('clear', 'restore', 'add', 'remove', 'reshape')
+
+class EditLog:
+    '''
+    Records box edits and undoes or redoes them on the panel lists.
+    getpanels is a function returning the list of Rects for a kind.
+    At most limit edits are kept for undoing, None keeps them all.
+    '''
+
+    def __init__(self, getpanels, limit=None):
+        self.getpanels = getpanels
+        self.limit = limit
+        self.undostack = []
+        self.redostack = []
+        # functions called with every delta recorded, undone or redone
+        self.listeners = []
+        # counts the changes to the boxes (edits, undos, redos and resets),
+        # for caches of anything computed from them
+        self.version = 0
+
+    ### Recording methods ###
+
+    def record_create(self, kind, rect):
+        self._push(('create', kind, rect.id, rect.GetBox()))
+
+    def record_resize(self, kind, rect, oldgeom):
+        newgeom = rect.GetBox()
+        if tuple(oldgeom) == newgeom:
+            # Nothing changed, so there is nothing to undo
+            return
+        self._push(('resize', kind, rect.id, tuple(oldgeom), newgeom))
+
+    def record_delete(self, kind, rect, index):
+        self._push(('delete', kind, rect.id, rect.GetBox(), index))
+
+    def record_clear(self, kind, rects):
+        if len(rects) == 0:
+            return
+        self._push(('clear', kind,\
+                tuple([(r.id, r.GetBox()) for r in rects])))
+
+    def record_add(self, kind, rects):
+        if len(rects) == 0:
+            return
+        self._push(('add', kind, tuple([(r.id, r.GetBox()) for r in rects])))
+
+    def record_reshape(self, kind, changes):
+        '''
+        Record the resizing of many boxes, changes is a list of (rect,
+        oldgeom).
+        '''
+        if len(changes) == 0:
+            return
+        self._push(('reshape', kind, tuple([(r.id, tuple(oldgeom),\
+                r.GetBox()) for r, oldgeom in changes])))
+
+    def _push(self, delta):
+        self.undostack.append(delta)
+        if (self.limit is not None) and (len(self.undostack) > self.limit):
+            del self.undostack[0]
+        # a new edit invalidates whatever could have been redone
+        del self.redostack[:]
+        self._notify(delta)
+
+    def _notify(self, delta):
+        self.version += 1
+        for listener in self.listeners:
+            listener(delta)
+
+    ### Undo / redo ###
+
+    def CanUndo(self):
+        return len(self.undostack) > 0
+
+    def CanRedo(self):
+        return len(self.redostack) > 0
+
+    def Undo(self):
+        '''
+        Revert the most recent edit, returns the delta undone or None.
+        '''
+        if not self.CanUndo():
+            return None
+        delta = self.undostack.pop()
+        inverse = invert_delta(delta)
+        apply_delta(self.getpanels, inverse)
+        self.redostack.append(delta)
+        self._notify(inverse)
+        return delta
+
+    def Redo(self):
+        '''
+        Re-apply the most recently undone edit, returns the delta or None.
+        '''
+        if not self.CanRedo():
+            return None
+        delta = self.redostack.pop()
+        apply_delta(self.getpanels, delta)
+        self.undostack.append(delta)
+        self._notify(delta)
+        return delta
+
+    def Reset(self):
+        '''
+        Forget all history, e.g. when a new image is opened.
+        '''
+        del self.undostack[:]
+        del self.redostack[:]
+        # the boxes are usually replaced wholesale along with the history
+        self.version += 1
+
+def invert_delta(delta):
+    '''
+    Return the delta that reverts delta. Reverting a clear is expressed as a
+    'restore' that re-creates all its boxes.
+    '''
+    op = delta[0]
+    if op == 'create':
+        _, kind, boxid, geom = delta
+        return ('delete', kind, boxid, geom, None)
+    if op == 'resize':
+        _, kind, boxid, oldgeom, newgeom = delta
+        return ('resize', kind, boxid, newgeom, oldgeom)
+    if op == 'delete':
+        _, kind, boxid, geom, index = delta
+        return ('insert', kind, boxid, geom, index)
+    if op == 'clear':
+        return ('restore',) + delta[1:]
+    if op == 'add':
+        return ('remove',) + delta[1:]
+    if op == 'remove':
+        return ('add',) + delta[1:]
+    if op == 'reshape':
+        return ('reshape', delta[1], tuple([(boxid, newgeom, oldgeom)\
+                for boxid, oldgeom, newgeom in delta[2]]))
+    raise ValueError("Cannot invert edit " + repr(op))
+
+def _find_index(panels, boxid):
+    # Boxes that are edited are usually the most recent ones so search from
+    # the end
+    for i in xrange(len(panels) - 1, -1, -1):
+        if panels[i].id == boxid:
+            return i
+    raise KeyError("No box with id %d" % boxid)
+
+def apply_delta(getpanels, delta):
+    '''
+    Apply delta to the panel lists returned by getpanels.
+    '''
+    op = delta[0]
+    panels = getpanels(delta[1])
+    if op in ('create', 'insert'):
+        boxid, geom = delta[2], delta[3]
+        rect = Rect(geom[0], geom[1], geom[2], geom[3], boxid=boxid)
+        index = delta[4] if op == 'insert' else None
+        if index is None:
+            panels.append(rect)
+        else:
+            panels.insert(index, rect)
+    elif op == 'resize':
+        rect = panels[_find_index(panels, delta[2])]
+        geom = delta[4]
+        rect.SetPosition((geom[0], geom[1]))
+        rect.SetSize((geom[2], geom[3]))
+    elif op == 'delete':
+        del panels[_find_index(panels, delta[2])]
+    elif op == 'clear':
+        del panels[:]
+    elif op == 'reshape':
+        newgeoms = dict([(boxid, newgeom)\
+                for boxid, oldgeom, newgeom in delta[2]])
+        for rect in panels:
+            geom = newgeoms.get(rect.id)
+            if geom is not None:
+                rect.SetPosition((geom[0], geom[1]))
+                rect.SetSize((geom[2], geom[3]))
+    elif op == 'remove':
+        boxids = set([boxid for boxid, geom in delta[2]])
+        panels[:] = [r for r in panels if r.id not in boxids]
+    elif op in ('restore', 'add'):
+        panels.extend([Rect(geom[0], geom[1], geom[2], geom[3], boxid=boxid)\
+                for boxid, geom in delta[2]])
+    else:
+        raise ValueError("Unknown edit " + repr(op))
@@ -36,6 +36,73 @@ depending on what mode you are in currently. Note that when \
 deleting boxes you will only delete the type of boxes whose mode \
 you are in currently. This is also true for the Clear method.
 
+Drawing, resizing, deleting and clearing boxes can be undone with \
+File->Undo and redone with File->Redo. Clearing all the boxes of a \
+mode is undone in one step.
+
+Box edits are autosaved as they happen to a journal next to the \
+image (ending in .gtj). If the program stops before you save, you \
+will be offered to restore the boxes the next time you open the \
+image. Saving the boxes or closing the program normally empties \
+the journal.
+
+File->Save session stores the boxes, the notes and the \
+preprocessed image next to the image (ending in .gts). Use \
+File->Open session to carry on annotating the page later without \
+waiting for the image to be preprocessed. This does not write an \
+MEI file, use File->Save for that.
+
+If the GTRUTH_STORE environment variable names a database file, \
+File->Save also stores the page in that corpus store, and \
+File->Load from store brings back the boxes and notes stored for \
+the current page.
+
+File->Propose staff boxes finds the staves on the page and \
+proposes a staff box for each system, drawn dashed. Hold down \
+control and click on a proposal to accept it, or control and \
+right-click to reject it. File->Propose bar boxes proposes \
+bar boxes between the barlines found inside each staff box, and \
+keeps doing so whenever the staff boxes change until it is turned \
+off again. File->Accept proposals and \
+File->Reject proposals do this for all the proposals of the mode \
+you are in.
+
+When File->Snap to ink is checked, the edges of the box you are \
+drawing or resizing are pulled to the nearest place where the ink \
+inside the box begins or ends, or onto a nearby barline.
+
+To shrink a box to the ink inside it, click on it with the middle \
+mouse button. File->Tighten boxes does this for every box of the \
+mode you are in, and File->Tighten all boxes for every box on the \
+page. Tightening can be undone.
+
+Opened images are preprocessed (greyscale, binarization and \
+rotation correction) and kept in a cache, so opening an image again \
+is quick. The GTRUTH_PIPELINE environment variable chooses other \
+preprocessing, e.g. \
+greyscale,border_removal,binarize:method=sauvola,rotation \
+to also remove the scan borders and binarize with Sauvola's method. \
+Run gtruth_preprocess.py on a corpus directory beforehand to \
+preprocess all of its pages into the cache at once.
+
+MEI files are saved compressed if their name ends in .mei.gz (gzip) \
+or .mei.zst (zstd, needs the zstandard module), and compressed files \
+are loaded just like plain ones.
+
+File->Load predictions loads a directory of MEI files written by \
+the barline finder (or sets GTRUTH_PREDICTIONS to one at startup) \
+and proposes the predicted boxes on every page opened, to be \
+accepted, rejected or corrected like any other proposals. The \
+first load parses the whole directory in the background; after \
+that the predictions come straight from the cache.
+
+When zoomed so far out that the boxes are only a few pixels on \
+the screen, they are drawn as a shaded map of where the boxes \
+are, darker where more of them overlap, instead of outlines; \
+zoom in to see the outlines again. The GTRUTH_LOD_SIZE \
+environment variable sets the on-screen size in pixels below \
+which this happens (0 always draws outlines).
+
 There is a minimum box size that you are allowed to draw to keep \
 you from saving some erroneous boxes. If you are finding that it \
 be too small or large, it may be adjusted using Increase Minimum \
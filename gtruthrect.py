@@ -4,15 +4,24 @@ are inside of this rectangle) and have methods for finding rectangles with
 certain properties.
 '''
 
+import itertools
+
+# Source of the ids that identify each Rect for the lifetime of the program
+_rect_ids = itertools.count(1)
+
 class Rect:
     '''
     Represents a rectangle.
     '''
-    def __init__(self,posx,posy,szx,szy,num=-1):
+    def __init__(self,posx,posy,szx,szy,num=-1,boxid=None):
         self.pos = (posx,posy)
         self.size = (szx,szy)
         self.children = []
         self.number = num
+        # A Rect that is restored (e.g. by undo) keeps the id it had before
+        if boxid is None:
+            boxid = next(_rect_ids)
+        self.id = boxid
 
     def SetNumber(self,num):
         '''
@@ -76,6 +85,15 @@ class Rect:
     def ClearChildren(self):
         self.children = []
 
+def reserve_rect_ids(maxid):
+    '''
+    Make sure Rects created from now on get ids greater than maxid, e.g. after
+    restoring boxes with ids from a previous session.
+    '''
+    global _rect_ids
+    nextid = next(_rect_ids)
+    _rect_ids = itertools.count(max(nextid, maxid + 1))
+
 def get_bounding_rect(rects):
     '''
     Return the rectangle that can fit all the rectangles within it.
@@ -85,5 +103,47 @@ def get_bounding_rect(rects):
     hix  = max(rects, key=lambda x: x.pos[0] + x.size[0])
     hiy  = max(rects, key=lambda x: x.pos[1] + x.size[1])
     return Rect(lowx.pos[0], lowy.pos[1], (hix.pos[0]+hix.size[0])-lowx.pos[0],\
-            (hiy.pos[1]+hix.size[1])-lowy.pos[1])
+            (hiy.pos[1]+hiy.size[1])-lowy.pos[1])
+
+def build_staff_hierarchy(staffrects, barrects):
+    '''
+    Group the bar rectangles under the staff rectangles that enclose them.
+    Returns a list of new Rects, one per staff, with the staff's own geometry
+    and holding its bars as children. The staves are sorted top to bottom and
+    numbered in that order, and their children are sorted left to right, and
+    the bars are numbered in that (reading) order. Staves without bars are
+    kept.
+    '''
+    staff_bb = []
+
+    for rect in staffrects:
+
+        # Find the rectangles this rectangle bounds
+        children = rect.GetRectsInBounds(barrects)
+
+        # A copy, so numbering the staves does not change the boxes drawn
+        srect = Rect(rect.pos[0], rect.pos[1], rect.size[0], rect.size[1],\
+                boxid=rect.id)
+
+        # Set its children to the bounded rects
+        # We don't use FindChildren because I'm worried some children might
+        # be missing after resizing (this is a stupid worry) but also due to
+        # the order of how this saving is carried out
+        srect.SetChildren(children)
+
+        staff_bb.append(srect)
+
+    # Sort the staves by upper left hand y coordinate and their children by
+    # upper left hand x coordinate so that they may be accurately numbered
+    staff_bb.sort(key=lambda c: c.pos[1])
+    idx = 1
+    for staffidx, rect in enumerate(staff_bb):
+        rect.SetNumber(staffidx + 1)
+        rect.children.sort(key=lambda c: c.pos[0])
+        # assuming no bars belonging to multiple staves, they may now be
+        # numbered
+        for c in rect.children:
+            c.SetNumber(idx)
+            idx = idx + 1
 
+    return staff_bb
@@ -16,3 +16,9 @@ class GtruthTextFrame(wx.Frame):
 
     def SaveText(self, filename):
         self.control.SaveFile(filename,wx.TEXT_TYPE_ANY)
+
+    def GetText(self):
+        return self.control.GetValue()
+
+    def SetText(self, text):
+        self.control.SetValue(text)